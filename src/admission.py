@@ -0,0 +1,194 @@
+# admission.py
+import asyncio
+import math
+import time
+
+from collections import OrderedDict
+
+ADMISSION_ACTIONS = ("close", "tarpit")
+
+# Reasons a connection was turned away, as counted in stats().
+RATE, IP_CAP, GLOBAL_CAP = "rate", "ip_cap", "global_cap"
+
+
+class _Source:
+    """Token bucket and live connection count of one source IP."""
+
+    __slots__ = ("tokens", "last", "active")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.last = now
+        self.active = 0
+
+
+class Admission:
+    """Decides which accepted connections get a session.
+
+    Each source IP has a connect-rate token bucket and a cap on concurrent
+    connections, and all sources share a global connection cap. Per-source
+    state lives in an LRU table of at most `table_size` entries, so a scan
+    from many addresses can't grow it without bound.
+
+    Connections over a limit never reach the emulator. They are either
+    aborted right away ("close") or held open without being read for
+    `tarpit_seconds` ("tarpit"), up to `max_tarpit` at a time.
+
+    Every engine worker has its own Admission. from_config() splits the
+    limits between `workers`, since SO_REUSEPORT spreads a source's
+    connections across all of them.
+    """
+
+    def __init__(
+        self,
+        per_ip: int = 16,
+        rate: float = 5.0,
+        burst: int = 20,
+        max_connections: int = 4096,
+        table_size: int = 65536,
+        action: str = "close",
+        tarpit_seconds: float = 30,
+        max_tarpit: int = 1024,
+    ):
+        if action not in ADMISSION_ACTIONS:
+            raise ValueError(f"admission.action must be one of {', '.join(ADMISSION_ACTIONS)}")
+        self.per_ip = per_ip
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_connections = max_connections
+        self.table_size = max(1, table_size)
+        self.action = action
+        self.tarpit_seconds = tarpit_seconds
+        self.max_tarpit = max_tarpit
+
+        self._sources = OrderedDict()
+        self.active = 0
+        self.tarpitting = 0
+        self.admitted = 0
+        self.rejected = {RATE: 0, IP_CAP: 0, GLOBAL_CAP: 0}
+        self.tarpitted = 0
+        self.evicted = 0
+        self._last_warn = 0.0
+
+    @classmethod
+    def from_config(cls, cfg: dict, workers: int = 1):
+        def share(value):
+            # NOTE: Rounded up and kept above 0, so a split limit never turns into "disabled".
+            return max(1, math.ceil(value / workers)) if value else value
+
+        return cls(
+            per_ip=share(cfg.get("per_ip", 16)),
+            rate=cfg.get("rate", 5.0) / workers,
+            burst=share(cfg.get("burst", 20)),
+            max_connections=share(cfg.get("max_connections", 4096)),
+            table_size=cfg.get("table_size", 65536),
+            action=cfg.get("action", "close"),
+            tarpit_seconds=cfg.get("tarpit_seconds", 30),
+            max_tarpit=share(cfg.get("max_tarpit", 1024)),
+        )
+
+    def _source(self, ip: str, now: float) -> _Source:
+        src = self._sources.get(ip)
+        if src is not None:
+            self._sources.move_to_end(ip)
+            return src
+        # NOTE: Prefer evicting idle sources, dropping a busy one only loses its cap until it reconnects.
+        for _ in range(min(8, len(self._sources))):
+            if len(self._sources) < self.table_size:
+                break
+            old_ip, old = self._sources.popitem(last=False)
+            if old.active:
+                self._sources[old_ip] = old
+            else:
+                self.evicted += 1
+        while len(self._sources) >= self.table_size:
+            self._sources.popitem(last=False)
+            self.evicted += 1
+        src = self._sources[ip] = _Source(float(self.burst), now)
+        return src
+
+    def admit(self, ip: str) -> str:
+        """Admits a connection from `ip`. Returns None, or the limit it is over."""
+        now = time.monotonic()
+        src = self._source(ip, now)
+        if self.rate:
+            src.tokens = min(self.burst, src.tokens + (now - src.last) * self.rate)
+            src.last = now
+            if src.tokens < 1:
+                return RATE
+            src.tokens -= 1
+        if self.per_ip and src.active >= self.per_ip:
+            return IP_CAP
+        if self.max_connections and self.active >= self.max_connections:
+            return GLOBAL_CAP
+        src.active += 1
+        self.active += 1
+        self.admitted += 1
+        return None
+
+    def release(self, ip: str):
+        self.active -= 1
+        src = self._sources.get(ip)
+        if src is not None and src.active:
+            src.active -= 1
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "admitted": self.admitted,
+            "tarpitting": self.tarpitting,
+            "tarpitted": self.tarpitted,
+            "sources": len(self._sources),
+            "evicted": self.evicted,
+            **{f"rejected_{k}": v for k, v in self.rejected.items()},
+        }
+
+    def _rejected(self, reason: str):
+        self.rejected[reason] += 1
+        now = time.monotonic()
+        if now - self._last_warn >= 10:
+            self._last_warn = now
+            r = self.rejected
+            print(
+                f"[WARN] Admission limits hit: {r[RATE]} over rate, {r[IP_CAP]} over per-IP cap, "
+                f"{r[GLOBAL_CAP]} over global cap so far ({self.active} sessions active)"
+            )
+
+    def turn_away(self, transport: asyncio.BaseTransport) -> asyncio.Future:
+        """Tarpits or aborts a connection that was not admitted. The returned future is done once it is dropped."""
+        loop = asyncio.get_running_loop()
+        gone = loop.create_future()
+        if self.action == "tarpit" and self.tarpitting < self.max_tarpit:
+            self.tarpitting += 1
+            self.tarpitted += 1
+            transport.pause_reading()
+            # NOTE: A loop timer rather than a sleeping task, so a held connection costs no coroutine.
+            loop.call_later(self.tarpit_seconds, self._end_tarpit, transport, gone)
+            return gone
+        transport.abort()
+        gone.set_result(None)
+        return gone
+
+    def _end_tarpit(self, transport: asyncio.BaseTransport, gone: asyncio.Future):
+        self.tarpitting -= 1
+        transport.abort()
+        if not gone.done():
+            gone.set_result(None)
+
+    def wrap(self, handler):
+        """Wraps an emulator's connection handler with admission checks."""
+
+        async def admitted(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            peer = writer.get_extra_info("peername")
+            ip = peer[0] if peer else "?"
+            reason = self.admit(ip)
+            if reason:
+                self._rejected(reason)
+                await self.turn_away(writer.transport)
+                return
+            try:
+                await handler(reader, writer)
+            finally:
+                self.release(ip)
+
+        return admitted
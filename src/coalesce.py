@@ -0,0 +1,119 @@
+# coalesce.py
+import time
+import uuid
+
+from collections import OrderedDict
+
+DEFAULT_WINDOW = 300
+DEFAULT_MAX_ENTRIES = 10000
+
+
+class _Window:
+    """The first session of a repeat group and how often it was seen since."""
+
+    __slots__ = ("record", "first_seen", "last_seen", "hits")
+
+    def __init__(self, record: dict):
+        self.record = record
+        self.first_seen = record["start_ts"]
+        self.last_seen = record["start_ts"]
+        self.hits = 1
+
+
+class Coalescer:
+    """Collapses repeated identical sessions before they are stored.
+
+    Sessions are grouped by service, source, port, end reason and a digest of
+    the client's bytes, so connect-and-close scans and a bot replaying the
+    same payload land in one group. The first session of a group is stored
+    and reported as usual and opens a `window` of seconds in which further
+    sessions of that group are only counted. When the window closes, a group
+    that saw repeats updates its first session's row with `hit_count` and
+    `last_seen`, in whichever partition that row was stored; first-seen is
+    the row's start_ts.
+
+    At most `max_entries` windows are open; past that the oldest closes
+    early. Groups are keyed on the client digest the emulator put in
+    msg["payload"], so nothing is hashed here; sessions queued without one
+    can't be compared and are passed through.
+    """
+
+    def __init__(self, window: float = DEFAULT_WINDOW, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.window = window
+        self.max_entries = max(1, max_entries)
+        self._open = OrderedDict()
+        self._closed = []
+        self.absorbed = 0
+        self.counters = 0
+
+    @classmethod
+    def from_config(cls, cfg: dict):
+        if not cfg.get("enabled", False):
+            return None
+        return cls(cfg.get("window", DEFAULT_WINDOW), cfg.get("max_entries", DEFAULT_MAX_ENTRIES))
+
+    @staticmethod
+    def key(msg: dict) -> tuple:
+        if "payload" not in msg:
+            return None
+        return (
+            msg["service"],
+            msg["ip"],
+            msg["port"],
+            msg.get("end_reason"),
+            msg.get("truncated_bytes", 0),
+            msg["payload"] or "",
+        )
+
+    def add(self, msg: dict) -> dict:
+        """Returns `msg` if it should be stored, or None if it was counted as a repeat."""
+        key = self.key(msg)
+        if key is None:
+            return msg
+        win = self._open.get(key)
+        if win is not None and msg["start_ts"] < win.first_seen + self.window:
+            win.hits += 1
+            win.last_seen = max(win.last_seen, msg["start_ts"])
+            self.absorbed += 1
+            return None
+        if win is not None:
+            self._closed.append(self._open.pop(key))
+        elif len(self._open) >= self.max_entries:
+            self._closed.append(self._open.pop(next(iter(self._open))))
+        # NOTE: The stored session needs a known id so its counter row can replace it later.
+        msg.setdefault("session_id", str(uuid.uuid4()))
+        self._open[key] = _Window({k: v for k, v in msg.items() if k != "details"})
+        return msg
+
+    def expired(self, now: float = None) -> list:
+        """Closes every window past its end. Returns the counter records to store."""
+        now = time.time() if now is None else now
+        closed, self._closed = self._closed, []
+        # NOTE: Windows open in arrival order, close enough to start_ts order that expired ones are at the front.
+        while self._open:
+            key, win = next(iter(self._open.items()))
+            if win.first_seen + self.window > now:
+                break
+            closed.append(self._open.pop(key))
+        return self._counters(closed)
+
+    def drain(self) -> list:
+        """Closes every open window, e.g. at shutdown."""
+        closed, self._closed = self._closed + list(self._open.values()), []
+        self._open.clear()
+        return self._counters(closed)
+
+    def _counters(self, closed: list) -> list:
+        out = []
+        for win in closed:
+            if win.hits < 2:
+                continue
+            self.counters += 1
+            # NOTE: The first session was reported already; the counter only updates its stored row.
+            out.append(
+                win.record | {"hit_count": win.hits, "last_seen": win.last_seen, "report": False, "details": None}
+            )
+        return out
+
+    def stats(self) -> dict:
+        return {"open": len(self._open), "absorbed": self.absorbed, "counters": self.counters}
@@ -0,0 +1,158 @@
+# emulators/artifacts.py
+import asyncio
+import hashlib
+import os
+import uuid
+
+DEFAULT_DIRECTORY = "artifacts"
+DEFAULT_MAX_BYTES = 0
+FLUSH_SIZE = 64 * 1024
+
+
+class Upload:
+    """One body being streamed into the store.
+
+    write() hashes every chunk and buffers it, handing the buffer to a thread
+    for the disk write once it holds FLUSH_SIZE bytes, so the session keeps
+    at most that much in memory. Past `max_size` the spool file is dropped
+    and the rest is only counted, so finish() can report the size that was
+    attempted. Without a store only the hash and size are kept.
+    """
+
+    __slots__ = ("store", "max_size", "sha256", "size", "path", "_file", "_buf", "too_large")
+
+    def __init__(self, store, max_size: int):
+        self.store = store
+        self.max_size = max_size
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.path = None
+        self._file = None
+        self._buf = bytearray()
+        self.too_large = False
+
+    async def write(self, data: bytes):
+        self.size += len(data)
+        if self.too_large:
+            return
+        if self.max_size and self.size > self.max_size:
+            self.too_large = True
+            await self.abort()
+            return
+        self.sha256.update(data)
+        if self.store is None:
+            return
+        self._buf += data
+        if len(self._buf) >= FLUSH_SIZE:
+            await self._flush()
+
+    async def _flush(self):
+        chunk, self._buf = bytes(self._buf), bytearray()
+        if self._file is None:
+            self.path, self._file = await asyncio.to_thread(self.store.open_spool)
+        await asyncio.to_thread(self._file.write, chunk)
+
+    async def finish(self) -> dict:
+        """Moves the body into the store. Returns its sha256, size and whether it is kept on disk."""
+        if self.too_large:
+            return {"size": self.size, "too_large": True}
+        digest = self.sha256.hexdigest()
+        stored = False
+        if self.store is not None:
+            if self._buf or self._file is None:
+                await self._flush()
+            self._file.close()
+            self._file = None
+            stored = await asyncio.to_thread(self.store.commit, self.path, digest, self.size)
+            self.path = None
+        return {"sha256": digest, "size": self.size, "stored": stored}
+
+    async def abort(self):
+        self._buf = bytearray()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.path is not None:
+            await asyncio.to_thread(_unlink, self.path)
+            self.path = None
+
+
+class ArtifactStore:
+    """Content-addressed directory of captured bodies (mail, uploads).
+
+    A body is named after its sha256 and written once: uploads spool into
+    `tmp/` and are renamed to `<aa>/<sha256>` when finished, or deleted if
+    that body is already stored. With `max_bytes`, new bodies stop being
+    kept once the directory holds that much; their hashes are still logged.
+    The size used is counted by this process only, so with several workers
+    the cap is approximate.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.tmp = os.path.join(directory, "tmp")
+        self.used = None
+
+    @classmethod
+    def from_config(cls, cfg: dict):
+        if not cfg.get("enabled", True):
+            return None
+        return cls(cfg.get("directory", DEFAULT_DIRECTORY), cfg.get("max_bytes", DEFAULT_MAX_BYTES))
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def open_spool(self) -> tuple:
+        os.makedirs(self.tmp, exist_ok=True)
+        path = os.path.join(self.tmp, uuid.uuid4().hex)
+        return path, open(path, "wb")
+
+    def _scan(self) -> int:
+        used = 0
+        for root, _, files in os.walk(self.directory):
+            if root == self.tmp:
+                continue
+            for name in files:
+                try:
+                    used += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return used
+
+    def commit(self, spool: str, digest: str, size: int) -> bool:
+        """Moves a finished spool file to its content address. Returns whether the body is on disk."""
+        final = self.path(digest)
+        if os.path.exists(final):
+            _unlink(spool)
+            return True
+        if self.max_bytes:
+            if self.used is None:
+                self.used = self._scan()
+            if self.used + size > self.max_bytes:
+                _unlink(spool)
+                return False
+        os.makedirs(os.path.dirname(final), exist_ok=True)
+        os.replace(spool, final)
+        if self.used is not None:
+            self.used += size
+        return True
+
+
+def _unlink(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+_stores = {}
+
+
+def store(cfg: dict) -> ArtifactStore:
+    """The store for the `artifacts` config section, shared by every emulator in the process."""
+    key = (cfg.get("enabled", True), cfg.get("directory", DEFAULT_DIRECTORY))
+    if key not in _stores:
+        _stores[key] = ArtifactStore.from_config(cfg)
+    return _stores[key]
+
@@ -1,11 +1,355 @@
 # emulators/base.py
 import asyncio
+import hashlib
+import time
+
+from array import array
+
+from logger import enqueue
+
+from .latency import LatencyModel
+from .persona import DEFAULT_STICKY_SIZE, HostIdentity, PersonaSet
+
+DEFAULT_CAPTURE_BYTES = 256 * 1024
+DEFAULT_CAPTURE_FRAMES = 2000
+DEFAULT_IDLE_TIMEOUT = 60
+DEFAULT_MAX_SESSION = 600
+DEFAULT_MAX_LINE = 8192
+HANDLER_MODES = ("stream", "protocol")
+
+# end_reasons that mean a limit cut the session short; such sessions are logged even without commands.
+TRIP_REASONS = ("idle_timeout", "session_timeout", "line_too_long")
+
+DIRECTIONS = ("client", "server")
+_DIRECTION_CODES = {name: i for i, name in enumerate(DIRECTIONS)}
+_CLIENT = _DIRECTION_CODES["client"]
+
+
+class _Frames:
+    """Column-oriented frame storage.
+
+    Timestamps, directions and payload end offsets live in flat arrays and
+    every payload is appended to one contiguous buffer, so a frame costs a few
+    bytes of bookkeeping instead of a tuple, a float and a bytes object.
+    Frames can be dropped from the front; the arrays are compacted lazily.
+    """
+
+    __slots__ = ("ts", "dirs", "ends", "data", "first")
+
+    def __init__(self):
+        self.ts = array("d")
+        self.dirs = bytearray()
+        self.ends = array("Q")
+        self.data = bytearray()
+        self.first = 0
+
+    def __len__(self):
+        return len(self.ts) - self.first
+
+    def _start(self, i: int) -> int:
+        return self.ends[i - 1] if i else 0
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.data) - self._start(self.first)
+
+    def append(self, ts: float, direction: int, data: bytes):
+        self.ts.append(ts)
+        self.dirs.append(direction)
+        self.data += data
+        self.ends.append(len(self.data))
+
+    def popleft(self) -> int:
+        """Drops the oldest frame and returns its size in bytes."""
+        i = self.first
+        size = self.ends[i] - self._start(i)
+        self.first += 1
+        if self.first >= 64 and self.first * 2 >= len(self.ts):
+            self._compact()
+        return size
+
+    def _compact(self):
+        i, shift = self.first, self._start(self.first)
+        self.ts = self.ts[i:]
+        self.dirs = self.dirs[i:]
+        self.ends = array("Q", (e - shift for e in self.ends[i:]))
+        del self.data[:shift]
+        self.first = 0
+
+    def __iter__(self):
+        view = memoryview(self.data)
+        for i in range(self.first, len(self.ts)):
+            yield self.ts[i], DIRECTIONS[self.dirs[i]], view[self._start(i) : self.ends[i]]
+
+
+class Transcript:
+    """Records a session's frames within a byte and frame budget.
+
+    Frames fill the head of the transcript until it has used its share of the
+    budget; the frame that doesn't fit is cut to what's left of it, so one
+    oversized first packet still leaves a head. Later frames go to a tail
+    ring that only keeps the most recent ones, so a client streaming garbage
+    can't grow the session without bound. Whatever falls out of the ring is
+    counted in dropped_frames, and bytes cut from frames in dropped_bytes.
+
+    The transcript is handed to the log writer as is and only packed and
+    compressed there. Client bytes are hashed as they are added, so the
+    digest the coalescer and the payloads table key on is ready when the
+    session ends.
+    """
+
+    __slots__ = (
+        "head",
+        "tail",
+        "head_bytes_max",
+        "tail_bytes_max",
+        "head_frames_max",
+        "tail_frames_max",
+        "total_frames",
+        "total_bytes",
+        "dropped_frames",
+        "dropped_bytes",
+        "client_hash",
+        "digest",
+    )
+
+    def __init__(
+        self,
+        max_bytes=DEFAULT_CAPTURE_BYTES,
+        max_frames=DEFAULT_CAPTURE_FRAMES,
+        tail_ratio=0.25,
+    ):
+        self.tail_bytes_max = int(max_bytes * tail_ratio)
+        self.head_bytes_max = max_bytes - self.tail_bytes_max
+        self.tail_frames_max = max(1, int(max_frames * tail_ratio))
+        self.head_frames_max = max(1, max_frames - self.tail_frames_max)
+
+        self.head = _Frames()
+        # NOTE: Created once the head is full, most sessions never need one.
+        self.tail = None
+
+        self.total_frames = 0
+        self.total_bytes = 0
+        self.dropped_frames = 0
+        self.dropped_bytes = 0
+        self.client_hash = None
+        self.digest = None
+
+    def add(self, direction: str, data: bytes, ts: float = None):
+        ts = ts or time.time()
+        code = _DIRECTION_CODES[direction]
+        n = len(data)
+        self.total_frames += 1
+        self.total_bytes += n
+
+        head = self.head
+        if not self.tail and len(head) < self.head_frames_max:
+            room = self.head_bytes_max - head.nbytes
+            if n > room:
+                if room <= 0:
+                    self._add_tail(ts, code, data, n)
+                    return
+                # NOTE: The head is full after this, so later frames go to the tail and stay in order.
+                data = data[:room]
+                self.dropped_bytes += n - room
+            head.append(ts, code, data)
+            if code == _CLIENT and data:
+                if self.client_hash is None:
+                    self.client_hash = hashlib.sha256()
+                self.client_hash.update(data)
+            return
+        self._add_tail(ts, code, data, n)
+
+    def _add_tail(self, ts: float, code: int, data: bytes, n: int):
+        tail = self.tail
+        if tail is None:
+            tail = self.tail = _Frames()
+        if n > self.tail_bytes_max:
+            data = data[: self.tail_bytes_max]
+            self.dropped_bytes += n - len(data)
+        tail.append(ts, code, data)
+        while tail and (len(tail) > self.tail_frames_max or tail.nbytes > self.tail_bytes_max):
+            self.dropped_bytes += tail.popleft()
+            self.dropped_frames += 1
+
+    def client_digest(self) -> str:
+        """sha256 hex of the client bytes kept, None if the client sent nothing. Call once the session ended."""
+        if self.digest is None:
+            h = self.client_hash
+            if self.tail is not None:
+                # NOTE: The tail ring drops frames until the end, so only what it kept then is hashed.
+                sent = h is not None
+                h = h.copy() if sent else hashlib.sha256()
+                for _, direction, payload in self.tail:
+                    if direction == "client" and payload:
+                        sent = True
+                        h.update(payload)
+                if not sent:
+                    h = None
+            self.digest = h.hexdigest() if h is not None else ""
+            # NOTE: Hash objects can't be pickled, and workers ship transcripts to the supervisor.
+            self.client_hash = None
+        return self.digest or None
+
+    @property
+    def truncated(self) -> bool:
+        return self.dropped_bytes > 0
+
+    def __iter__(self):
+        """Yields (ts, direction, payload) with payload as a memoryview."""
+        yield from self.head
+        if self.tail is not None:
+            yield from self.tail
+
+    def __len__(self):
+        return len(self.head) + (len(self.tail) if self.tail is not None else 0)
+
+
+class SessionLimit(Exception):
+    """Raised when a session hits one of its limits; `reason` names which."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class Limits:
+    """Idle, total-duration and line-length limits for one session.
+
+    Every read and drain goes through wait(), which allows at most the idle
+    timeout and never past the session deadline. A tripped limit raises
+    SessionLimit and is remembered in `reason`, which ends up in the
+    session's end_reason.
+    """
+
+    __slots__ = ("idle", "deadline", "reason")
+
+    def __init__(self, idle: float, max_session: float):
+        self.idle = idle or None
+        self.deadline = time.monotonic() + max_session if max_session else None
+        self.reason = "closed"
+
+    @property
+    def tripped(self) -> bool:
+        return self.reason in TRIP_REASONS
+
+    def _trip(self, reason: str):
+        self.reason = reason
+        raise SessionLimit(reason)
+
+    async def wait(self, aw):
+        timeout, reason = self.idle, "idle_timeout"
+        if self.deadline is not None:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                aw.close()
+                self._trip("session_timeout")
+            if timeout is None or remaining < timeout:
+                timeout, reason = remaining, "session_timeout"
+        try:
+            async with asyncio.timeout(timeout):
+                return await aw
+        except TimeoutError:
+            self._trip(reason)
+
+    async def readline(self, reader: asyncio.StreamReader) -> bytes:
+        # NOTE: The StreamReader limit is set to max_line, readline raises ValueError past it.
+        try:
+            return await self.wait(reader.readline())
+        except ValueError:
+            self._trip("line_too_long")
+
+    async def read(self, reader: asyncio.StreamReader, n: int) -> bytes:
+        return await self.wait(reader.read(n))
+
+    async def readexactly(self, reader: asyncio.StreamReader, n: int) -> bytes:
+        return await self.wait(reader.readexactly(n))
+
+    async def drain(self, writer: asyncio.StreamWriter):
+        await self.wait(writer.drain())
+
 
 class BaseEmulator:
+    service = None
+    # ProtocolSession subclass serving `mode: "protocol"`, for the emulators that have one.
+    protocol = None
+
     def __init__(self, bind_ip="0.0.0.0", bind_port=None, config=None):
         self.bind_ip = bind_ip
         self.bind_port = bind_port or self.port
         self.config = config or {}
+        self.emu_config = self.config.get("emulators", {}).get(self.service) or {}
+        self.capture_bytes = self.emu_config.get("capture_bytes", DEFAULT_CAPTURE_BYTES)
+        self.capture_frames = self.emu_config.get("capture_frames", DEFAULT_CAPTURE_FRAMES)
+        self.idle_timeout = self.emu_config.get("idle_timeout", DEFAULT_IDLE_TIMEOUT)
+        self.max_session = self.emu_config.get("max_session", DEFAULT_MAX_SESSION)
+        self.max_line = self.emu_config.get("max_line", DEFAULT_MAX_LINE)
+        self.mode = self.emu_config.get("mode", "stream")
+        if self.mode not in HANDLER_MODES:
+            raise ValueError(f"emulators.{self.service}.mode must be one of {', '.join(HANDLER_MODES)}")
+        if self.mode == "protocol" and self.protocol is None:
+            print(f"[WARN] The {self.service} emulator has no protocol mode, using stream")
+            self.mode = "stream"
+        self.latency = LatencyModel.from_config(self.emu_config, self.config.get("latency") or {})
+        persona_cfg = self.config.get("persona") or {}
+        sticky = persona_cfg.get("sticky_size", DEFAULT_STICKY_SIZE) if persona_cfg.get("sticky", False) else 0
+        self.personas = PersonaSet(self.build_personas, sticky)
+
+    def build_personas(self, host: HostIdentity) -> list:
+        """Returns this emulator's persona variants for `host`, with banners pre-encoded."""
+        return [None]
+
+    def new_transcript(self) -> Transcript:
+        return Transcript(self.capture_bytes, self.capture_frames)
+
+    def new_limits(self) -> Limits:
+        return Limits(self.idle_timeout, self.max_session)
+
+    async def log_session(
+        self,
+        ip: str,
+        start_ts: float,
+        cmd_count: int,
+        transcript: Transcript,
+        limits: Limits,
+        fields: dict = None,
+    ):
+        """Queues the session for storage.
+
+        `fields` holds what the emulator parsed out of the client's messages
+        (user names, cookies, ...) and is stored as JSON with the session.
+        """
+        await enqueue(self.session_record(ip, start_ts, cmd_count, transcript, limits.reason, fields))
+
+    def session_record(
+        self,
+        ip: str,
+        start_ts: float,
+        cmd_count: int,
+        transcript: Transcript,
+        reason: str,
+        fields: dict = None,
+    ) -> dict:
+        return {
+            "service": self.service,
+            "ip": ip,
+            "port": self.bind_port,
+            "start_ts": start_ts,
+            "end_ts": time.time(),
+            "cmd_count": cmd_count,
+            "truncated_frames": transcript.dropped_frames,
+            "truncated_bytes": transcript.dropped_bytes,
+            "end_reason": reason,
+            "details": transcript,
+            "payload": transcript.client_digest(),
+            "fields": fields,
+        }
+
+    async def start_udp(self, reuse_port: bool = False):
+        """Starts the emulator's UDP side, for the emulators that have one."""
+
+    async def close(self):
+        """Stops and flushes whatever the emulator runs besides its TCP server."""
 
     async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         raise NotImplementedError
@@ -0,0 +1,276 @@
+# emulators/framing.py
+import asyncio
+import struct
+
+READ_SIZE = 65536
+DEFAULT_MAX_FRAME = 1024 * 1024
+
+_MYSQL_HEADER = struct.Struct("<I")
+_TPKT_HEADER = struct.Struct(">BxH")
+
+# MySQL client capability flags used when parsing the handshake response.
+CLIENT_CONNECT_WITH_DB = 0x00000008
+CLIENT_PROTOCOL_41 = 0x00000200
+CLIENT_SSL = 0x00000800
+CLIENT_SECURE_CONNECTION = 0x00008000
+CLIENT_PLUGIN_AUTH = 0x00080000
+CLIENT_PLUGIN_AUTH_LENENC_CLIENT_DATA = 0x00200000
+
+# VNC client-to-server messages: type -> (name, fixed size, offset and width of a trailing length).
+VNC_MESSAGES = {
+    0: ("SetPixelFormat", 20, None),
+    2: ("SetEncodings", 4, (2, 2, 4)),
+    3: ("FramebufferUpdateRequest", 10, None),
+    4: ("KeyEvent", 8, None),
+    5: ("PointerEvent", 6, None),
+    6: ("ClientCutText", 8, (4, 4, 1)),
+}
+
+RDP_PROTOCOLS = {0x1: "ssl", 0x2: "hybrid", 0x4: "rdstls", 0x8: "hybrid_ex"}
+
+
+class FramingError(Exception):
+    """The peer sent something that can't be a frame of the expected protocol."""
+
+
+class FrameReader:
+    """Reads protocol frames off a stream into one growable buffer.
+
+    Reads land in a bytearray and frames are handed out as memoryview slices
+    of it, so parsing a frame copies nothing. A view stays valid until the
+    next call on the reader; callers keep what they need with bytes(). The
+    consumed prefix is dropped only once it is at least half the buffer.
+    Reads go through the session's Limits, so timeouts still apply. A frame
+    longer than `max_frame` raises FramingError, and EOF inside a frame
+    raises asyncio.IncompleteReadError.
+    """
+
+    __slots__ = ("reader", "limits", "max_frame", "buf", "pos", "_views")
+
+    def __init__(self, reader: asyncio.StreamReader, limits, max_frame: int = DEFAULT_MAX_FRAME):
+        self.reader = reader
+        self.limits = limits
+        self.max_frame = max_frame
+        self.buf = bytearray()
+        self.pos = 0
+        self._views = []
+
+    @property
+    def buffered(self) -> int:
+        return len(self.buf) - self.pos
+
+    def _release(self):
+        for view in self._views:
+            try:
+                view.release()
+            except BufferError:
+                pass
+        self._views.clear()
+
+    async def fill(self, n: int) -> bool:
+        """Buffers at least `n` unread bytes. Returns False on EOF before any byte arrives."""
+        if n > self.max_frame:
+            raise FramingError(f"frame of {n} bytes exceeds {self.max_frame}")
+        self._release()
+        while self.buffered < n:
+            data = await self.limits.read(self.reader, READ_SIZE)
+            if not data:
+                if not self.buffered:
+                    return False
+                raise asyncio.IncompleteReadError(bytes(self.buf[self.pos :]), n)
+            try:
+                if self.pos and self.pos * 2 >= len(self.buf):
+                    del self.buf[: self.pos]
+                    self.pos = 0
+                self.buf += data
+            except BufferError:
+                # NOTE: Something still holds a slice of a handed-out frame, so move to a fresh buffer.
+                self.buf = self.buf[self.pos :] + data
+                self.pos = 0
+        return True
+
+    def take(self, n: int) -> memoryview:
+        """Consumes `n` already-buffered bytes."""
+        with memoryview(self.buf) as whole:
+            view = whole[self.pos : self.pos + n]
+        self._views.append(view)
+        self.pos += n
+        return view
+
+    def peek(self, n: int) -> bytes:
+        return bytes(self.buf[self.pos : self.pos + n])
+
+    async def exactly(self, n: int) -> memoryview:
+        if not await self.fill(n):
+            raise asyncio.IncompleteReadError(b"", n)
+        return self.take(n)
+
+    async def chunk(self) -> memoryview:
+        """Whatever is buffered (reading once if nothing is), or None on EOF."""
+        if not await self.fill(1):
+            return None
+        return self.take(self.buffered)
+
+    async def frame(self, sizer) -> memoryview:
+        """Returns the next frame as measured by `sizer`, or None on EOF between frames."""
+        if not await self.fill(1):
+            return None
+        while (size := sizer(self.buf, self.pos, len(self.buf))) is None:
+            await self.fill(self.buffered + 1)
+        await self.fill(size)
+        return self.take(size)
+
+    async def mysql_packet(self) -> tuple:
+        """Returns (sequence id, wire frame, payload), or None on EOF between packets."""
+        frame = await self.frame(mysql_size)
+        if frame is None:
+            return None
+        payload = frame[4:]
+        self._views.append(payload)
+        return frame[3], frame, payload
+
+    async def tpkt(self) -> tuple:
+        """Returns (wire frame, payload) of a TPKT or RDP fast-path PDU, or None on EOF.
+
+        Fast-path PDUs come back with a None payload; they carry no X.224 data.
+        """
+        frame = await self.frame(tpkt_size)
+        if frame is None:
+            return None
+        if frame[0] != 0x03:
+            return frame, None
+        payload = frame[4:]
+        self._views.append(payload)
+        return frame, payload
+
+    async def vnc_message(self) -> tuple:
+        """Returns (message name, wire frame) of one RFB client message, or None on EOF."""
+        frame = await self.frame(vnc_size)
+        if frame is None:
+            return None
+        return VNC_MESSAGES[frame[0]][0], frame
+
+
+# Sizers measure the frame starting at buf[pos], with buf[pos:end] buffered. They return its
+# total length, or None if more bytes are needed to tell, and raise FramingError on garbage.
+
+
+def fixed_size(n: int):
+    return lambda buf, pos, end: n
+
+
+def mysql_size(buf, pos: int, end: int) -> int:
+    if end - pos < 4:
+        return None
+    return 4 + (_MYSQL_HEADER.unpack_from(buf, pos)[0] & 0xFFFFFF)
+
+
+def tpkt_size(buf, pos: int, end: int) -> int:
+    if end - pos < 4:
+        return None
+    first = buf[pos]
+    if first == 0x03:
+        _, size = _TPKT_HEADER.unpack_from(buf, pos)
+        if size < 4:
+            raise FramingError(f"TPKT length {size} is shorter than its header")
+        return size
+    if first & 0x03 == 0:
+        size = buf[pos + 1]
+        if size & 0x80:
+            size = (size & 0x7F) << 8 | buf[pos + 2]
+        if size < 2:
+            raise FramingError(f"fast-path length {size} is too short")
+        return size
+    raise FramingError(f"not a TPKT or fast-path header (0x{first:02x})")
+
+
+def vnc_size(buf, pos: int, end: int) -> int:
+    kind = buf[pos]
+    spec = VNC_MESSAGES.get(kind)
+    if spec is None:
+        raise FramingError(f"unknown RFB client message type {kind}")
+    _, size, trailer = spec
+    if trailer:
+        at, width, unit = trailer
+        if end - pos < at + width:
+            return None
+        size += int.from_bytes(buf[pos + at : pos + at + width], "big") * unit
+    return size
+
+
+def _cstring(view: memoryview, pos: int) -> tuple:
+    end = bytes(view[pos:]).find(b"\x00")
+    if end < 0:
+        return bytes(view[pos:]), len(view)
+    return bytes(view[pos : pos + end]), pos + end + 1
+
+
+def _lenenc(view: memoryview, pos: int) -> tuple:
+    first = view[pos]
+    if first < 0xFB:
+        return first, pos + 1
+    width = {0xFC: 2, 0xFD: 3, 0xFE: 8}.get(first)
+    if width is None:
+        raise FramingError(f"bad length-encoded integer prefix 0x{first:02x}")
+    return int.from_bytes(view[pos + 1 : pos + 1 + width], "little"), pos + 1 + width
+
+
+def parse_mysql_login(payload: memoryview) -> dict:
+    """Parses a MySQL HandshakeResponse (4.1 or the older 3.20 form).
+
+    Returns the username, whether a password was sent, the schema and the
+    auth plugin. An SSL request (the short packet sent before a TLS upgrade)
+    comes back as {"ssl": True}.
+    """
+    if len(payload) < 4:
+        raise FramingError("handshake response too short")
+    caps = int.from_bytes(payload[:2], "little")
+    if caps & CLIENT_PROTOCOL_41:
+        caps = int.from_bytes(payload[:4], "little")
+        if len(payload) == 32 and caps & CLIENT_SSL:
+            return {"ssl": True}
+        pos = 32
+    else:
+        pos = 5
+    if pos > len(payload):
+        raise FramingError("handshake response too short")
+    user, pos = _cstring(payload, pos)
+    auth_len = 0
+    if pos < len(payload):
+        if caps & CLIENT_PLUGIN_AUTH_LENENC_CLIENT_DATA:
+            auth_len, pos = _lenenc(payload, pos)
+            pos += auth_len
+        elif caps & CLIENT_SECURE_CONNECTION:
+            auth_len = payload[pos]
+            pos += 1 + auth_len
+        else:
+            auth, pos = _cstring(payload, pos)
+            auth_len = len(auth)
+    schema = plugin = b""
+    if caps & CLIENT_CONNECT_WITH_DB and pos < len(payload):
+        schema, pos = _cstring(payload, pos)
+    if caps & CLIENT_PLUGIN_AUTH and pos < len(payload):
+        plugin, pos = _cstring(payload, pos)
+    return {
+        "user": user.decode(errors="replace"),
+        "password": auth_len > 0,
+        "schema": schema.decode(errors="replace"),
+        "plugin": plugin.decode(errors="replace"),
+    }
+
+
+def parse_x224_request(payload: memoryview) -> dict:
+    """Parses an X.224 Connection Request: the routing cookie and RDP negotiation request."""
+    if len(payload) < 7 or payload[1] & 0xF0 != 0xE0:
+        raise FramingError("not an X.224 connection request")
+    end = min(len(payload), payload[0] + 1)
+    body = bytes(payload[7:end])
+    fields = {}
+    eol = body.find(b"\r\n")
+    if eol >= 0:
+        fields["cookie"] = body[:eol].decode(errors="replace")
+        body = body[eol + 2 :]
+    if len(body) >= 8 and body[0] == 0x01:
+        requested = int.from_bytes(body[4:8], "little")
+        fields["protocols"] = [name for bit, name in RDP_PROTOCOLS.items() if requested & bit] or ["rdp"]
+    return fields
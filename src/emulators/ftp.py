@@ -1,14 +1,101 @@
 # emulators/ftp.py
 import time
-import random
 import asyncio
-from .base import BaseEmulator
-from logger import queue
+import ipaddress
+from collections import deque
+from .base import BaseEmulator, SessionLimit
+from .artifacts import Upload, store
 
 def _peer_ip(writer):
     return writer.get_extra_info("peername")[0]
 
+DEFAULT_PASV_PORTS = (50000, 50099)
+DEFAULT_PASV_TIMEOUT = 30
+DEFAULT_MAX_UPLOAD = 10485760
+READ_SIZE = 65536
+# NOTE: Transfers listed per session record; later ones are only counted.
+MAX_LOGGED_TRANSFERS = 100
+
+FAKE_FILES = [
+    ("drwxr-xr-x", 2, 4096, "Mar 04  2023", "backup"),
+    ("drwxr-xr-x", 3, 4096, "Nov 19  2022", "pub"),
+    ("drwxrwxr-x", 2, 4096, "Jan 07 09:12", "upload"),
+    ("-rw-r--r--", 1, 220, "Feb 25  2022", ".bash_logout"),
+    ("-rw-r--r--", 1, 3771, "Feb 25  2022", ".bashrc"),
+    ("-rw-r--r--", 1, 1048, "Jun 13  2023", "README.txt"),
+    ("-rw-r--r--", 1, 58213, "Sep 30  2023", "site-backup.sql.gz"),
+]
+
+
+class PortPool:
+    """Passive-mode ports shared by every session of one emulator.
+
+    A port is taken when a session enters passive mode and given back when
+    its data channel closes, so at most len(ports) data sockets are open at
+    once. Ports are handed out round robin, so a port just released isn't
+    the next one reused.
+    """
+
+    __slots__ = ("free",)
+
+    def __init__(self, low: int, high: int):
+        self.free = deque(range(low, high + 1))
+
+    def acquire(self):
+        return self.free.popleft() if self.free else None
+
+    def release(self, port: int):
+        self.free.append(port)
+
+
+class DataChannel:
+    """One passive data connection: a listener on a pooled port that accepts a single client.
+
+    The channel is reclaimed (listener closed, port returned) when it's
+    closed, or after `timeout` seconds if no transfer has started on it.
+    """
+
+    __slots__ = ("pool", "port", "server", "conn", "reclaim", "closed")
+
+    def __init__(self, pool: PortPool, port: int, conn: asyncio.Future):
+        self.pool = pool
+        self.port = port
+        self.server = None
+        self.conn = conn
+        self.reclaim = None
+        self.closed = False
+
+    async def connected(self, timeout: float) -> tuple:
+        """Waits for the client's data connection. Returns (reader, writer), or None if it never came."""
+        if self.closed:
+            return None
+        if self.reclaim is not None:
+            self.reclaim.cancel()
+            self.reclaim = None
+        try:
+            async with asyncio.timeout(timeout):
+                return await asyncio.shield(self.conn)
+        except TimeoutError:
+            return None
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.reclaim is not None:
+            self.reclaim.cancel()
+        if self.server is not None:
+            self.server.close()
+        if self.conn.done() and not self.conn.cancelled():
+            self.conn.result()[1].close()
+        else:
+            self.conn.cancel()
+        self.pool.release(self.port)
+
+
 class FTPEmulator(BaseEmulator):
+    service = "ftp"
+
     def __init__(self, bind_ip=None, bind_port=None, config=None):
         super().__init__(bind_ip, bind_port, config)
 
@@ -17,35 +104,125 @@ class FTPEmulator(BaseEmulator):
             "220 ProFTPD 1.3.5 Server ready",
             "220 (Pure-FTPd 1.0.49)",
         ]
+        low, high = self.emu_config.get("pasv_ports") or DEFAULT_PASV_PORTS
+        self.ports = PortPool(low, high)
+        self.pasv_address = self.emu_config.get("pasv_address")
+        self.pasv_timeout = self.emu_config.get("pasv_timeout", DEFAULT_PASV_TIMEOUT)
+        self.max_upload = self.emu_config.get("max_upload", DEFAULT_MAX_UPLOAD)
+        self.artifacts = store(self.config.get("artifacts") or {})
+
+        self.LISTING = b"".join(
+            b"%s %3d ftp      ftp      %8d %s %s\r\n" % (mode.encode(), links, size, date.encode(), name.encode())
+            for mode, links, size, date, name in FAKE_FILES
+        )
+        self.NAMES = b"".join(name.encode() + b"\r\n" for *_, name in FAKE_FILES)
+
+    def build_personas(self, host):
+        return [b.encode() + b"\r\n" for b in self.BANNERS]
+
+    async def _passive(self, ip: str) -> DataChannel:
+        """Listens on a free pooled port for a data connection from `ip`. Returns None when the pool is exhausted."""
+        loop = asyncio.get_running_loop()
+        for _ in range(len(self.ports.free)):
+            port = self.ports.acquire()
+            if port is None:
+                break
+            channel = DataChannel(self.ports, port, loop.create_future())
+
+            def accept(reader, writer, channel=channel):
+                # NOTE: Only the control connection's peer may attach, so a port scan can't take over a transfer.
+                peer = writer.get_extra_info("peername")
+                if channel.conn.done() or not peer or peer[0] != ip:
+                    writer.close()
+                    return
+                channel.conn.set_result((reader, writer))
+                # NOTE: One connection per channel; stop listening as soon as it arrives.
+                channel.server.close()
+
+            try:
+                channel.server = await asyncio.start_server(accept, self.bind_ip, port)
+            except OSError:
+                # NOTE: Taken by another process (e.g. another worker), try the next port.
+                self.ports.release(port)
+                continue
+            channel.reclaim = loop.call_later(self.pasv_timeout, channel.close)
+            return channel
+        return None
+
+    def _pasv_reply(self, cmd: str, writer, port: int) -> bytes:
+        if cmd == "EPSV":
+            return b"229 Entering Extended Passive Mode (|||%d|)\r\n" % port
+        host = self.pasv_address or writer.get_extra_info("sockname")[0]
+        try:
+            addr = ipaddress.IPv4Address(host)
+        except ValueError:
+            return b"425 Use EPSV, this server has no IPv4 passive address.\r\n"
+        return b"227 Entering Passive Mode (%s,%d,%d).\r\n" % (
+            str(addr).replace(".", ",").encode(),
+            port >> 8,
+            port & 0xFF,
+        )
+
+    async def _send(self, channel: DataChannel, limits, data: bytes) -> bool:
+        conn = await channel.connected(self.pasv_timeout)
+        if conn is None:
+            return False
+        conn[1].write(data)
+        await limits.drain(conn[1])
+        return True
+
+    async def _receive(self, channel: DataChannel, limits, upload: Upload) -> bool:
+        conn = await channel.connected(self.pasv_timeout)
+        if conn is None:
+            return False
+        while True:
+            chunk = await limits.read(conn[0], READ_SIZE)
+            if not chunk:
+                return True
+            await upload.write(chunk)
+
+    async def _send_file(self, channel: DataChannel, limits, path: str) -> bool:
+        conn = await channel.connected(self.pasv_timeout)
+        if conn is None:
+            return False
+        with await asyncio.to_thread(open, path, "rb") as f:
+            while chunk := await asyncio.to_thread(f.read, READ_SIZE):
+                conn[1].write(chunk)
+                await limits.drain(conn[1])
+        return True
 
     async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         ip = _peer_ip(writer)
         start_ts = time.time()
-        transcript = []
+        transcript = self.new_transcript()
+        limits = self.new_limits()
         cmd_count = 0
         logged_in = False
-        banner = random.choice(self.BANNERS).encode() + b"\r\n"
-
-        async def jitter():
-            await asyncio.sleep(random.uniform(0.05, 0.15))
+        banner = self.personas.pick(ip)
+        channel = None
+        upload = None
+        fields = {}
+        # NOTE: name -> (sha256, size, stored) of this session's uploads, so SIZE and RETR can find them.
+        uploaded = {}
 
         try:
-            transcript.append((time.time(), "server", banner))
+            transcript.add("server", banner)
             writer.write(banner)
-            await writer.drain()
+            await limits.drain(writer)
 
             while True:
-                line = await reader.readline()
+                line = await limits.readline(reader)
                 if not line:
                     break
                 now = time.time()
-                transcript.append((now, "client", line))
+                transcript.add("client", line, now)
                 cmd_count += 1
-                await jitter()
+                await self.latency.pause()
 
                 cmd, *args = line.decode(errors="ignore").strip().split(" ", 1)
                 cmd = cmd.upper()
                 resp = b"502 Command not implemented.\r\n"
+                transfer = None
                 if cmd == "USER":
                     resp = (
                         b"331 Password required for %s\r\n" % args[0].encode()
@@ -61,37 +238,94 @@ class FTPEmulator(BaseEmulator):
                     resp = b'257 "/" is current directory\r\n'
                 elif cmd == "TYPE" and logged_in and args:
                     resp = b"200 Type set to %s\r\n" % args[0].encode()
+                elif cmd in ("CWD", "CDUP") and logged_in:
+                    resp = b"250 Directory successfully changed.\r\n"
+                elif cmd == "NOOP":
+                    resp = b"200 NOOP ok.\r\n"
+                elif cmd in ("PORT", "EPRT") and logged_in:
+                    # NOTE: Active mode would have the honeypot connect out (FTP bounce), so it's refused.
+                    resp = b"500 Illegal PORT command.\r\n"
+                elif cmd in ("PASV", "EPSV") and logged_in:
+                    if channel is not None:
+                        channel.close()
+                    channel = await self._passive(ip)
+                    if channel is None:
+                        resp = b"425 Can't open passive connection.\r\n"
+                    else:
+                        resp = self._pasv_reply(cmd, writer, channel.port)
+                elif cmd == "SIZE" and logged_in and args:
+                    known = uploaded.get(args[0])
+                    resp = b"213 %d\r\n" % known[1] if known else b"550 Could not get file size.\r\n"
+                elif cmd in ("LIST", "NLST", "STOR", "RETR") and logged_in:
+                    if channel is None:
+                        resp = b"425 Use PORT or PASV first.\r\n"
+                    elif cmd == "RETR" and not (args and uploaded.get(args[0], (0, 0, False))[2]):
+                        resp = b"550 Failed to open file.\r\n"
+                    elif cmd == "STOR" and not args:
+                        resp = b"501 No file name given.\r\n"
+                    else:
+                        resp = b"150 Opening BINARY mode data connection.\r\n"
+                        transfer = cmd
                 elif cmd == "QUIT":
                     resp = b"221 Goodbye.\r\n"
 
-                transcript.append((time.time(), "server", resp))
+                transcript.add("server", resp)
                 writer.write(resp)
-                await writer.drain()
+                await limits.drain(writer)
                 if cmd == "QUIT":
                     break
+                if transfer is None:
+                    continue
+
+                # NOTE: Data goes over the passive channel; only the outcome is logged, never the contents.
+                name = args[0] if args else ""
+                if transfer == "STOR":
+                    upload = Upload(self.artifacts, self.max_upload)
+                    done = await self._receive(channel, limits, upload)
+                    if not done:
+                        # NOTE: No data connection came, so there is nothing to store or log.
+                        await upload.abort()
+                        upload = None
+                    else:
+                        result = await upload.finish()
+                        upload = None
+                        if result.get("too_large"):
+                            resp = b"552 Requested file action aborted. Exceeded storage allocation.\r\n"
+                        else:
+                            if name in uploaded or len(uploaded) < MAX_LOGGED_TRANSFERS:
+                                uploaded[name] = (result["sha256"], result["size"], result["stored"])
+                            resp = b"226 Transfer complete.\r\n"
+                        count = fields["upload_count"] = fields.get("upload_count", 0) + 1
+                        if count <= MAX_LOGGED_TRANSFERS:
+                            fields.setdefault("uploads", []).append({"name": name} | result)
+                elif transfer == "RETR":
+                    try:
+                        done = await self._send_file(channel, limits, self.artifacts.path(uploaded[name][0]))
+                        resp = b"226 Transfer complete.\r\n"
+                    except FileNotFoundError:
+                        # NOTE: The store pruned the artifact since; only this transfer fails.
+                        done, resp = True, b"550 Failed to open file.\r\n"
+                else:
+                    done = await self._send(channel, limits, self.LISTING if transfer == "LIST" else self.NAMES)
+                    resp = b"226 Directory send OK.\r\n"
+                if not done:
+                    resp = b"425 Failed to establish connection.\r\n"
+                channel.close()
+                channel = None
+                transcript.add("server", resp)
+                writer.write(resp)
+                await limits.drain(writer)
 
-        except (ConnectionResetError, OSError):
+        except (SessionLimit, ConnectionResetError, OSError):
             pass
 
         finally:
-            if cmd_count:
-                payload = {
-                    "service": "ftp",
-                    "ip": ip,
-                    "port": self.bind_port,
-                    "start_ts": start_ts,
-                    "end_ts": time.time(),
-                    "cmd_count": cmd_count,
-                    "details": [
-                        {
-                            "ts": ts,
-                            "direction": d,
-                            "data": data.decode("latin-1", errors="ignore").rstrip(),
-                        }
-                        for ts, d, data in transcript
-                    ],
-                }
-                await queue.put(payload)
+            if channel is not None:
+                channel.close()
+            if upload is not None:
+                await upload.abort()
+            if cmd_count or limits.tripped:
+                await self.log_session(ip, start_ts, cmd_count, transcript, limits, fields)
             try:
                 writer.close()
                 await writer.wait_closed()
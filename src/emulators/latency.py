@@ -0,0 +1,128 @@
+# emulators/latency.py
+import asyncio
+import math
+import random
+
+DELAY_DISTRIBUTIONS = ("uniform", "lognormal", "none")
+DEFAULT_TICK_MS = 10
+WHEEL_SLOTS = 512
+
+
+class TimerWheel:
+    """Coarse timer shared by every session on one event loop.
+
+    Sessions waiting to respond are dropped into the slot for their due tick
+    instead of each getting its own loop timer. A single loop callback runs
+    per tick while anything is pending and wakes everything due in that slot
+    at once. Delays are rounded to whole ticks; ones longer than the wheel
+    fall back to a plain loop timer.
+    """
+
+    def __init__(self, tick: float, slots: int = WHEEL_SLOTS):
+        self.tick = tick
+        self.size = slots
+        self._reset(None)
+
+    def _reset(self, loop):
+        self.slots = [[] for _ in range(self.size)]
+        self.pos = 0
+        self.pending = 0
+        self._loop = loop
+        self._next = 0.0
+        self._handle = None
+
+    def sleep(self, delay: float) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # NOTE: A new event loop (e.g. a fresh asyncio.run) starts with an empty wheel.
+            self._reset(loop)
+        fut = loop.create_future()
+        ticks = max(1, math.ceil(delay / self.tick))
+        if ticks > self.size:
+            loop.call_later(delay, _wake, fut)
+            return fut
+        if self._handle is None:
+            self._next = loop.time() + self.tick
+            self._handle = loop.call_at(self._next, self._advance)
+        # NOTE: Slot `pos` is the one the next tick wakes.
+        self.slots[(self.pos + ticks - 1) % self.size].append(fut)
+        self.pending += 1
+        return fut
+
+    def _advance(self):
+        now = self._loop.time()
+        # NOTE: Catch up on every tick that is due, the loop may have been busy past several.
+        while self._next <= now and self.pending:
+            due, self.slots[self.pos] = self.slots[self.pos], []
+            self.pending -= len(due)
+            for fut in due:
+                _wake(fut)
+            self.pos = (self.pos + 1) % self.size
+            self._next += self.tick
+        self._handle = self._loop.call_at(self._next, self._advance) if self.pending else None
+
+
+def _wake(fut: asyncio.Future):
+    if not fut.done():
+        fut.set_result(None)
+
+
+_wheels = {}
+
+
+def wheel(tick_ms: float = DEFAULT_TICK_MS) -> TimerWheel:
+    tw = _wheels.get(tick_ms)
+    if tw is None:
+        tw = _wheels[tick_ms] = TimerWheel(tick_ms / 1000)
+    return tw
+
+
+class LatencyModel:
+    """Draws response delays for one emulator and waits them out on the wheel.
+
+    "uniform" draws between low and high. "lognormal" clusters around their
+    geometric mean with an occasional slower reply, clamped to the range.
+    "none", or a disabled latency section, answers immediately.
+    """
+
+    __slots__ = ("distribution", "low", "high", "wheel", "_mu")
+
+    def __init__(self, distribution: str, low: float, high: float, tw: TimerWheel = None):
+        if distribution not in DELAY_DISTRIBUTIONS:
+            raise ValueError(f"delay must be one of {', '.join(DELAY_DISTRIBUTIONS)}")
+        self.distribution = distribution if high > 0 else "none"
+        self.low = low
+        self.high = max(low, high)
+        self.wheel = tw or wheel()
+        self._mu = math.log(math.sqrt(max(low, 1e-3) * self.high)) if self.high > 0 else 0.0
+
+    @classmethod
+    def from_config(cls, emu_cfg: dict, latency_cfg: dict):
+        distribution = emu_cfg.get("delay", "uniform")
+        if not latency_cfg.get("enabled", True):
+            distribution = "none"
+        return cls(
+            distribution,
+            emu_cfg.get("delay_min", 0.05),
+            emu_cfg.get("delay_max", 0.15),
+            wheel(latency_cfg.get("tick_ms", DEFAULT_TICK_MS)),
+        )
+
+    def sample(self) -> float:
+        if self.distribution == "uniform":
+            return random.uniform(self.low, self.high)
+        if self.distribution == "lognormal":
+            return min(self.high, max(self.low, random.lognormvariate(self._mu, 0.5)))
+        return 0.0
+
+    async def pause(self):
+        if self.distribution == "none":
+            return
+        await self.wheel.sleep(self.sample())
+
+    def later(self, callback, *args):
+        """Calls `callback(*args)` after a drawn delay, for code running in loop callbacks."""
+        if self.distribution == "none":
+            callback(*args)
+            return
+        self.wheel.sleep(self.sample()).add_done_callback(lambda _: callback(*args))
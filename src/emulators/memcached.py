@@ -2,77 +2,512 @@
 import time
 import random
 import asyncio
-from .base import BaseEmulator
-from logger import queue
+import socket
+from collections import OrderedDict
+from logger import enqueue
+from .base import BaseEmulator, SessionLimit
 
 def _peer_ip(writer):
     return writer.get_extra_info("peername")[0]
 
+UDP_HEADER_SIZE = 8
+UDP_REPLY_HEADER = b"\x00\x00\x00\x01\x00\x00"  # Sequence 0 of 1 datagram, reserved.
+UDP_SAMPLE_BYTES = 512
+
+
+class _Probe:
+    """UDP traffic from one source within the current bucket."""
+
+    __slots__ = ("count", "nbytes", "first_ts", "last_ts", "sample", "sample_cut", "reply", "replies")
+
+    def __init__(self, now: float, data: bytes):
+        self.count = 0
+        self.nbytes = 0
+        self.first_ts = now
+        self.last_ts = now
+        self.sample = data[:UDP_SAMPLE_BYTES]
+        self.sample_cut = len(data) - len(self.sample)
+        self.reply = None
+        self.replies = 0
+
+
+class MemcachedUDP(asyncio.DatagramProtocol):
+    """Memcached's UDP protocol, which is what amplification scans probe.
+
+    Each datagram carries an 8-byte frame header (request id, sequence
+    number, datagram count, reserved). Replies echo the request id and are
+    never larger than the request, so the honeypot can't be used to amplify;
+    a source only gets `udp_replies` replies per bucket. Probes are counted
+    per source and logged as one session per source per `udp_bucket`
+    seconds, with the first datagram and reply as its transcript and the
+    datagram and byte counts in its fields.
+    """
+
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.transport = None
+        self.sources = {}
+        self.bodies = {}
+        self.malformed = 0
+        self.overflow = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        n = len(data)
+        if n < UDP_HEADER_SIZE:
+            self.malformed += 1
+            return
+        ip = addr[0]
+        now = time.time()
+        probe = self.sources.get(ip)
+        if probe is None:
+            if len(self.sources) >= self.emulator.udp_max_sources:
+                self.overflow += 1
+                return
+            probe = self.sources[ip] = _Probe(now, data)
+        probe.count += 1
+        probe.nbytes += n
+        probe.last_ts = now
+        if probe.replies >= self.emulator.udp_replies:
+            return
+        probe.replies += 1
+        reply = self._reply(data, ip)
+        if reply is not None:
+            self.transport.sendto(reply, addr)
+            if probe.reply is None:
+                probe.reply = reply
+
+    def _reply(self, data: bytes, ip: str):
+        version = self.emulator.personas.pick(ip, remember=False)
+        bodies = self.bodies.get(version)
+        if bodies is None:
+            bodies = self.bodies[version] = (
+                f"STAT version {version}\r\nEND\r\n".encode(),
+                f"VERSION {version}\r\n".encode(),
+            )
+        # NOTE: startswith at an offset avoids copying the payload out of the datagram.
+        if data.startswith((b"stats", b"STATS"), UDP_HEADER_SIZE):
+            body = bodies[0]
+        elif data.startswith((b"version", b"VERSION"), UDP_HEADER_SIZE):
+            body = bodies[1]
+        elif data.startswith((b"get", b"GET"), UDP_HEADER_SIZE):
+            body = b"END\r\n"
+        else:
+            body = b"ERROR\r\n"
+        if UDP_HEADER_SIZE + len(body) > len(data):
+            # NOTE: A bare "stats\r\n" probe only has room for an empty listing.
+            body = b"END\r\n" if body is bodies[0] else b"ERROR\r\n"
+            if UDP_HEADER_SIZE + len(body) > len(data):
+                return None
+        return data[:2] + UDP_REPLY_HEADER + body
+
+    async def flush(self):
+        sources, self.sources = self.sources, {}
+        for ip, probe in sources.items():
+            transcript = self.emulator.new_transcript()
+            transcript.add("client", probe.sample, probe.first_ts)
+            if probe.reply is not None:
+                transcript.add("server", probe.reply, probe.first_ts)
+            await enqueue(
+                {
+                    "service": self.emulator.service,
+                    "ip": ip,
+                    "port": self.emulator.bind_port,
+                    "start_ts": probe.first_ts,
+                    "end_ts": probe.last_ts,
+                    "cmd_count": probe.count,
+                    "truncated_frames": transcript.dropped_frames,
+                    "truncated_bytes": transcript.dropped_bytes + probe.sample_cut,
+                    "end_reason": "udp",
+                    # NOTE: UDP sources are trivially spoofed, reporting them could report a victim.
+                    "report": False,
+                    "details": transcript,
+                    "payload": transcript.client_digest(),
+                    "fields": {"datagrams": probe.count, "datagram_bytes": probe.nbytes},
+                }
+            )
+        if self.overflow or self.malformed:
+            print(
+                f"[WARN] Memcached UDP: {self.overflow} probes past udp_max_sources, "
+                f"{self.malformed} malformed datagrams ignored"
+            )
+            self.overflow = self.malformed = 0
+
+
+MAX_KEY_LENGTH = 250
+ITEM_OVERHEAD = 56  # Rough per-item bookkeeping cost charged against the budgets.
+MAX_RELATIVE_EXPTIME = 30 * 24 * 3600  # Larger exptimes are absolute unix times, as in memcached.
+STORAGE_COMMANDS = (b"set", b"add", b"replace", b"append", b"prepend", b"cas")
+
+
+class _Item:
+    __slots__ = ("value", "flags", "expires", "cas", "size")
+
+    def __init__(self, key: bytes, value: bytes, flags: int, expires: float, cas: int):
+        self.value = value
+        self.flags = flags
+        self.expires = expires
+        self.cas = cas
+        self.size = len(key) + len(value) + ITEM_OVERHEAD
+
+
+class _Namespace:
+    """One source's items, in LRU order, and its counters."""
+
+    __slots__ = ("items", "bytes", "hits", "misses", "sets", "total_items", "evictions")
+
+    def __init__(self):
+        self.items = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.total_items = 0
+        self.evictions = 0
+
+
+class ItemStore:
+    """Items stored by memcached clients, shared by every session.
+
+    Keys live in per-source namespaces, so a client only ever sees what it
+    (or another connection from its IP) stored. All namespaces share a byte
+    budget of `max_bytes`, with the least recently used items evicted
+    store-wide, and each namespace is held to `source_bytes` on its own so one
+    source can't evict everyone else. At most `max_sources` namespaces are
+    kept; the least recently active one is dropped with its items. Expired
+    items are dropped on access.
+    """
+
+    def __init__(self, max_bytes: int, source_bytes: int, max_item_size: int, max_sources: int):
+        self.max_bytes = max_bytes
+        self.source_bytes = min(source_bytes, max_bytes)
+        self.max_item_size = max_item_size
+        self.max_sources = max(1, max_sources)
+        self._lru = OrderedDict()
+        self._namespaces = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+        self._cas = 0
+
+    def namespace(self, ns: str) -> _Namespace:
+        space = self._namespaces.get(ns)
+        if space is not None:
+            self._namespaces.move_to_end(ns)
+            return space
+        if len(self._namespaces) >= self.max_sources:
+            old_ns, old = self._namespaces.popitem(last=False)
+            for key in old.items:
+                del self._lru[(old_ns, key)]
+            self.bytes -= old.bytes
+        space = self._namespaces[ns] = _Namespace()
+        return space
+
+    def _link(self, ns: str, space: _Namespace, key: bytes, item: _Item):
+        space.items[key] = item
+        self._lru[(ns, key)] = item
+        space.bytes += item.size
+        self.bytes += item.size
+
+    def _unlink(self, ns: str, space: _Namespace, key: bytes) -> _Item:
+        item = space.items.pop(key)
+        del self._lru[(ns, key)]
+        space.bytes -= item.size
+        self.bytes -= item.size
+        return item
+
+    def _evict(self, ns: str, space: _Namespace):
+        while space.bytes > self.source_bytes:
+            self._unlink(ns, space, next(iter(space.items)))
+            space.evictions += 1
+            self.evictions += 1
+        while self.bytes > self.max_bytes:
+            old_ns, old_key = next(iter(self._lru))
+            old = self._namespaces[old_ns]
+            self._unlink(old_ns, old, old_key)
+            old.evictions += 1
+            self.evictions += 1
+
+    def _lookup(self, ns: str, space: _Namespace, key: bytes, now: float) -> _Item:
+        item = space.items.get(key)
+        if item is not None and item.expires and item.expires <= now:
+            self._unlink(ns, space, key)
+            return None
+        return item
+
+    def _expires(self, exptime: int, now: float) -> float:
+        if not exptime:
+            return 0
+        return now + exptime if exptime <= MAX_RELATIVE_EXPTIME else exptime
+
+    def get(self, ns: str, key: bytes, now: float) -> _Item:
+        space = self.namespace(ns)
+        item = self._lookup(ns, space, key, now)
+        if item is None:
+            space.misses += 1
+            return None
+        space.hits += 1
+        space.items.move_to_end(key)
+        self._lru.move_to_end((ns, key))
+        return item
+
+    def store(self, ns: str, cmd: bytes, key: bytes, flags: int, exptime: int, value: bytes, now: float, cas: int = None) -> bytes:
+        space = self.namespace(ns)
+        space.sets += 1
+        current = self._lookup(ns, space, key, now)
+
+        if cmd == b"add" and current is not None:
+            return b"NOT_STORED"
+        if cmd in (b"replace", b"append", b"prepend") and current is None:
+            return b"NOT_STORED"
+        if cmd == b"cas":
+            if current is None:
+                return b"NOT_FOUND"
+            if current.cas != cas:
+                return b"EXISTS"
+        if cmd == b"append":
+            value, flags, expires = current.value + value, current.flags, current.expires
+        elif cmd == b"prepend":
+            value, flags, expires = value + current.value, current.flags, current.expires
+        elif exptime < 0:
+            # NOTE: A negative exptime stores an already expired item, i.e. removes it.
+            if current is not None:
+                self._unlink(ns, space, key)
+            return b"STORED"
+        else:
+            expires = self._expires(exptime, now)
+        if len(value) > self.max_item_size:
+            return b"SERVER_ERROR object too large for cache"
+
+        if current is not None:
+            self._unlink(ns, space, key)
+        self._cas += 1
+        self._link(ns, space, key, _Item(key, value, flags, expires, self._cas))
+        space.total_items += 1
+        self._evict(ns, space)
+        return b"STORED"
+
+    def delete(self, ns: str, key: bytes, now: float) -> bool:
+        space = self.namespace(ns)
+        if self._lookup(ns, space, key, now) is None:
+            return False
+        self._unlink(ns, space, key)
+        return True
+
+    def incr(self, ns: str, key: bytes, delta: int, decr: bool, now: float) -> bytes:
+        space = self.namespace(ns)
+        item = self._lookup(ns, space, key, now)
+        if item is None:
+            return b"NOT_FOUND"
+        if not item.value.isdigit():
+            return b"CLIENT_ERROR cannot increment or decrement non-numeric value"
+        value = int(item.value)
+        value = max(0, value - delta) if decr else (value + delta) % 2**64
+        self._unlink(ns, space, key)
+        self._cas += 1
+        encoded = str(value).encode()
+        self._link(ns, space, key, _Item(key, encoded, item.flags, item.expires, self._cas))
+        self._evict(ns, space)
+        return encoded
+
+    def touch(self, ns: str, key: bytes, exptime: int, now: float) -> bool:
+        item = self.get(ns, key, now)
+        if item is None:
+            return False
+        item.expires = self._expires(exptime, now)
+        return True
+
+    def flush(self, ns: str):
+        space = self.namespace(ns)
+        for key in list(space.items):
+            self._unlink(ns, space, key)
+
+
 class MemcachedEmulator(BaseEmulator):
+    service = "memcached"
+
     def __init__(self, bind_ip=None, bind_port=None, config=None):
         super().__init__(bind_ip, bind_port, config)
 
         self.VERSIONS = ["1.5.22", "1.6.9", "1.6.17", "1.6.21"]
 
+        self.store = ItemStore(
+            self.emu_config.get("item_bytes", 64 * 1024 * 1024),
+            self.emu_config.get("source_item_bytes", 1024 * 1024),
+            self.emu_config.get("max_item_size", 1024 * 1024),
+            self.emu_config.get("max_sources", 65536),
+        )
+        self.pid = random.randint(1000, 5000)
+        # NOTE: Look like a server that has been up for a while, not one started with the honeypot.
+        self.started = time.time() - random.randint(86400, 90 * 86400)
+        self.curr_connections = 0
+        self.total_connections = 0
+
+        self.udp = self.emu_config.get("udp", False)
+        self.udp_bucket = self.emu_config.get("udp_bucket", 60)
+        self.udp_replies = self.emu_config.get("udp_replies", 1)
+        self.udp_max_sources = self.emu_config.get("udp_max_sources", 65536)
+        self._udp = None
+        self._udp_flusher = None
+
+    def build_personas(self, host):
+        return self.VERSIONS
+
+    async def start_udp(self, reuse_port: bool = False):
+        if not self.udp:
+            return
+        loop = asyncio.get_running_loop()
+        family = socket.AF_INET6 if ":" in self.bind_ip else socket.AF_INET
+        _, self._udp = await loop.create_datagram_endpoint(
+            lambda: MemcachedUDP(self),
+            local_addr=(self.bind_ip, self.bind_port),
+            family=family,
+            reuse_port=reuse_port or None,
+        )
+        self._udp_flusher = asyncio.create_task(self._flush_udp())
+        print(f"[INFO] Emulator memcached listening on {self.bind_ip}:{self.bind_port}/udp")
+
+    async def _flush_udp(self):
+        while True:
+            await asyncio.sleep(self.udp_bucket)
+            await self._udp.flush()
+
+    async def close(self):
+        if self._udp is None:
+            return
+        self._udp.transport.close()
+        self._udp_flusher.cancel()
+        await self._udp.flush()
+
+    async def _discard(self, reader, limits, transcript, n: int):
+        """Swallows an oversized data block without buffering it."""
+        while n > 0:
+            chunk = await limits.read(reader, min(n, 65536))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b"", n)
+            transcript.add("client", chunk)
+            n -= len(chunk)
+
+    async def _storage(self, ns, parts, reader, limits, transcript, now) -> bytes:
+        cmd = parts[0].lower()
+        try:
+            key, flags, exptime, size = parts[1], int(parts[2]), int(parts[3]), int(parts[4])
+            cas = int(parts[5]) if cmd == b"cas" else None
+        except (IndexError, ValueError):
+            return b"CLIENT_ERROR bad command line format\r\n"
+        if len(key) > MAX_KEY_LENGTH or size < 0 or flags < 0:
+            return b"CLIENT_ERROR bad command line format\r\n"
+        if size > self.store.max_item_size:
+            await self._discard(reader, limits, transcript, size + 2)
+            return b"SERVER_ERROR object too large for cache\r\n"
+        block = await limits.readexactly(reader, size + 2)
+        transcript.add("client", block)
+        if block[-2:] != b"\r\n":
+            return b"CLIENT_ERROR bad data chunk\r\n"
+        return self.store.store(ns, cmd, key, flags, exptime, block[:-2], now, cas) + b"\r\n"
+
+    def _get(self, ns, keys, with_cas: bool, now) -> bytes:
+        out = bytearray()
+        # NOTE: Repeated keys are answered once, so a single line can't multiply a large item.
+        for key in dict.fromkeys(keys):
+            item = self.store.get(ns, key, now)
+            if item is None:
+                continue
+            if with_cas:
+                out += b"VALUE %s %d %d %d\r\n" % (key, item.flags, len(item.value), item.cas)
+            else:
+                out += b"VALUE %s %d %d\r\n" % (key, item.flags, len(item.value))
+            out += item.value
+            out += b"\r\n"
+        out += b"END\r\n"
+        return bytes(out)
+
+    def _stats(self, ns, version, now) -> bytes:
+        space = self.store.namespace(ns)
+        return b"".join(
+            (
+                b"STAT pid %d\r\n" % self.pid,
+                b"STAT uptime %d\r\n" % int(now - self.started),
+                b"STAT time %d\r\n" % int(now),
+                b"STAT version %s\r\n" % version.encode(),
+                b"STAT curr_connections %d\r\n" % self.curr_connections,
+                b"STAT total_connections %d\r\n" % self.total_connections,
+                b"STAT cmd_get %d\r\n" % (space.hits + space.misses),
+                b"STAT cmd_set %d\r\n" % space.sets,
+                b"STAT get_hits %d\r\n" % space.hits,
+                b"STAT get_misses %d\r\n" % space.misses,
+                b"STAT curr_items %d\r\n" % len(space.items),
+                b"STAT total_items %d\r\n" % space.total_items,
+                b"STAT bytes %d\r\n" % space.bytes,
+                b"STAT evictions %d\r\n" % space.evictions,
+                b"STAT limit_maxbytes %d\r\n" % self.store.source_bytes,
+                b"END\r\n",
+            )
+        )
+
     async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         ip = _peer_ip(writer)
         start_ts = time.time()
-        transcript = []
+        transcript = self.new_transcript()
+        limits = self.new_limits()
         cmd_count = 0
-        version = random.choice(self.VERSIONS)
-
-        async def jitter():
-            await asyncio.sleep(random.uniform(0.05, 0.15))
+        version = self.personas.pick(ip)
+        store = self.store
+        self.curr_connections += 1
+        self.total_connections += 1
 
         try:
             while True:
-                data = await reader.readline()
+                data = await limits.readline(reader)
                 if not data:
                     break
                 now = time.time()
-                transcript.append((now, "client", data))
+                transcript.add("client", data, now)
                 cmd_count += 1
-                await jitter()
-                parts = data.strip().split()
-                cmd = parts[0].upper() if parts else b""
-                if cmd == b"STATS":
-                    lines = [
-                        f"STAT pid {random.randint(1000,5000)}",
-                        f"STAT uptime {int(now-start_ts)}",
-                        f"STAT version {version}",
-                        f"STAT curr_items {random.randint(0,10)}",
-                        f"STAT total_connections {random.randint(1,50)}",
-                    ]
-                    resp = b"".join((l + "\r\n").encode() for l in lines) + b"END\r\n"
-                elif cmd == b"VERSION":
+                parts = data.split()
+                cmd = parts[0].lower() if parts else b""
+                noreply = len(parts) > 1 and parts[-1] == b"noreply"
+                if cmd in STORAGE_COMMANDS:
+                    resp = await self._storage(ip, parts, reader, limits, transcript, now)
+                elif cmd in (b"get", b"gets") and len(parts) > 1:
+                    resp = self._get(ip, parts[1:], cmd == b"gets", now)
+                elif cmd == b"delete" and len(parts) > 1:
+                    resp = b"DELETED\r\n" if store.delete(ip, parts[1], now) else b"NOT_FOUND\r\n"
+                elif cmd in (b"incr", b"decr") and len(parts) > 2:
+                    if parts[2].isdigit():
+                        resp = store.incr(ip, parts[1], int(parts[2]), cmd == b"decr", now) + b"\r\n"
+                    else:
+                        resp = b"CLIENT_ERROR invalid numeric delta argument\r\n"
+                elif cmd == b"touch" and len(parts) > 2 and parts[2].lstrip(b"-").isdigit():
+                    touched = store.touch(ip, parts[1], int(parts[2]), now)
+                    resp = b"TOUCHED\r\n" if touched else b"NOT_FOUND\r\n"
+                elif cmd == b"flush_all":
+                    store.flush(ip)
+                    resp = b"OK\r\n"
+                elif cmd == b"stats":
+                    resp = self._stats(ip, version, now) if len(parts) == 1 else b"END\r\n"
+                elif cmd == b"version":
                     resp = f"VERSION {version}\r\n".encode()
+                elif cmd == b"verbosity":
+                    resp = b"OK\r\n"
+                elif cmd == b"quit":
+                    break
                 else:
                     resp = b"ERROR\r\n"
-                transcript.append((time.time(), "server", resp))
+                if noreply:
+                    continue
+                await self.latency.pause()
+                transcript.add("server", resp)
                 writer.write(resp)
-                await writer.drain()
+                await limits.drain(writer)
 
-        except (ConnectionResetError, OSError):
+        except (asyncio.IncompleteReadError, SessionLimit, ConnectionResetError, OSError):
             pass
         finally:
-            if cmd_count:
-                payload = {
-                    "service": "memcached",
-                    "ip": ip,
-                    "port": self.bind_port,
-                    "start_ts": start_ts,
-                    "end_ts": time.time(),
-                    "cmd_count": cmd_count,
-                    "details": [
-                        {
-                            "ts": ts,
-                            "direction": d,
-                            "data": data.decode("latin-1", errors="ignore").rstrip(),
-                        }
-                        for ts, d, data in transcript
-                    ],
-                }
-                await queue.put(payload)
+            self.curr_connections -= 1
+            if cmd_count or limits.tripped:
+                await self.log_session(ip, start_ts, cmd_count, transcript, limits)
             try:
                 writer.close()
                 await writer.wait_closed()
@@ -3,12 +3,16 @@ import time
 import random
 import asyncio
 import struct
-from .base import BaseEmulator
-from logger import queue
+from .base import BaseEmulator, SessionLimit
+from .framing import FrameReader, FramingError, parse_mysql_login
 
 def _peer_ip(writer):
     return writer.get_extra_info("peername")[0]
 
+# NOTE: Protocol 4.1 with plugin auth and no SSL, so clients send user, schema and plugin in the clear.
+SERVER_CAPABILITIES = 0x81FFF7FF
+AUTH_PLUGIN = b"mysql_native_password"
+
 def build_handshake(ver, cid):
     p = bytearray()
     p.append(0x0A)
@@ -16,73 +20,86 @@ def build_handshake(ver, cid):
     p.extend(struct.pack("<I", cid))
     p.extend(b"abcdefgh")
     p.append(0)
-    p.extend(struct.pack("<H", 2))
+    p.extend(struct.pack("<H", SERVER_CAPABILITIES & 0xFFFF))
     p.append(0x21)
     p.extend(struct.pack("<H", 2))
-    p.extend(struct.pack("<H", 0))
-    p.append(0)
+    p.extend(struct.pack("<H", SERVER_CAPABILITIES >> 16))
+    p.append(21)
     p.extend(b"\x00" * 10)
-    p.extend(b"ijklmnopqrstuvwx")
+    p.extend(b"ijklmnopqrst\x00")
+    p.extend(AUTH_PLUGIN + b"\x00")
     hdr = struct.pack("<I", len(p))[:3] + b"\x00"
     return hdr + p
 
 
-def make_error(msg):
+def make_error(msg, seq=2):
     payload = b"\xff" + struct.pack("<H", 1045) + b"#28000" + msg.encode()
-    hdr = struct.pack("<I", len(payload))[:3] + b"\x02"
+    hdr = struct.pack("<I", len(payload))[:3] + bytes([seq & 0xFF])
     return hdr + payload
 
 
 class MySQLEmulator(BaseEmulator):
+    service = "mysql"
+
     def __init__(self, bind_ip=None, bind_port=None, config=None):
         super().__init__(bind_ip, bind_port, config)
 
+        self.VERSIONS = ["5.7.38", "8.0.29", "10.3.34-MariaDB"]
+
+    def build_personas(self, host):
+        # NOTE: The connection id sits after the 4-byte header, protocol byte and NUL-terminated version.
+        return [
+            {"handshake": build_handshake(ver, 0), "cid_at": 4 + 1 + len(ver) + 1}
+            for ver in self.VERSIONS
+        ]
+
     async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         ip = _peer_ip(writer)
         start_ts = time.time()
-        transcript = []
+        transcript = self.new_transcript()
+        limits = self.new_limits()
         cmd_count = 0
-        ver = random.choice(["5.7.38", "8.0.29", "10.3.34-MariaDB"])
-        cid = random.randint(1000, 9999)
-        hs = build_handshake(ver, cid)
-
-        async def jitter():
-            await asyncio.sleep(random.uniform(0.05, 0.15))
+        fields = None
+        persona = self.personas.pick(ip)
+        hs = bytearray(persona["handshake"])
+        struct.pack_into("<I", hs, persona["cid_at"], random.randint(1000, 9999))
+        frames = FrameReader(reader, limits)
 
         try:
-            transcript.append((time.time(), "server", hs))
-            await jitter()
+            transcript.add("server", hs)
+            await self.latency.pause()
             writer.write(hs)
-            await writer.drain()
-            data = await reader.read(4096)
-            if data:
+            await limits.drain(writer)
+            packet = await frames.mysql_packet()
+            if packet:
+                seq, frame, payload = packet
                 ts = time.time()
-                transcript.append((ts, "client", data))
+                transcript.add("client", frame, ts)
+                cmd_count += 1
+                try:
+                    fields = parse_mysql_login(payload)
+                except FramingError:
+                    fields = {}
+                if not fields.get("ssl"):
+                    err = make_error(
+                        f"Access denied for user '{fields.get('user', '')}'@'{ip}' "
+                        f"(using password: {'YES' if fields.get('password', True) else 'NO'})",
+                        seq + 1,
+                    )
+                    transcript.add("server", err)
+                    await self.latency.pause()
+                    writer.write(err)
+                    await limits.drain(writer)
+        except (asyncio.IncompleteReadError, FramingError):
+            # NOTE: Not MySQL or cut short, keep what was sent as is.
+            if frames.buffered:
+                transcript.add("client", frames.peek(frames.buffered))
                 cmd_count += 1
-                err = make_error(
-                    "Access denied for user ''@'%' (using password: YES)"
-                )  # TODO: Should return the username and host correctly to avoid detection.
-                transcript.append((time.time(), "server", err))
-                await jitter()
-                writer.write(err)
-                await writer.drain()
-        except (ConnectionResetError, OSError):
+        except (SessionLimit, ConnectionResetError, OSError):
             pass
         finally:
-            if cmd_count:
-                payload = {
-                    "service": "mysql",
-                    "ip": ip,
-                    "port": self.bind_port,
-                    "start_ts": start_ts,
-                    "end_ts": time.time(),
-                    "cmd_count": cmd_count,
-                    "details": [
-                        {"ts": ts, "direction": d, "data": data.hex()}
-                        for ts, d, data in transcript
-                    ],
-                }
-                await queue.put(payload)
+            if cmd_count or limits.tripped:
+                await self.log_session(ip, start_ts, cmd_count, transcript, limits, fields)
             try:
                 writer.close()
                 await writer.wait_closed()
@@ -0,0 +1,119 @@
+# emulators/persona.py
+import asyncio
+import platform
+import random
+import socket
+import zlib
+
+from collections import OrderedDict
+
+DEFAULT_REFRESH_INTERVAL = 3600
+DEFAULT_STICKY_SIZE = 65536
+
+
+class HostIdentity:
+    """What the honeypot host looks like: name and platform details."""
+
+    __slots__ = ("fqdn", "os_name", "os_release", "arch", "bits")
+
+    def __init__(self, fqdn: str, os_name: str, os_release: str, arch: str, bits: str):
+        self.fqdn = fqdn
+        self.os_name = os_name
+        self.os_release = os_release
+        self.arch = arch
+        self.bits = bits
+
+    @classmethod
+    def probe(cls):
+        """Looks the host up. Blocking (getfqdn may hit DNS), so run it off the loop."""
+        return cls(
+            socket.getfqdn(),
+            platform.system(),
+            platform.release(),
+            platform.machine(),
+            "64" if platform.architecture()[0].startswith("64") else "32",
+        )
+
+
+_identity = None
+_generation = 0
+_refresher = None
+
+
+def identity() -> HostIdentity:
+    if _identity is None:
+        set_identity(HostIdentity.probe())
+    return _identity
+
+
+def set_identity(ident: HostIdentity):
+    global _identity, _generation
+    _identity = ident
+    _generation += 1
+
+
+async def _refresh_loop(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            set_identity(await asyncio.to_thread(HostIdentity.probe))
+        except Exception as e:
+            print(f"[WARN] Failed to refresh host identity: {e!r}")
+
+
+async def start(cfg: dict):
+    """Probes the host once and refreshes it every refresh_interval seconds."""
+    global _refresher
+    if _refresher is not None:
+        return
+    set_identity(await asyncio.to_thread(HostIdentity.probe))
+    interval = cfg.get("refresh_interval", DEFAULT_REFRESH_INTERVAL)
+    if interval:
+        _refresher = asyncio.create_task(_refresh_loop(interval))
+
+
+class PersonaSet:
+    """Pre-built variants of one emulator's persona, picked per connection.
+
+    `build(identity)` returns the variants with their banners and handshakes
+    already encoded; they are rebuilt only when the host identity changes.
+    With `sticky_size`, each source IP keeps the variant it was first shown
+    (tracked in an LRU of that many IPs), so a returning scanner sees the
+    same server. Off by default.
+    """
+
+    def __init__(self, build, sticky_size: int = 0):
+        self.build = build
+        self.sticky_size = sticky_size
+        self._sticky = OrderedDict()
+        self._variants = None
+        self._generation = None
+
+    @property
+    def variants(self) -> list:
+        if self._generation != _generation or self._variants is None:
+            self._variants = self.build(identity())
+            self._generation = _generation
+        return self._variants
+
+    def pick(self, ip: str, remember: bool = True):
+        """Returns the variant to show `ip`.
+
+        Pass remember=False for sources that can be spoofed (UDP): they get
+        the variant a remembered IP was shown, or a fixed one per IP, but are
+        never added to the LRU, so a flood of them can't evict real clients.
+        """
+        variants = self.variants
+        if not self.sticky_size:
+            return random.choice(variants)
+        index = self._sticky.get(ip)
+        if index is None:
+            if not remember:
+                # NOTE: crc32, unlike hash(), is the same in every worker and across restarts.
+                return variants[zlib.crc32(ip.encode()) % len(variants)]
+            index = self._sticky[ip] = random.randrange(len(variants))
+            if len(self._sticky) > self.sticky_size:
+                self._sticky.popitem(last=False)
+        elif remember:
+            self._sticky.move_to_end(ip)
+        return variants[index % len(variants)]
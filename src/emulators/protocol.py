@@ -0,0 +1,237 @@
+# emulators/protocol.py
+import asyncio
+import time
+
+from logger import enqueue, enqueue_nowait
+
+from .base import TRIP_REASONS
+from .framing import FramingError
+
+RECV_SIZE = 65536
+DEFAULT_MAX_PARTIAL = 4096
+
+# NOTE: One receive buffer for every protocol-mode connection in the process. buffer_updated()
+# runs right after the kernel fills it, and whatever a session keeps is copied out first.
+_RECV = memoryview(bytearray(RECV_SIZE))
+
+# NOTE: Sessions whose record had to wait for room in a "block" policy log queue.
+_waiting = set()
+
+
+class ProtocolSession(asyncio.BufferedProtocol):
+    """Callback-driven session for emulators running with `mode: "protocol"`.
+
+    Stream mode gives each connection a StreamReader, a StreamWriter, a
+    handler coroutine and its own read buffer. Here a connection is one small
+    object: the kernel reads into the shared _RECV buffer, input is split
+    into frames by `sizer` (a framing sizer, None for raw reads) and handed
+    to received() as bytes. Frames split across reads are kept in `partial`
+    until they complete. Input that can't be framed, or a frame that would
+    keep more than `max_partial` bytes waiting, switches the session to raw
+    reads, so a client dripping one huge frame can't pin more than that.
+
+    Replies go out through reply(), delayed by the latency model and written
+    in order, coalescing whatever queued up during the delay. One loop timer
+    per session enforces idle_timeout and max_session. Sessions are logged
+    from connection_lost().
+
+    Subclasses implement greet() and received(), and set `max_partial` to
+    the largest frame their protocol sends in practice.
+    """
+
+    max_partial = DEFAULT_MAX_PARTIAL
+
+    __slots__ = (
+        "emulator",
+        "admission",
+        "loop",
+        "transport",
+        "ip",
+        "start_ts",
+        "transcript",
+        "cmd_count",
+        "fields",
+        "reason",
+        "sizer",
+        "partial",
+        "outbox",
+        "closing",
+        "last_rx",
+        "deadline",
+        "timer",
+    )
+
+    def __init__(self, emulator, admission=None):
+        self.emulator = emulator
+        self.admission = admission
+        self.transport = None
+        self.transcript = None
+        self.cmd_count = 0
+        self.fields = None
+        self.reason = "closed"
+        self.sizer = None
+        self.partial = None
+        self.outbox = None
+        self.closing = False
+        self.timer = None
+
+    def connection_made(self, transport):
+        self.loop = asyncio.get_running_loop()
+        peer = transport.get_extra_info("peername")
+        self.ip = peer[0] if peer else "?"
+        if self.admission is not None:
+            reason = self.admission.admit(self.ip)
+            if reason:
+                self.admission._rejected(reason)
+                self.admission.turn_away(transport)
+                return
+        self.transport = transport
+        self.start_ts = time.time()
+        self.transcript = self.emulator.new_transcript()
+        now = self.loop.time()
+        self.last_rx = now
+        max_session = self.emulator.max_session
+        self.deadline = now + max_session if max_session else None
+        self._arm(now)
+        self.greet()
+
+    def greet(self):
+        """Starts the session, e.g. by sending the banner and setting `sizer`."""
+
+    def received(self, frame: bytes):
+        raise NotImplementedError
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return _RECV
+
+    def buffer_updated(self, nbytes: int):
+        if self.transport is None or self.closing:
+            return
+        self.last_rx = self.loop.time()
+        if self.partial is not None:
+            self.partial += _RECV[:nbytes]
+            buf, end = self.partial, len(self.partial)
+        else:
+            buf, end = _RECV, nbytes
+        pos = 0
+        while pos < end and not self.closing:
+            size = end - pos
+            if self.sizer is not None:
+                try:
+                    size = self.sizer(buf, pos, end)
+                except FramingError:
+                    self.sizer = None
+                    continue
+                if size is None or size > end - pos:
+                    if max(end - pos, size or 0) > self.max_partial:
+                        self.sizer = None
+                        continue
+                    break
+            frame = bytes(buf[pos : pos + size])
+            pos += size
+            self.received(frame)
+        self.partial = bytearray(buf[pos:end]) if pos < end and not self.closing else None
+
+    def eof_received(self) -> bool:
+        if self.partial:
+            # NOTE: A frame cut short by EOF is still recorded, as stream mode does.
+            self.record(bytes(self.partial))
+            self.partial = None
+        self.close()
+        return True
+
+    def record(self, frame: bytes):
+        self.transcript.add("client", frame)
+        self.cmd_count += 1
+
+    def send(self, data: bytes):
+        """Writes `data` now, or after the replies already waiting on a delay."""
+        if self.outbox is not None:
+            self.outbox.append(data)
+            return
+        self.transcript.add("server", data)
+        self.transport.write(data)
+
+    def reply(self, data: bytes):
+        """Writes `data` after a response delay."""
+        if self.outbox is not None:
+            self.outbox.append(data)
+            return
+        self.outbox = [data]
+        self.emulator.latency.later(self._flush)
+
+    def _flush(self):
+        data = b"".join(self.outbox)
+        self.outbox = None
+        transport = self.transport
+        if transport is None or transport.is_closing():
+            return
+        if data:
+            self.transcript.add("server", data)
+            transport.write(data)
+        if self.closing:
+            transport.close()
+
+    def close(self, reason: str = None):
+        """Closes the connection once the replies still waiting on a delay are written."""
+        if reason:
+            self.reason = reason
+        self.closing = True
+        if self.outbox is None and self.transport is not None:
+            self.transport.close()
+
+    def _arm(self, now: float):
+        idle = self.emulator.idle_timeout
+        due = self.last_rx + idle if idle else None
+        if self.deadline is not None and (due is None or self.deadline < due):
+            due = self.deadline
+        if due is not None:
+            self.timer = self.loop.call_at(max(due, now), self._check)
+
+    def _check(self):
+        # NOTE: Reads only move last_rx; the timer finds out about them when it fires and re-arms.
+        self.timer = None
+        if self.transport is None:
+            return
+        now = self.loop.time()
+        idle = self.emulator.idle_timeout
+        if self.deadline is not None and now >= self.deadline:
+            self.reason = "session_timeout"
+        elif idle and now - self.last_rx >= idle:
+            self.reason = "idle_timeout"
+        else:
+            self._arm(now)
+            return
+        self.transport.abort()
+
+    def pause_writing(self):
+        # NOTE: A peer that doesn't read its replies isn't read either, so its backlog can't grow.
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+    def should_log(self) -> bool:
+        return bool(self.cmd_count) or self.reason in TRIP_REASONS
+
+    def session_fields(self) -> dict:
+        return self.fields
+
+    def connection_lost(self, exc):
+        if self.transport is None:
+            return
+        self.transport = None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.admission is not None:
+            self.admission.release(self.ip)
+        if self.should_log():
+            record = self.emulator.session_record(
+                self.ip, self.start_ts, self.cmd_count, self.transcript, self.reason, self.session_fields()
+            )
+            if not enqueue_nowait(record):
+                task = self.loop.create_task(enqueue(record))
+                _waiting.add(task)
+                task.add_done_callback(_waiting.discard)
+        self.transcript = None
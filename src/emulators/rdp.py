@@ -1,11 +1,40 @@
 # emulators/rdp.py
 import asyncio
 import time
-import random
-from .base import BaseEmulator
-from logger import queue
+from .base import BaseEmulator, SessionLimit
+from .framing import FrameReader, FramingError, parse_x224_request, tpkt_size
+from .protocol import ProtocolSession
+
+
+class RDPProtocol(ProtocolSession):
+    """Protocol-mode RDP session: answers the X.224 Connection Request, then records PDUs."""
+
+    __slots__ = ()
+    # NOTE: Connection Requests and MCS PDUs are a few hundred bytes; bulk data after negotiation is TLS, kept raw.
+    max_partial = 2048
+
+    def greet(self):
+        self.sizer = tpkt_size
+
+    def received(self, frame: bytes):
+        self.record(frame)
+        if self.cmd_count > 1:
+            return
+        if frame[0] == 0x03:
+            try:
+                self.fields = parse_x224_request(frame[4:])
+            except FramingError:
+                pass
+        self.reply(self.emulator.personas.pick(self.ip))
+
+    def should_log(self) -> bool:
+        return True
+
 
 class RDPEmulator(BaseEmulator):
+    service = "rdp"
+    protocol = RDPProtocol
+
     def __init__(self, bind_ip=None, bind_port=None, config=None):
         super().__init__(bind_ip, bind_port, config)
 
@@ -15,50 +44,69 @@ class RDPEmulator(BaseEmulator):
             b"\x03\x00\x00\x0d\x02\xf0\x80\x68\x00\x01\x03\x00\x00",
         ]
 
+    def build_personas(self, host):
+        return self.PROTOCOL_BANNERS
+
+    def session_record(self, ip, start_ts, cmd_count, transcript, reason, fields=None) -> dict:
+        record = super().session_record(ip, start_ts, cmd_count, transcript, reason, fields)
+        if not cmd_count:
+            # NOTE: Most RDP sessions are connect-and-close scans. They are logged as a bare summary row,
+            # without a transcript to pack and store.
+            record["details"] = None
+        return record
+
     async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         ip = writer.get_extra_info("peername")[0]
         start_ts = time.time()
-        transcript = []
+        transcript = self.new_transcript()
+        limits = self.new_limits()
         cmd_count = 0
-
-        async def jitter():
-            await asyncio.sleep(random.uniform(0.05, 0.15))
+        fields = None
+        frames = FrameReader(reader, limits)
+        # NOTE: Anything that isn't TPKT (e.g. the TLS handshake after negotiation) is kept as raw reads.
+        framed = True
 
         try:
-            banner = random.choice(self.PROTOCOL_BANNERS)
-            writer.write(banner)
-            await writer.drain()
-            transcript.append((time.time(), "server", banner))
-            await jitter()
-
             while True:
-                data = await reader.read(1024)
-                if not data:
-                    break
-                transcript.append((time.time(), "client", data))
+                if framed:
+                    try:
+                        pdu = await frames.tpkt()
+                    except FramingError:
+                        framed = False
+                        continue
+                    if pdu is None:
+                        break
+                    frame, payload = pdu
+                else:
+                    frame, payload = await frames.chunk(), None
+                    if frame is None:
+                        break
+                transcript.add("client", frame)
                 cmd_count += 1
-                await jitter()
 
-        except (asyncio.IncompleteReadError, ConnectionResetError, OSError):
+                if cmd_count == 1:
+                    # NOTE: The client speaks first with an X.224 Connection Request, answered with the persona's Confirm.
+                    if payload is not None:
+                        try:
+                            fields = parse_x224_request(payload)
+                        except FramingError:
+                            pass
+                    banner = self.personas.pick(ip)
+                    await self.latency.pause()
+                    writer.write(banner)
+                    await limits.drain(writer)
+                    transcript.add("server", banner)
+                else:
+                    await self.latency.pause()
+
+        except asyncio.IncompleteReadError:
+            if frames.buffered:
+                transcript.add("client", frames.peek(frames.buffered))
+                cmd_count += 1
+        except (SessionLimit, ConnectionResetError, OSError):
             pass
         finally:
-            payload = {
-                "service": "rdp",
-                "ip": ip,
-                "port": self.bind_port,
-                "start_ts": start_ts,
-                "end_ts": time.time(),
-                "cmd_count": cmd_count,
-                "details": [
-                    {
-                        "ts": ts,
-                        "direction": d,
-                        "data": data.decode("latin-1", errors="ignore"),
-                    }
-                    for ts, d, data in transcript
-                ],
-            }
-            await queue.put(payload)
+            await self.log_session(ip, start_ts, cmd_count, transcript, limits, fields)
             try:
                 writer.close()
                 await writer.wait_closed()
@@ -1,16 +1,118 @@
 # emulators/redis.py
 import time
-import random
 import asyncio
-import socket
-import platform
-from .base import BaseEmulator
-from logger import queue
+from .base import BaseEmulator, SessionLimit
 
 def _peer_ip(writer):
     return writer.get_extra_info("peername")[0]
 
+DEFAULT_MAX_REQUEST = 8 * 1024 * 1024
+MAX_MULTIBULK = 1024 * 1024
+READ_SIZE = 65536
+
+
+class RespError(Exception):
+    """Input a real Redis server would answer with a protocol error."""
+
+
+class RespParser:
+    """Incremental parser for Redis requests.
+
+    feed() appends whatever was read and commands() returns every complete
+    command in the buffer as (argv, raw), keeping a trailing partial command
+    for the next read. Both RESP multi-bulk arrays and inline commands are
+    understood; `raw` is the command's exact bytes on the wire. Pending input
+    is capped at `max_request` bytes and inline commands at `max_inline`.
+
+    Input a real server rejects stops parsing: the commands before it are
+    still returned, the RespError is kept in `error` and the offending bytes
+    are left in `buf`.
+    """
+
+    __slots__ = ("buf", "max_inline", "max_request", "error")
+
+    def __init__(self, max_inline: int = 65536, max_request: int = DEFAULT_MAX_REQUEST):
+        self.buf = bytearray()
+        self.max_inline = max_inline
+        self.max_request = max_request
+        self.error = None
+
+    def feed(self, data: bytes):
+        self.buf += data
+
+    def commands(self) -> list:
+        buf = self.buf
+        out = []
+        pos = 0
+        try:
+            while pos < len(buf):
+                if buf[pos] == 0x2A:  # "*"
+                    argv, end = self._multibulk(buf, pos)
+                    if argv is None:
+                        break
+                else:
+                    eol = buf.find(b"\n", pos)
+                    if eol < 0:
+                        if len(buf) - pos > self.max_inline:
+                            raise RespError("too big inline request")
+                        break
+                    end = eol + 1
+                    argv = bytes(buf[pos:eol]).split()
+                if argv:
+                    out.append((argv, bytes(buf[pos:end])))
+                pos = end
+        except RespError as e:
+            self.error = e
+        del buf[:pos]
+        if self.error is None and len(buf) > self.max_request:
+            self.error = RespError("too big request")
+        return out
+
+    @staticmethod
+    def _int(buf: bytearray, start: int, end: int, what: str) -> int:
+        try:
+            return int(buf[start:end])
+        except ValueError:
+            raise RespError(f"invalid {what}") from None
+
+    def _multibulk(self, buf: bytearray, pos: int) -> tuple:
+        """Parses the array at `pos`. Returns (argv, end), or (None, pos) if it is incomplete."""
+        eol = buf.find(b"\r\n", pos)
+        if eol < 0:
+            return None, pos
+        count = self._int(buf, pos + 1, eol, "multibulk length")
+        if count > MAX_MULTIBULK:
+            raise RespError("invalid multibulk length")
+        p = eol + 2
+        argv = []
+        for _ in range(count):
+            if p >= len(buf):
+                return None, pos
+            if buf[p] != 0x24:  # "$"
+                raise RespError(f"expected '$', got '{chr(buf[p])}'")
+            eol = buf.find(b"\r\n", p)
+            if eol < 0:
+                return None, pos
+            size = self._int(buf, p + 1, eol, "bulk length")
+            if size < 0 or size > self.max_request:
+                raise RespError("invalid bulk length")
+            start = eol + 2
+            p = start + size + 2
+            if p > len(buf):
+                return None, pos
+            if buf[p - 2 : p] != b"\r\n":
+                raise RespError("invalid bulk terminator")
+            argv.append(bytes(buf[start : start + size]))
+        return argv, p
+
+
+def _bulk(value: bytes) -> bytes:
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
 class RedisEmulator(BaseEmulator):
+    service = "redis"
+
     def __init__(self, bind_ip=None, bind_port=None, config=None):
         super().__init__(bind_ip, bind_port, config)
 
@@ -19,77 +121,126 @@ redis_version:{version}
 os:{os_name} {os_release} {arch}
 arch_bits:{bits}
 uptime_in_seconds:{uptime}"""
+        self.VERSIONS = ["6.0.10", "6.2.6", "7.0.5", "5.0.14"]
+        self.max_request = self.emu_config.get("max_request", DEFAULT_MAX_REQUEST)
+
+        self.SIMPLE_REPLIES = {
+            b"SET": b"+OK\r\n",
+            b"SELECT": b"+OK\r\n",
+            b"SLAVEOF": b"+OK\r\n",
+            b"REPLICAOF": b"+OK\r\n",
+            b"FLUSHALL": b"+OK\r\n",
+            b"FLUSHDB": b"+OK\r\n",
+            b"SAVE": b"+OK\r\n",
+            b"BGSAVE": b"+Background saving started\r\n",
+            b"CLIENT": b"+OK\r\n",
+            b"GET": b"$-1\r\n",
+            b"DEL": b":0\r\n",
+            b"EXISTS": b":0\r\n",
+            b"DBSIZE": b":0\r\n",
+            b"KEYS": b"*0\r\n",
+            b"SCAN": b"*2\r\n$1\r\n0\r\n*0\r\n",
+            b"COMMAND": b"*0\r\n",
+            b"AUTH": b"-ERR Client sent AUTH, but no password is set\r\n",
+            b"MODULE": b"-ERR Error loading the extension. Please check the server logs.\r\n",
+            b"QUIT": b"+OK\r\n",
+        }
+
+    def build_personas(self, host):
+        return [
+            {
+                "banner": f"+OK {host.fqdn} Redis {ver}\r\n".encode(),
+                # NOTE: Uptime is left empty, INFO appends the live value.
+                "info": self.INFO_TEMPLATE.format(
+                    version=ver,
+                    os_name=host.os_name,
+                    os_release=host.os_release,
+                    arch=host.arch,
+                    bits=host.bits,
+                    uptime="",
+                ).encode(),
+            }
+            for ver in self.VERSIONS
+        ]
+
+    def reply(self, argv: list, persona: dict, uptime: int) -> bytes:
+        cmd = argv[0].upper()
+        if cmd == b"PING":
+            return _bulk(argv[1]) if len(argv) > 1 else b"+PONG\r\n"
+        if cmd == b"ECHO" and len(argv) > 1:
+            return _bulk(argv[1])
+        if cmd == b"INFO":
+            return _bulk(persona["info"] + b"%d" % uptime)
+        if cmd == b"CONFIG" and len(argv) > 2:
+            sub = argv[1].upper()
+            if sub == b"SET":
+                return b"+OK\r\n"
+            if sub == b"GET":
+                return b"*2\r\n" + _bulk(argv[2]) + _bulk(b"")
+        reply = self.SIMPLE_REPLIES.get(cmd)
+        if reply is not None:
+            return reply
+        nm = argv[0].decode(errors="ignore")
+        return f"-ERR unknown command '{nm}'\r\n".encode()
 
     async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         ip = _peer_ip(writer)
         start_ts = time.time()
-        transcript = []
+        transcript = self.new_transcript()
+        limits = self.new_limits()
         cmd_count = 0
-        ver = random.choice(["6.0.10", "6.2.6", "7.0.5", "5.0.14"])
-        osn, osr, arch = platform.system(), platform.release(), platform.machine()
-        bits = "64" if platform.architecture()[0].startswith("64") else "32"
-
-        async def jitter():
-            await asyncio.sleep(random.uniform(0.05, 0.15))
+        persona = self.personas.pick(ip)
+        parser = RespParser(self.max_line, self.max_request)
 
         try:
-            bnr = f"+OK {socket.getfqdn()} Redis {ver}\r\n".encode()
-            transcript.append((time.time(), "server", bnr))
-            await jitter()
+            bnr = persona["banner"]
+            transcript.add("server", bnr)
+            await self.latency.pause()
             writer.write(bnr)
-            await writer.drain()
+            await limits.drain(writer)
             while True:
-                data = await reader.readline()
+                data = await limits.read(reader, READ_SIZE)
                 if not data:
                     break
                 ts = time.time()
-                transcript.append((ts, "client", data))
-                cmd_count += 1
-                await jitter()
-                cmd = data.strip().split()[0].upper() if data.strip() else b""
-                if cmd == b"PING":
-                    resp = b"+PONG\r\n"
-                elif cmd == b"ECHO" and len(data.split()) > 1:
-                    arg = data.strip().split(b" ", 1)[1]
-                    resp = b"$%d\r\n%s\r\n" % (len(arg), arg)
-                elif cmd == b"INFO":
-                    up = int(ts - start_ts)
-                    info = self.INFO_TEMPLATE.format(
-                        version=ver,
-                        os_name=osn,
-                        os_release=osr,
-                        arch=arch,
-                        bits=bits,
-                        uptime=up,
-                    ).encode()
-                    resp = b"$%d\r\n%s\r\n" % (len(info), info)
-                else:
-                    nm = cmd.decode(errors="ignore")
-                    resp = f"-ERR unknown command '{nm}'\r\n".encode()
-                transcript.append((time.time(), "server", resp))
+                parser.feed(data)
+                commands = parser.commands()
+                if not commands and parser.error is None:
+                    continue
+
+                # NOTE: One frame per command keeps the transcript decodable into argv lists.
+                for _, raw in commands:
+                    transcript.add("client", raw, ts)
+                cmd_count += len(commands)
+                quit = False
+                replies = []
+                for argv, _ in commands:
+                    replies.append(self.reply(argv, persona, int(ts - start_ts)))
+                    if argv[0].upper() == b"QUIT":
+                        quit = True
+                        break
+                if parser.error is not None and not quit:
+                    # NOTE: Like Redis, the commands before the bad input are answered first.
+                    if parser.buf:
+                        transcript.add("client", bytes(parser.buf), ts)
+                        cmd_count += 1
+                    replies.append(f"-ERR Protocol error: {parser.error}\r\n".encode())
+                    limits.reason = "protocol_error"
+                    quit = True
+
+                # NOTE: A pipelined batch is answered after one delay, with one write.
+                await self.latency.pause()
+                resp = b"".join(replies)
+                transcript.add("server", resp)
                 writer.write(resp)
-                await writer.drain()
-        except (ConnectionResetError, OSError):
+                await limits.drain(writer)
+                if quit:
+                    break
+        except (SessionLimit, ConnectionResetError, OSError):
             pass
         finally:
-            if cmd_count:
-                payload = {
-                    "service": "redis",
-                    "ip": ip,
-                    "port": self.bind_port,
-                    "start_ts": start_ts,
-                    "end_ts": time.time(),
-                    "cmd_count": cmd_count,
-                    "details": [
-                        {
-                            "ts": ts,
-                            "direction": d,
-                            "data": dta.decode("latin-1", errors="ignore"),
-                        }
-                        for ts, d, dta in transcript
-                    ],
-                }
-                await queue.put(payload)
+            if cmd_count or limits.tripped:
+                await self.log_session(ip, start_ts, cmd_count, transcript, limits)
             try:
                 writer.close()
                 await writer.wait_closed()
@@ -0,0 +1,183 @@
+# emulators/shell.py
+import re
+
+# NOTE: Output templates, formatted with the host identity when a persona is built.
+RESPONSES = {
+    "uname": "Linux",
+    "uname -s": "Linux",
+    "uname -a": "Linux {hostname} {release} #1 SMP {build} {arch} GNU/Linux",
+    "uname -r": "{release}",
+    "uname -m": "{arch}",
+    "uname -n": "{hostname}",
+    "arch": "{arch}",
+    "hostname": "{hostname}",
+    "whoami": "root",
+    "id": "uid=0(root) gid=0(root) groups=0(root)",
+    "pwd": "/root",
+    "nproc": "{cpus}",
+    "cat /proc/cpuinfo": "{cpuinfo}",
+    "cat /proc/meminfo": (
+        "MemTotal:        2041328 kB\nMemFree:          612904 kB\n"
+        "MemAvailable:    1489120 kB\nBuffers:           86212 kB\nCached:           801344 kB"
+    ),
+    "cat /proc/version": "Linux version {release} (buildd@lcy02-amd64-001) #1 SMP {build}",
+    "cat /etc/issue": "{issue} \\n \\l\n",
+    "free": (
+        "              total        used        free      shared  buff/cache   available\n"
+        "Mem:        2041328      551868      612904        1140      876556     1489120\n"
+        "Swap:       1048572           0     1048572"
+    ),
+    "free -m": (
+        "              total        used        free      shared  buff/cache   available\n"
+        "Mem:           1993         538         598           1         856        1454\n"
+        "Swap:          1023           0        1023"
+    ),
+    "uptime": " 10:14:02 up 41 days,  3:12,  1 user,  load average: 0.08, 0.03, 0.01",
+    "w": " 10:14:02 up 41 days,  3:12,  1 user,  load average: 0.08, 0.03, 0.01",
+    "ls": "bin   dev  home  lib64  mnt  proc  run   srv  tmp  var\nboot  etc  lib   media  opt  root  sbin  sys  usr",
+    "ls /": "bin   dev  home  lib64  mnt  proc  run   srv  tmp  var\nboot  etc  lib   media  opt  root  sbin  sys  usr",
+    "ps": "  PID TTY          TIME CMD\n 1342 pts/0    00:00:00 sh\n 1377 pts/0    00:00:00 ps",
+    "busybox": (
+        "BusyBox v1.30.1 (Ubuntu 1:1.30.1-4ubuntu6) multi-call binary.\n"
+        "BusyBox is copyrighted by many authors between 1998-2015.\n"
+        "Licensed under GPLv2. See source distribution for detailed\ncopyright notices.\n\n"
+        "Usage: busybox [function [arguments]...]"
+    ),
+}
+
+# Commands that succeed without output.
+SILENT = {
+    "enable", "system", "shell", "sh", "bash", "linuxshell", "cd", "chmod", "chown", "cp", "mv",
+    "rm", "mkdir", "touch", "export", "kill", "killall", "pkill", "sleep", "true", "history",
+    "ulimit", "unset", "sync", "dd", "iptables", "service", "systemctl", "crontab",
+}
+
+# Applets the fake busybox answers for; anything else is "applet not found".
+APPLETS = {cmd.split()[0] for cmd in RESPONSES} | SILENT | {"echo", "cat", "wget", "tftp", "ftpget", "curl"}
+
+CPU_MODELS = {
+    "x86_64": "Intel(R) Xeon(R) CPU E5-2680 v4 @ 2.40GHz",
+    "aarch64": "ARMv8 Processor rev 4 (v8l)",
+}
+
+_HEX_ESCAPE = re.compile(rb"\\x([0-9a-fA-F]{2})")
+_SEPARATORS = re.compile(r"\s*(?:;|&&|\|\|)\s*")
+
+
+def _cpuinfo(arch: str, cpus: int) -> str:
+    if arch in ("aarch64", "arm64"):
+        return "\n\n".join(
+            f"processor\t: {i}\nmodel name\t: {CPU_MODELS['aarch64']}\nBogoMIPS\t: 38.40\n"
+            f"Features\t: fp asimd evtstrm crc32 cpuid\nCPU implementer\t: 0x41\nCPU part\t: 0xd03"
+            for i in range(cpus)
+        )
+    return "\n\n".join(
+        f"processor\t: {i}\nvendor_id\t: GenuineIntel\ncpu family\t: 6\nmodel name\t: {CPU_MODELS['x86_64']}\n"
+        f"cpu MHz\t\t: 2399.998\ncache size\t: 35840 KB\ncpu cores\t: {cpus}\nbogomips\t: 4799.99"
+        for i in range(cpus)
+    )
+
+
+def build_index(host, issue: str, cpus: int = 4) -> dict:
+    """Renders RESPONSES for one host and persona into ready-to-send CRLF bytes."""
+    values = {
+        "hostname": host.fqdn.split(".")[0],
+        "release": host.os_release,
+        "arch": host.arch,
+        "build": "Tue Mar 7 15:22:41 UTC 2023",
+        "cpus": cpus,
+        "cpuinfo": _cpuinfo(host.arch, cpus),
+        "issue": issue,
+    }
+    return {cmd: _crlf(text.format(**values)) for cmd, text in RESPONSES.items()}
+
+
+def _crlf(text: str) -> bytes:
+    return text.replace("\n", "\r\n").encode() + b"\r\n" if text else b""
+
+
+def _echo(args: list) -> bytes:
+    interpret = False
+    newline = True
+    while args and args[0].startswith("-") and set(args[0][1:]) <= set("neE") and len(args[0]) > 1:
+        interpret = interpret or "e" in args[0]
+        newline = newline and "n" not in args[0]
+        args = args[1:]
+    out = " ".join(a.strip("'\"") for a in args).encode(errors="ignore")
+    if interpret:
+        out = _HEX_ESCAPE.sub(lambda m: bytes([int(m.group(1), 16)]), out)
+        out = out.replace(b"\\n", b"\n").replace(b"\\t", b"\t")
+    out = out.replace(b"\n", b"\r\n")
+    return out + b"\r\n" if newline else out
+
+
+class FakeShell:
+    """Answers shell command lines from a pre-rendered response index.
+
+    A line is split on `;`, `&&` and `||` and each command is looked up as a
+    whole, then by program name. echo, busybox applets and the downloaders
+    (wget, curl, tftp, ftpget) are handled by small functions. Downloaders
+    never fetch anything; the URLs they were asked for are collected in
+    `downloads`.
+    """
+
+    __slots__ = ("index", "downloads")
+
+    def __init__(self, index: dict):
+        self.index = index
+        self.downloads = []
+
+    def run(self, line: str) -> tuple:
+        """Returns (output, exit) for one command line, exit being True when the shell should close."""
+        out = []
+        for cmd in _SEPARATORS.split(line.strip()):
+            if not cmd:
+                continue
+            # NOTE: Only the head of a pipeline answers; redirected output goes nowhere.
+            cmd = cmd.split("|", 1)[0].strip()
+            redirected = ">" in cmd
+            if redirected:
+                cmd = cmd.split(">", 1)[0].strip()
+            args = cmd.split()
+            if not args:
+                continue
+            if args[0] in ("exit", "logout", "quit"):
+                return b"".join(out), True
+            res = self.command(args)
+            if not redirected:
+                out.append(res)
+        return b"".join(out), False
+
+    def command(self, args: list) -> bytes:
+        prog = args[0].rsplit("/", 1)[-1]
+        if prog == "busybox" and len(args) > 1:
+            if args[1] not in APPLETS:
+                return b"%s: applet not found\r\n" % args[1].encode(errors="ignore")
+            return self.command(args[1:])
+        key = " ".join([prog] + args[1:])
+        if key in self.index:
+            return self.index[key]
+        if prog == "echo":
+            return _echo(args[1:])
+        if prog in ("wget", "curl", "tftp", "ftpget"):
+            return self._download(prog, args[1:])
+        if prog in self.index:
+            return self.index[prog]
+        if prog in SILENT:
+            return b""
+        if prog == "cat" and len(args) > 1:
+            return b"cat: can't open '%s': No such file or directory\r\n" % args[1].encode(errors="ignore")
+        return b"-sh: %s: not found\r\n" % prog.encode(errors="ignore")
+
+    def _download(self, prog: str, args: list) -> bytes:
+        target = next((a for a in args if not a.startswith("-")), "")
+        if len(self.downloads) < 100:
+            self.downloads.append(" ".join([prog] + args))
+        if prog == "tftp" or prog == "ftpget":
+            return b"%s: timeout\r\n" % prog.encode()
+        host = re.sub(r"^\w+://", "", target).split("/", 1)[0] or "localhost"
+        if prog == "curl":
+            return b"curl: (7) Failed to connect to %s port 80: Connection refused\r\n" % host.encode(errors="ignore")
+        return b"Connecting to %s (%s:80)\r\nwget: can't connect to remote host (%s): Connection refused\r\n" % (
+            (host.encode(errors="ignore"),) * 3
+        )
@@ -1,58 +1,85 @@
 # emulators/smtp.py
 import time
-import random
 import asyncio
-import socket
 from ssl import SSLContext, PROTOCOL_TLS_SERVER
-from .base import BaseEmulator
-from logger import queue
+from .base import BaseEmulator, SessionLimit
+from .artifacts import Upload, store
 
 def _peer_ip(writer):
     return writer.get_extra_info("peername")[0]
 
 TLS = SSLContext(PROTOCOL_TLS_SERVER)
+DEFAULT_MAX_MESSAGE = 10485760
+TOO_LARGE = b"552 5.3.4 Message size exceeds fixed maximum message size\r\n"
+# NOTE: Messages listed per session record; later ones are only counted.
+MAX_LOGGED_MESSAGES = 100
 
 class SMTPEmulator(BaseEmulator):
+    service = "smtp"
+
     def __init__(self, bind_ip=None, bind_port=None, config=None):
         super().__init__(bind_ip, bind_port, config)
 
+        self.VERSIONS = ["Postfix (Ubuntu)", "Exim 4.94", "Sendmail 8.16"]
+        self.max_message = self.emu_config.get("max_message", DEFAULT_MAX_MESSAGE)
+        self.artifacts = store(self.config.get("artifacts") or {})
+
+    def build_personas(self, host):
+        return [
+            {
+                "banner": f"220 {host.fqdn} ESMTP {version}\r\n".encode(),
+                "ehlo": (
+                    f"250-{host.fqdn}\r\n250-PIPELINING\r\n250-SIZE {self.max_message}\r\n"
+                    f"250-8BITMIME\r\n250-AUTH LOGIN PLAIN\r\n250-STARTTLS\r\n250 HELP\r\n"
+                ).encode(),
+                "helo": f"250 {host.fqdn}\r\n".encode(),
+            }
+            for version in self.VERSIONS
+        ]
+
+    def _size_ok(self, cmd: str) -> bool:
+        """Checks a MAIL FROM SIZE= declaration against the advertised limit."""
+        for param in cmd.split():
+            if param.startswith("SIZE="):
+                try:
+                    return int(param[5:]) <= self.max_message
+                except ValueError:
+                    return True
+        return True
+
     async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         ip = _peer_ip(writer)
         start_ts = time.time()
-        transcript = []
+        transcript = self.new_transcript()
+        limits = self.new_limits()
         cmd_count = 0
         tls_started = False
-        host = socket.getfqdn()
-        version = random.choice(["Postfix (Ubuntu)", "Exim 4.94", "Sendmail 8.16"])
-
-        async def jitter():
-            await asyncio.sleep(random.uniform(0.05, 0.15))
+        fields = {}
+        upload = None
+        persona = self.personas.pick(ip)
 
         try:
-            bnr = f"220 {host} ESMTP {version}\r\n".encode()
-            transcript.append((time.time(), "server", bnr))
+            bnr = persona["banner"]
+            transcript.add("server", bnr)
             writer.write(bnr)
-            await writer.drain()
+            await limits.drain(writer)
             while True:
-                line = await reader.readline()
+                line = await limits.readline(reader)
                 if not line:
                     break
                 ts = time.time()
-                transcript.append((ts, "client", line))
+                transcript.add("client", line, ts)
                 cmd_count += 1
-                await jitter()
+                await self.latency.pause()
                 cmd = line.decode(errors="ignore").strip().upper()
                 if cmd.startswith("EHLO"):
-                    resp = (
-                        f"250-{host}\r\n250-PIPELINING\r\n250-SIZE 10485760\r\n"
-                        f"250-8BITMIME\r\n250-AUTH LOGIN PLAIN\r\n250-STARTTLS\r\n250 HELP\r\n"
-                    ).encode()
+                    resp = persona["ehlo"]
                 elif cmd.startswith("HELO"):
-                    resp = f"250 {host}\r\n".encode()
+                    resp = persona["helo"]
                 elif cmd == "STARTTLS" and not tls_started:
                     resp = b"220 Ready to start TLS\r\n"
                 elif cmd.startswith("MAIL FROM"):
-                    resp = b"250 OK\r\n"
+                    resp = b"250 OK\r\n" if self._size_ok(cmd) else TOO_LARGE
                 elif cmd.startswith("RCPT TO"):
                     resp = b"250 Accepted\r\n"
                 elif cmd == "DATA":
@@ -61,9 +88,9 @@ class SMTPEmulator(BaseEmulator):
                     resp = b"221 Bye\r\n"
                 else:
                     resp = b"502 Command not implemented\r\n"
-                transcript.append((time.time(), "server", resp))
+                transcript.add("server", resp)
                 writer.write(resp)
-                await writer.drain()
+                await limits.drain(writer)
                 if cmd == "STARTTLS" and not tls_started:
                     tr = writer.transport
                     pr = tr.get_protocol()
@@ -73,39 +100,33 @@ class SMTPEmulator(BaseEmulator):
                     writer.set_transport(tls)
                     tls_started = True
                 if cmd == "DATA":
+                    # NOTE: The body goes to the artifact store, only its hash and size are logged.
+                    upload = Upload(self.artifacts, self.max_message)
                     while True:
-                        dl = await reader.readline()
-                        ts2 = time.time()
-                        transcript.append((ts2, "client", dl))
-                        if dl == b".\r\n":
+                        dl = await limits.readline(reader)
+                        if not dl:
+                            return
+                        if dl == b".\r\n" or dl == b".\n":
                             break
-                    ack = b"250 Message accepted for delivery\r\n"
-                    transcript.append((time.time(), "server", ack))
+                        await upload.write(dl[1:] if dl.startswith(b"..") else dl)
+                    msg = await upload.finish()
+                    upload = None
+                    count = fields["message_count"] = fields.get("message_count", 0) + 1
+                    if count <= MAX_LOGGED_MESSAGES:
+                        fields.setdefault("messages", []).append(msg)
+                    ack = TOO_LARGE if msg.get("too_large") else b"250 Message accepted for delivery\r\n"
+                    transcript.add("server", ack)
                     writer.write(ack)
-                    await writer.drain()
+                    await limits.drain(writer)
                 if cmd == "QUIT":
                     break
-        except (ConnectionResetError, OSError):
+        except (SessionLimit, ConnectionResetError, OSError):
             pass
         finally:
-            if cmd_count:
-                payload = {
-                    "service": "smtp",
-                    "ip": ip,
-                    "port": self.bind_port,
-                    "start_ts": start_ts,
-                    "end_ts": time.time(),
-                    "cmd_count": cmd_count,
-                    "details": [
-                        {
-                            "ts": t,
-                            "direction": d,
-                            "data": b.decode("latin-1", errors="ignore").rstrip(),
-                        }
-                        for t, d, b in transcript
-                    ],
-                }
-                await queue.put(payload)
+            if upload is not None:
+                await upload.abort()
+            if cmd_count or limits.tripped:
+                await self.log_session(ip, start_ts, cmd_count, transcript, limits, fields)
             try:
                 writer.close()
                 await writer.wait_closed()
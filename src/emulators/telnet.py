@@ -1,14 +1,301 @@
 # emulators/telnet.py
 import time
-import random
 import asyncio
-from .base import BaseEmulator
-from logger import queue
+from .base import BaseEmulator, SessionLimit
+from .protocol import ProtocolSession
+from .shell import FakeShell, build_index
 
 def _peer_ip(writer):
     return writer.get_extra_info("peername")[0]
 
+IAC, SB, SE = 255, 250, 240
+WILL, WONT, DO, DONT = 251, 252, 253, 254
+# NOTE: Every option is refused, so the session stays in plain NVT line mode.
+REFUSAL = {DO: WONT, WILL: DONT}
+
+LOGIN_PROMPT = b"login: "
+PASSWORD_PROMPT = b"Password: "
+LOGIN_FAILED = b"\r\nLogin incorrect\r\n"
+
+DEFAULT_LOGIN_ATTEMPTS = 3
+DEFAULT_CREDENTIALS = [
+    "root:xc3511",
+    "root:vizxv",
+    "root:admin",
+    "admin:admin",
+    "root:888888",
+    "root:default",
+    "root:123456",
+    "support:support",
+]
+
+_DATA, _IAC, _OPTION, _SUB, _SUB_IAC = range(5)
+
+
+class TelnetParser:
+    """Incremental telnet input parser.
+
+    feed() strips IAC sequences out of whatever was read and returns the
+    complete input lines (CR LF, CR NUL or a bare LF end a line), the
+    refusals to send back for option requests and the raw negotiation bytes
+    seen. Each option request is answered once, so a peer can't start a
+    negotiation loop. Subnegotiations are skipped. A partial line longer than
+    `max_line` raises ValueError.
+    """
+
+    __slots__ = ("state", "command", "answered", "line", "max_line")
+
+    def __init__(self, max_line: int = 8192):
+        self.state = _DATA
+        self.command = 0
+        self.answered = None
+        self.line = bytearray()
+        self.max_line = max_line
+
+    def feed(self, data: bytes) -> tuple:
+        text = bytearray()
+        reply = bytearray()
+        negotiation = bytearray()
+        i, n = 0, len(data)
+        while i < n:
+            state = self.state
+            if state == _DATA:
+                j = data.find(b"\xff", i)
+                if j < 0:
+                    text += data[i:]
+                    break
+                text += data[i:j]
+                i = j + 1
+                negotiation.append(IAC)
+                self.state = _IAC
+                continue
+            b = data[i]
+            i += 1
+            if state == _IAC:
+                if b == IAC:
+                    # NOTE: IAC IAC is an escaped 0xff data byte.
+                    text.append(IAC)
+                    negotiation.pop()
+                    self.state = _DATA
+                    continue
+                negotiation.append(b)
+                if b in (WILL, WONT, DO, DONT):
+                    self.command = b
+                    self.state = _OPTION
+                elif b == SB:
+                    self.state = _SUB
+                else:
+                    self.state = _DATA
+            elif state == _OPTION:
+                negotiation.append(b)
+                refusal = REFUSAL.get(self.command)
+                if self.answered is None:
+                    self.answered = set()
+                if refusal and (self.command, b) not in self.answered:
+                    self.answered.add((self.command, b))
+                    reply += bytes((IAC, refusal, b))
+                self.state = _DATA
+            elif state == _SUB:
+                negotiation.append(b)
+                if b == IAC:
+                    self.state = _SUB_IAC
+            else:
+                negotiation.append(b)
+                self.state = _DATA if b == SE else _SUB
+        return self._lines(text), bytes(reply), bytes(negotiation)
+
+    def _lines(self, text: bytearray) -> list:
+        buf = self.line
+        buf += text
+        lines = []
+        start = 0
+        while True:
+            cr = buf.find(b"\r", start)
+            lf = buf.find(b"\n", start)
+            if cr < 0 and lf < 0:
+                break
+            if cr < 0 or 0 <= lf < cr:
+                lines.append(bytes(buf[start:lf]))
+                start = lf + 1
+                continue
+            if cr + 1 >= len(buf):
+                # NOTE: CR at the end of a read, wait for the LF or NUL that follows.
+                break
+            lines.append(bytes(buf[start:cr]))
+            start = cr + 2 if buf[cr + 1] in (0, 10) else cr + 1
+        del buf[:start]
+        if len(buf) > self.max_line:
+            raise ValueError("line too long")
+        return lines
+
+
+class CredentialPolicy:
+    """Decides which logins succeed.
+
+    A login is accepted when it matches one of `credentials` ("user:password",
+    either side may be "*") or, with `accept_after`, on that attempt whatever
+    was typed. After `attempts` failures the connection is closed.
+    """
+
+    __slots__ = ("pairs", "accept_after", "attempts")
+
+    def __init__(self, credentials: list, accept_after: int, attempts: int):
+        self.pairs = set()
+        for cred in credentials:
+            user, _, password = cred.partition(":")
+            self.pairs.add((user.encode(), password.encode()))
+        self.accept_after = accept_after
+        self.attempts = attempts
+
+    @classmethod
+    def from_config(cls, emu_cfg: dict):
+        return cls(
+            emu_cfg.get("credentials", DEFAULT_CREDENTIALS),
+            emu_cfg.get("accept_after", 0),
+            emu_cfg.get("login_attempts", DEFAULT_LOGIN_ATTEMPTS),
+        )
+
+    def check(self, user: bytes, password: bytes, attempt: int) -> bool:
+        if self.accept_after and attempt >= self.accept_after:
+            return True
+        pairs = self.pairs
+        return (
+            (user, password) in pairs
+            or (user, b"*") in pairs
+            or (b"*", password) in pairs
+            or (b"*", b"*") in pairs
+        )
+
+
+class TelnetSession:
+    """Login prompt and fake shell of one connection, whichever handler mode feeds it.
+
+    input() takes the bytes of one read, records the client's lines in the
+    transcript and returns (reply, answered): everything to send back for
+    that read, and whether it answered any line (a reply to option
+    negotiation alone goes out without a response delay). `done` turns true
+    once the connection should be closed after the reply.
+    """
+
+    __slots__ = (
+        "persona",
+        "credentials",
+        "parser",
+        "state",
+        "user",
+        "prompt",
+        "attempts",
+        "shell",
+        "logins",
+        "cmd_count",
+        "done",
+    )
+
+    def __init__(self, persona: dict, credentials: CredentialPolicy, max_line: int):
+        self.persona = persona
+        self.credentials = credentials
+        self.parser = TelnetParser(max_line)
+        self.state = "user"
+        self.user = b""
+        self.prompt = b""
+        self.attempts = 0
+        self.shell = None
+        self.logins = []
+        self.cmd_count = 0
+        self.done = False
+
+    def input(self, data: bytes, transcript) -> tuple:
+        ts = time.time()
+        lines, reply, negotiation = self.parser.feed(data)
+        if negotiation:
+            transcript.add("client", negotiation, ts)
+        out = [reply]
+        for line in lines:
+            transcript.add("client", line, ts)
+            self.cmd_count += 1
+            if self.state == "user":
+                self.user = line.strip()
+                self.state = "password"
+                out.append(PASSWORD_PROMPT)
+            elif self.state == "password":
+                self.attempts += 1
+                ok = self.credentials.check(self.user, line.strip(), self.attempts)
+                self.logins.append(
+                    {
+                        "user": self.user.decode(errors="replace"),
+                        "password": line.strip().decode(errors="replace"),
+                        "ok": ok,
+                    }
+                )
+                if ok:
+                    self.state = "shell"
+                    self.shell = FakeShell(self.persona["index"])
+                    self.prompt = b"%s@%s:~%s " % (
+                        self.user,
+                        self.persona["hostname"],
+                        b"#" if self.user == b"root" else b"$",
+                    )
+                    out += (self.persona["motd"], self.prompt)
+                elif self.attempts >= self.credentials.attempts:
+                    out.append(LOGIN_FAILED)
+                    self.done = True
+                    break
+                else:
+                    self.state = "user"
+                    out += (LOGIN_FAILED, LOGIN_PROMPT)
+            else:
+                res, self.done = self.shell.run(line.decode(errors="ignore"))
+                out.append(res)
+                if self.done:
+                    break
+                out.append(self.prompt)
+        return b"".join(out), bool(lines)
+
+    def fields(self) -> dict:
+        fields = {}
+        if self.logins:
+            fields["logins"] = self.logins
+        if self.shell is not None and self.shell.downloads:
+            fields["downloads"] = self.shell.downloads
+        return fields
+
+
+class TelnetProtocol(ProtocolSession):
+    """Protocol-mode telnet session, driving a TelnetSession from loop callbacks."""
+
+    __slots__ = ("session",)
+
+    def greet(self):
+        persona = self.emulator.personas.pick(self.ip)
+        # NOTE: The unfinished line is the only input kept between reads, bounded like framed partials.
+        self.session = TelnetSession(persona, self.emulator.credentials, min(self.emulator.max_line, self.max_partial))
+        self.send(persona["banner"])
+        self.reply(LOGIN_PROMPT)
+
+    def received(self, data: bytes):
+        session = self.session
+        try:
+            resp, answered = session.input(data, self.transcript)
+        except ValueError:
+            self.close("line_too_long")
+            return
+        self.cmd_count = session.cmd_count
+        if resp:
+            if answered:
+                self.reply(resp)
+            else:
+                self.send(resp)
+        if session.done:
+            self.close()
+
+    def session_fields(self) -> dict:
+        return self.session.fields()
+
+
 class TelnetEmulator(BaseEmulator):
+    service = "telnet"
+    protocol = TelnetProtocol
+
     def __init__(self, bind_ip=None, bind_port=None, config=None):
         super().__init__(bind_ip, bind_port, config)
 
@@ -17,73 +304,62 @@ class TelnetEmulator(BaseEmulator):
             b"Debian GNU/Linux 10 ttyS0",
             b"CentOS Linux 7 (Core) ttyS1",
         ]
+        self.credentials = CredentialPolicy.from_config(self.emu_config)
+
+    def build_personas(self, host):
+        personas = []
+        for b in self.LOGIN_BANNERS:
+            issue = b.rsplit(b" ", 1)[0].decode()
+            personas.append(
+                {
+                    "banner": b + b"\r\n",
+                    "motd": f"\r\nWelcome to {issue}\r\n\r\n".encode(),
+                    "hostname": host.fqdn.split(".")[0].encode(),
+                    "index": build_index(host, issue),
+                }
+            )
+        return personas
 
     async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         ip = _peer_ip(writer)
         start_ts = time.time()
-        transcript = []
-        cmd_count = 0
+        transcript = self.new_transcript()
+        limits = self.new_limits()
 
-        banner = random.choice(self.LOGIN_BANNERS) + b"\r\n"
-        prompt_user = b"login: "
-        prompt_pass = b"Password: "
-        fail_msg = b"Login incorrect\r\n"
-
-        async def jitter():
-            await asyncio.sleep(random.uniform(0.05, 0.15))
+        persona = self.personas.pick(ip)
+        session = TelnetSession(persona, self.credentials, self.max_line)
 
         try:
-            for chunk in (banner, prompt_user):
-                transcript.append((time.time(), "server", chunk))
+            for chunk in (persona["banner"], LOGIN_PROMPT):
+                transcript.add("server", chunk)
                 writer.write(chunk)
-                await writer.drain()
-                await jitter()
-
-            user = await reader.readline()
-            if not user:
-                return
-            transcript.append((time.time(), "client", user))
-            cmd_count += 1
-            await jitter()
-
-            transcript.append((time.time(), "server", prompt_pass))
-            writer.write(prompt_pass)
-            await writer.drain()
-            await jitter()
-
-            pwd = await reader.readline()
-            if not pwd:
-                return
-            transcript.append((time.time(), "client", pwd))
-            cmd_count += 1
-            await jitter()
-
-            transcript.append((time.time(), "server", fail_msg))
-            writer.write(fail_msg)
-            await writer.drain()
-
-        except (ConnectionResetError, OSError):
+                await limits.drain(writer)
+                await self.latency.pause()
+
+            while not session.done:
+                data = await limits.read(reader, 4096)
+                if not data:
+                    break
+                try:
+                    resp, answered = session.input(data, transcript)
+                except ValueError:
+                    limits.reason = "line_too_long"
+                    break
+
+                # NOTE: Everything answered for one read goes out after one delay, in one write.
+                if resp:
+                    if answered:
+                        await self.latency.pause()
+                    transcript.add("server", resp)
+                    writer.write(resp)
+                    await limits.drain(writer)
+
+        except (SessionLimit, ConnectionResetError, OSError):
             pass
 
         finally:
-            if cmd_count:
-                payload = {
-                    "service": "telnet",
-                    "ip": ip,
-                    "port": self.bind_port,
-                    "start_ts": start_ts,
-                    "end_ts": time.time(),
-                    "cmd_count": cmd_count,
-                    "details": [
-                        {
-                            "ts": ts,
-                            "direction": d,
-                            "data": data.decode("latin-1", errors="ignore").rstrip(),
-                        }
-                        for ts, d, data in transcript
-                    ],
-                }
-                await queue.put(payload)
+            if session.cmd_count or limits.tripped:
+                await self.log_session(ip, start_ts, session.cmd_count, transcript, limits, session.fields())
             try:
                 writer.close()
                 await writer.wait_closed()
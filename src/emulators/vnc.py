@@ -1,15 +1,53 @@
 # emulators/vnc.py
 import time
-import random
 import asyncio
 import struct
-from .base import BaseEmulator
-from logger import queue
+from .base import BaseEmulator, SessionLimit
+from .framing import FrameReader, FramingError, fixed_size, vnc_size
+from .protocol import ProtocolSession
 
 def _peer_ip(writer):
     return writer.get_extra_info("peername")[0]
 
+SECURITY_TYPES = b"\x01\x01"
+SECURITY_OK = b"\x00\x00\x00\x00"
+_VERSION_SIZE = fixed_size(12)
+_BYTE_SIZE = fixed_size(1)
+
+
+class VNCProtocol(ProtocolSession):
+    """Protocol-mode VNC session: the RFB handshake as a state machine, then one frame per message."""
+
+    __slots__ = ("persona",)
+    # NOTE: Handshake and input messages are tiny; a long SetEncodings or ClientCutText is kept raw instead.
+    max_partial = 1024
+
+    def greet(self):
+        self.persona = self.emulator.personas.pick(self.ip)
+        self.fields = {}
+        self.sizer = _VERSION_SIZE
+        self.send(self.persona["proto"])
+
+    def received(self, frame: bytes):
+        self.record(frame)
+        step = self.cmd_count
+        if step == 1:
+            self.fields["version"] = frame.strip().decode(errors="replace")
+            self.sizer = _BYTE_SIZE
+            self.reply(SECURITY_TYPES)
+        elif step == 2:
+            self.fields["security"] = frame[0]
+            self.reply(SECURITY_OK)
+        elif step == 3:
+            self.fields["shared"] = bool(frame[0])
+            self.sizer = vnc_size
+            self.reply(self.persona["server_init"])
+
+
 class VNCEmulator(BaseEmulator):
+    service = "vnc"
+    protocol = VNCProtocol
+
     def __init__(self, bind_ip=None, bind_port=None, config=None):
         super().__init__(bind_ip, bind_port, config)
 
@@ -31,91 +69,105 @@ class VNCEmulator(BaseEmulator):
 
         self.RESOLUTIONS = [(800, 600), (1024, 768), (1280, 1024), (1920, 1080)]
 
+    def build_personas(self, host):
+        personas = []
+        for proto in self.PROTO_VERSIONS:
+            for width, height in self.RESOLUTIONS:
+                for name in self.SERVER_NAMES:
+                    server_init = (
+                        struct.pack(">HH", width, height)
+                        + b"\x20\x18"
+                        + b"\x00"
+                        + b"\x01"
+                        + struct.pack(">HHHHHH", 255, 255, 0, 255, 0, 255)
+                        + b"\x00\x00\x00"
+                        + struct.pack(">I", len(name))
+                        + name
+                    )
+                    personas.append({"proto": proto, "server_init": server_init})
+        return personas
+
     async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         ip = _peer_ip(writer)
         start_ts = time.time()
-        transcript = []
+        transcript = self.new_transcript()
+        limits = self.new_limits()
         cmd_count = 0
 
-        proto = random.choice(self.PROTO_VERSIONS)
-        width, height = random.choice(self.RESOLUTIONS)
-        name = random.choice(self.SERVER_NAMES)
-        sec_types = b"\x01\x01"
-
-        server_init = (
-            struct.pack(">HH", width, height)
-            + b"\x20\x18"
-            + b"\x00"
-            + b"\x01"
-            + struct.pack(">HHHHHH", 255, 255, 0, 255, 0, 255)
-            + b"\x00\x00\x00"
-            + struct.pack(">I", len(name))
-            + name
-        )
-
-        async def jitter():
-            await asyncio.sleep(random.uniform(0.05, 0.15))
+        persona = self.personas.pick(ip)
+        proto = persona["proto"]
+        sec_types = SECURITY_TYPES
+        server_init = persona["server_init"]
+
+        frames = FrameReader(reader, limits)
+        fields = {}
+        framed = True
 
         try:
-            transcript.append((time.time(), "server", proto))
+            transcript.add("server", proto)
             writer.write(proto)
-            await writer.drain()
-            await jitter()
+            await limits.drain(writer)
+            await self.latency.pause()
 
-            client_proto = await reader.readexactly(len(proto))
-            transcript.append((time.time(), "client", client_proto))
+            client_proto = await frames.exactly(len(proto))
+            transcript.add("client", client_proto)
+            fields["version"] = bytes(client_proto).strip().decode(errors="replace")
             cmd_count += 1
-            await jitter()
+            await self.latency.pause()
 
-            transcript.append((time.time(), "server", sec_types))
+            transcript.add("server", sec_types)
             writer.write(sec_types)
-            await writer.drain()
-            await jitter()
+            await limits.drain(writer)
+            await self.latency.pause()
 
-            choice = await reader.readexactly(1)
-            transcript.append((time.time(), "client", choice))
+            choice = await frames.exactly(1)
+            transcript.add("client", choice)
+            fields["security"] = choice[0]
+            cmd_count += 1
+            await self.latency.pause()
+            transcript.add("server", SECURITY_OK)
+            writer.write(SECURITY_OK)
+            await limits.drain(writer)
+
+            client_init = await frames.exactly(1)
+            transcript.add("client", client_init)
+            fields["shared"] = bool(client_init[0])
             cmd_count += 1
-            await jitter()
-            sec_res = b"\x00\x00\x00\x00"
-            transcript.append((time.time(), "server", sec_res))
-            writer.write(sec_res)
-            await writer.drain()
-            await jitter()
-
-            transcript.append((time.time(), "server", server_init))
+            await self.latency.pause()
+
+            transcript.add("server", server_init)
             writer.write(server_init)
-            await writer.drain()
-            await jitter()
+            await limits.drain(writer)
+            await self.latency.pause()
 
+            # NOTE: One frame per RFB message; past an unknown message type the rest is kept as raw reads.
             while True:
-                data = await reader.read(1024)
-                if not data:
-                    break
-                transcript.append((time.time(), "client", data))
+                if framed:
+                    try:
+                        msg = await frames.vnc_message()
+                    except FramingError:
+                        framed = False
+                        continue
+                    if msg is None:
+                        break
+                    frame = msg[1]
+                else:
+                    frame = await frames.chunk()
+                    if frame is None:
+                        break
+                transcript.add("client", frame)
                 cmd_count += 1
 
-        except (asyncio.IncompleteReadError, ConnectionResetError, OSError):
+        except (asyncio.IncompleteReadError, FramingError):
+            if frames.buffered:
+                transcript.add("client", frames.peek(frames.buffered))
+                cmd_count += 1
+        except (SessionLimit, ConnectionResetError, OSError):
             pass
 
         finally:
-            if cmd_count:
-                payload = {
-                    "service": "vnc",
-                    "ip": ip,
-                    "port": self.bind_port,
-                    "start_ts": start_ts,
-                    "end_ts": time.time(),
-                    "cmd_count": cmd_count,
-                    "details": [
-                        {
-                            "ts": ts,
-                            "direction": d,
-                            "data": data.decode("latin-1", errors="ignore").rstrip(),
-                        }
-                        for ts, d, data in transcript
-                    ],
-                }
-                await queue.put(payload)
+            if cmd_count or limits.tripped:
+                await self.log_session(ip, start_ts, cmd_count, transcript, limits, fields)
 
             try:
                 writer.close()
@@ -1,6 +1,11 @@
 # engine.py
 import asyncio
+import multiprocessing
+import os
+import signal
+import socket
 import sys
+import threading
 
 from emulators.redis import RedisEmulator
 from emulators.smtp import SMTPEmulator
@@ -10,14 +15,62 @@ from emulators.telnet import TelnetEmulator
 from emulators.mysql import MySQLEmulator
 from emulators.vnc import VNCEmulator
 from emulators.rdp import RDPEmulator
+from emulators import persona
 
+from admission import Admission
 from config import CONFIG
-from logger import log_sink
+import logger
 
-async def main() -> None:
-    asyncio.create_task(log_sink())
+ENGINE_CFG = CONFIG.get("engine") or {}
+WORKERS = int(ENGINE_CFG.get("workers", 1)) or os.cpu_count() or 1
+RESTART_DELAY = ENGINE_CFG.get("restart_delay", 1)
+EVENT_LOOPS = ("asyncio", "uvloop", "auto")
+LOOP = ENGINE_CFG.get("loop", "asyncio")
+
+
+def loop_factory(name: str = LOOP):
+    """Returns the event loop factory for engine.loop, None meaning the default asyncio loop."""
+    if name not in EVENT_LOOPS:
+        raise ValueError(f"engine.loop must be one of {', '.join(EVENT_LOOPS)}")
+    if name == "asyncio":
+        return None
+    try:
+        import uvloop
+    except ImportError:
+        if name == "uvloop":
+            print("[WARN] engine.loop is uvloop but uvloop is not installed, using asyncio")
+        return None
+    return uvloop.new_event_loop
+
+
+def run(coro, loop: str = LOOP):
+    factory = loop_factory(loop)
+    with asyncio.Runner(loop_factory=factory) as runner:
+        print(f"[INFO] Event loop: {'uvloop' if factory else 'asyncio'}")
+        return runner.run(coro)
 
+
+def _stop_event() -> asyncio.Event:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    return stop
+
+
+async def start_emulators(reuse_port: bool = False) -> tuple:
+    """Binds every enabled emulator. Returns (servers, emulators, admission)."""
     servers = []
+    emulators = []
+    await persona.start(CONFIG.get("persona") or {})
+
+    adm_conf = CONFIG.get("admission") or {}
+    # NOTE: Workers share the listening ports, so each enforces its share of the configured limits.
+    workers = WORKERS if reuse_port else 1
+    admission = Admission.from_config(adm_conf, workers) if adm_conf.get("enabled", True) else None
 
     emulator_classes = {
         "redis": RedisEmulator,
@@ -45,9 +98,22 @@ async def main() -> None:
         )
 
         try:
-            server = await asyncio.start_server(
-                emulator.handle, host=emulator.bind_ip, port=emulator.bind_port
-            )
+            if emulator.mode == "protocol":
+                server = await asyncio.get_running_loop().create_server(
+                    lambda emulator=emulator: emulator.protocol(emulator, admission),
+                    host=emulator.bind_ip,
+                    port=emulator.bind_port,
+                    reuse_port=reuse_port or None,
+                )
+            else:
+                handler = admission.wrap(emulator.handle) if admission else emulator.handle
+                server = await asyncio.start_server(
+                    handler,
+                    host=emulator.bind_ip,
+                    port=emulator.bind_port,
+                    limit=emulator.max_line,
+                    reuse_port=reuse_port or None,
+                )
         except OSError as e:
             if e.errno == 98 or e.errno == 48:
                 print(
@@ -59,13 +125,142 @@ async def main() -> None:
                 raise
 
         print(
-            f"[INFO] Emulator {name} listening on {emulator.bind_ip}:{emulator.bind_port}"
+            f"[INFO] Emulator {name} listening on {emulator.bind_ip}:{emulator.bind_port} ({emulator.mode} mode)"
         )
         servers.append(server)
+        await emulator.start_udp(reuse_port)
+        emulators.append(emulator)
+
+    return servers, emulators, admission
+
+
+async def main() -> None:
+    await logger.start()
+    sink = asyncio.create_task(logger.log_sink())
+    stop = _stop_event()
+
+    servers, emulators, admission = await start_emulators()
+
+    await stop.wait()
+    print("[INFO] Shutting down, flushing logs...")
+
+    for srv in servers:
+        srv.close()
+    for emulator in emulators:
+        await emulator.close()
+    await logger.stop_sink(sink)
+    if admission:
+        print(f"[INFO] Admission: {admission.stats()}")
+    logger.report_queue_stats()
+    await logger.shutdown()
+
+
+async def worker_main(index: int, records) -> None:
+    """One worker process: serves every emulator and forwards sessions to the supervisor."""
+    sink = asyncio.create_task(logger.forward_sink(records))
+    stop = _stop_event()
+
+    servers, emulators, admission = await start_emulators(reuse_port=True)
+
+    await stop.wait()
+    for srv in servers:
+        srv.close()
+    for emulator in emulators:
+        await emulator.close()
+    await logger.stop_sink(sink)
+    if admission:
+        print(f"[INFO] Worker {index} admission: {admission.stats()}")
+    logger.report_queue_stats(f"Worker {index} log queue")
+    await asyncio.to_thread(logger.forward_rest, records)
+
+
+def run_worker(index: int, records):
+    # NOTE: Ignore Ctrl-C until the loop installs its handlers, the supervisor stops workers itself.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run(worker_main(index, records))
+
+
+class Supervisor:
+    """Runs `workers` engine processes and owns logging for all of them.
+
+    Every worker binds each emulator port with SO_REUSEPORT, so the kernel
+    spreads incoming connections across them. Workers ship finished sessions
+    over a multiprocessing queue to the supervisor, which keeps the single
+    SQLite writer and the AbuseIPDB reporter, so writes and report dedup stay
+    global. Workers that die are restarted after restart_delay seconds.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        # NOTE: Spawn, not fork, so workers start with fresh module state instead of the supervisor's loop and queues.
+        self.ctx = multiprocessing.get_context("spawn")
+        self.records = self.ctx.Queue(maxsize=max(1, logger.QUEUE_MAX // logger.FORWARD_BATCH))
+        self.procs = {}
+        self.stopping = False
+
+    def _spawn(self, index: int):
+        proc = self.ctx.Process(
+            target=run_worker, args=(index, self.records), name=f"sticky-ports-worker-{index}"
+        )
+        proc.start()
+        self.procs[index] = proc
+
+    def _receive(self, loop: asyncio.AbstractEventLoop):
+        """Reader thread: hands batches from the workers to the log queue."""
+        while True:
+            batch = self.records.get()
+            if batch is None:
+                return
+            # NOTE: Waiting for ingest makes a full log queue push back on the workers.
+            asyncio.run_coroutine_threadsafe(logger.ingest(batch), loop).result()
+
+    async def _watch(self):
+        while not self.stopping:
+            await asyncio.sleep(RESTART_DELAY)
+            for index, proc in list(self.procs.items()):
+                if proc.is_alive() or self.stopping:
+                    continue
+                print(f"[WARN] Worker {index} exited with code {proc.exitcode}, restarting")
+                proc.close()
+                self._spawn(index)
+
+    async def run(self):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("engine.workers > 1 needs SO_REUSEPORT, which this platform lacks")
+        await logger.start()
+        sink = asyncio.create_task(logger.log_sink())
+        stop = _stop_event()
+        loop = asyncio.get_running_loop()
+        receiver = threading.Thread(target=self._receive, args=(loop,), daemon=True)
+        receiver.start()
+
+        for index in range(self.workers):
+            self._spawn(index)
+        print(f"[INFO] Supervisor started {self.workers} workers")
+        watcher = asyncio.create_task(self._watch())
+
+        await stop.wait()
+        print("[INFO] Shutting down, flushing logs...")
+        self.stopping = True
+        watcher.cancel()
+        for proc in self.procs.values():
+            if proc.is_alive():
+                proc.terminate()
+        for proc in self.procs.values():
+            await asyncio.to_thread(proc.join, 10)
+            if proc.is_alive():
+                print(f"[WARN] Worker {proc.name} did not stop in time, killing it")
+                proc.kill()
 
-    await asyncio.gather(*(srv.serve_forever() for srv in servers))
+        self.records.put(None)
+        await asyncio.to_thread(receiver.join)
+        await logger.stop_sink(sink)
+        logger.report_queue_stats()
+        await logger.shutdown()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
-    
\ No newline at end of file
+    if WORKERS > 1:
+        run(Supervisor(WORKERS).run())
+    else:
+        run(main())
@@ -1,16 +1,14 @@
 # logger.py
 import asyncio
-import sqlite3
-import json
-import uuid
-import aiohttp
+import time
 
 from cachetools import TTLCache
 from datetime import datetime, timezone
 
+from coalesce import Coalescer
 from config import CONFIG
-
-queue = asyncio.Queue()
+from reporter import AbuseReporter
+from storage import WriterThread
 
 SERVICE_CAT_MAP = {
     "ssh": [22, 18],  # SSH abuse & brute-force
@@ -28,28 +26,30 @@ VERSION = CONFIG.get("version", "?")
 SQLITE_CFG = CONFIG.get("logging", {}).get("sqlite", {})
 ABUSE_CFG = CONFIG.get("logging", {}).get("abuseipdb", {})
 
-if SQLITE_CFG.get("enabled", False):
-    db_file = SQLITE_CFG.get("file_name", "logger.db")
-    conn = sqlite3.connect(db_file, check_same_thread=False)
-    c = conn.cursor()
-    c.execute(
-        """
-    CREATE TABLE IF NOT EXISTS logs (
-        session_id   TEXT PRIMARY KEY,
-        service      TEXT NOT NULL,
-        ip           TEXT NOT NULL,
-        port         INTEGER NOT NULL,
-        start_ts     REAL NOT NULL,
-        end_ts       REAL NOT NULL,
-        cmd_count    INTEGER NOT NULL,
-        details      JSON
-    );
-    """
-    )
-    c.execute("CREATE INDEX IF NOT EXISTS idx_logs_ip      ON logs(ip)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_logs_service ON logs(service)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_logs_time    ON logs(start_ts)")
-    conn.commit()
+QUEUE_CFG = CONFIG.get("logging", {}).get("queue", {})
+COALESCE_CFG = CONFIG.get("logging", {}).get("coalesce", {})
+
+SQLITE_ENABLED = SQLITE_CFG.get("enabled", False)
+
+QUEUE_POLICIES = ("block", "drop_oldest", "summary")
+QUEUE_MAX = max(1, int(QUEUE_CFG.get("max_size", 10000)))
+QUEUE_POLICY = QUEUE_CFG.get("policy", "summary")
+QUEUE_DEGRADE_AT = int(QUEUE_MAX * QUEUE_CFG.get("degrade_ratio", 0.5))
+if QUEUE_POLICY not in QUEUE_POLICIES:
+    raise ValueError(f"logging.queue.policy must be one of {', '.join(QUEUE_POLICIES)}")
+
+queue = asyncio.Queue(maxsize=QUEUE_MAX)
+QUEUE_STATS = {"dropped": 0, "degraded": 0}
+_last_overload_warn = 0.0
+
+writer = None
+coalescer = None
+_sweeper = None
+# NOTE: Whether a sink holds sessions taken off the queue, and whether it was asked to stop.
+_sink_busy = False
+_sink_stopping = False
+
+FORWARD_BATCH = 256  # Sessions per batch shipped from a worker process to the supervisor.
 
 ABUSE_RECENTS = TTLCache(
     maxsize=ABUSE_CFG.get("ttl_size", 4500), ttl=ABUSE_CFG.get("ttl_time", 905) + 5
@@ -58,76 +58,206 @@ ABUSE_ENABLED = ABUSE_CFG.get("enabled", False)
 ABUSE_API_KEY = ABUSE_CFG.get("api_key")
 ABUSE_CATS = ABUSE_CFG.get("categories", [])
 ABUSE_IDENTIFIER = ABUSE_CFG.get("identifier", "server")
-REPORT_URL = "https://api.abuseipdb.com/api/v2/report"
 
+reporter = None
 
-async def report_to_abuseipdb(ip: str, categories: list, comment: str, timestamp: str):
-    headers = {
-        "Key": ABUSE_API_KEY,
-        "Accept": "application/json",
-        "User-Agent": f"StickyPorts/{VERSION} (L4 Honeypot; reporting abusive IPs)",
-    }
-    data = {
-        "ip": ip,
-        "categories": ",".join(str(c) for c in categories),
-        "comment": comment,
-        "timestamp": timestamp,
+
+def _maybe_report(service: str, ip: str, port: int, start_ts: float, cmd_count: int):
+    if reporter and not ABUSE_RECENTS.get(ip):
+        ABUSE_RECENTS[ip] = True
+
+        cats = SERVICE_CAT_MAP.get(service, ABUSE_CATS)
+        if not cats:
+            cats = ABUSE_CATS
+
+        if cmd_count <= 0 and 14 not in cats: # NOTE: If command count is below zero ( no commands executed ) we will flag for port scan.
+            cats.append(14)
+
+        comment = f"\nEmulator: {service} \nPort: {port} \nCommands: {cmd_count}\n\nCaught on {ABUSE_IDENTIFIER} using StickyPorts! \nhttps://github.com/ImInTheICU/sticky-ports"
+        ts_str = datetime.fromtimestamp(start_ts, timezone.utc).isoformat()
+        if not reporter.submit(ip, cats, comment, ts_str):
+            print(f"[WARN] AbuseIPDB report queue full, dropping report for {ip}")
+
+
+def _summarize(msg: dict) -> dict:
+    """Keeps the session counters and timestamps but drops the transcript."""
+    return {k: v for k, v in msg.items() if k != "details"} | {"details": None}
+
+
+def _overloaded(kind: str):
+    global _last_overload_warn
+    QUEUE_STATS[kind] += 1
+    now = time.monotonic()
+    if now - _last_overload_warn >= 10:
+        _last_overload_warn = now
+        print(
+            f"[WARN] Log queue overloaded ({queue.qsize()}/{QUEUE_MAX}, policy {QUEUE_POLICY}): "
+            f"{QUEUE_STATS['dropped']} dropped, {QUEUE_STATS['degraded']} degraded so far"
+        )
+
+
+def queue_stats() -> dict:
+    return {
+        "depth": queue.qsize(),
+        "max_size": QUEUE_MAX,
+        "policy": QUEUE_POLICY,
+        **QUEUE_STATS,
     }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(REPORT_URL, data=data, headers=headers) as resp:
-            if resp.status != 200:
-                text = await resp.text()
-                print(f"[ERROR] Failed to report {ip}: {resp.status} {text}")
 
 
-async def log_sink():
+def report_queue_stats(label: str = "Log queue"):
+    # NOTE: Also called from the writer thread; the counters are only read, so no lock is needed.
+    s = queue_stats()
+    print(
+        f"[INFO] {label}: {s['depth']}/{s['max_size']} queued (policy {s['policy']}), "
+        f"{s['dropped']} dropped, {s['degraded']} degraded"
+    )
+
+
+async def enqueue(msg: dict):
+    """Queues a finished session, applying the overload policy if the sink is behind."""
+    if QUEUE_POLICY == "block":
+        await queue.put(msg)
+        return
+    enqueue_nowait(msg)
+
+
+def enqueue_nowait(msg: dict) -> bool:
+    """enqueue() for callbacks. Returns False when the "block" policy would have to wait."""
+    if QUEUE_POLICY == "block":
+        if queue.full():
+            return False
+        queue.put_nowait(msg)
+        return True
+
+    if QUEUE_POLICY == "summary" and queue.qsize() >= QUEUE_DEGRADE_AT:
+        msg = _summarize(msg)
+        _overloaded("degraded")
+
+    if queue.full():
+        queue.get_nowait()
+        _overloaded("dropped")
+    queue.put_nowait(msg)
+    return True
+
+
+async def _handle(msg):
+    if not isinstance(msg, dict):
+        return
+    if coalescer:
+        msg = coalescer.add(msg)
+        for counter in coalescer.expired():
+            await _persist(counter)
+        if msg is None:
+            return
+    await _persist(msg)
+
+
+async def _sweep():
+    """Stores the counters of repeat windows that closed while no new session arrived."""
     while True:
-        msg = await queue.get()
-        if not isinstance(msg, dict):
-            continue
-        session_id = msg.get("session_id") or str(uuid.uuid4())
-        service = msg["service"]
-        ip = msg["ip"]
-        port = msg["port"]
-        start_ts = msg["start_ts"]
-        end_ts = msg["end_ts"]
-        cmd_count = msg["cmd_count"]
-        details = msg.get("details")
-
-        if SQLITE_CFG.get("enabled", False):
-            try:
-                details_json = json.dumps(details)
-                c.execute(
-                    """
-                    INSERT OR REPLACE INTO logs
-                    (session_id, service, ip, port, start_ts, end_ts, cmd_count, details)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                    (
-                        session_id,
-                        service,
-                        ip,
-                        port,
-                        start_ts,
-                        end_ts,
-                        cmd_count,
-                        details_json,
-                    ),
-                )
-                conn.commit()
-            except Exception as e:
-                print(f"[ERROR] SQLite error: {e}")
-
-        if ABUSE_ENABLED and ABUSE_API_KEY and not ABUSE_RECENTS.get(ip):
+        await asyncio.sleep(max(1.0, coalescer.window / 10))
+        for counter in coalescer.expired():
+            await _persist(counter)
+
+
+async def _persist(msg: dict):
+    if writer:
+        # NOTE: Wait for the writer to catch up so the bounded queue, not its inbox, absorbs overload.
+        while not writer.submit(msg):
+            await asyncio.sleep(0.01)
+    if msg.get("report", True):
+        _maybe_report(
+            msg["service"], msg["ip"], msg["port"], msg["start_ts"], msg["cmd_count"]
+        )
+
+
+async def start():
+    global writer, reporter, coalescer, _sweeper
+    if coalescer is None:
+        coalescer = Coalescer.from_config(COALESCE_CFG)
+        if coalescer:
+            _sweeper = asyncio.create_task(_sweep())
+    if SQLITE_ENABLED and writer is None:
+        writer = WriterThread(SQLITE_CFG, report_queue_stats)
+        writer.start()
+    if ABUSE_ENABLED and ABUSE_API_KEY and reporter is None:
+        reporter = AbuseReporter.from_config(ABUSE_CFG, VERSION)
+        await reporter.start()
+        for ip in await reporter.recent_ips(ABUSE_RECENTS.ttl):
             ABUSE_RECENTS[ip] = True
 
-            cats = SERVICE_CAT_MAP.get(service, ABUSE_CATS)
-            if not cats:
-                cats = ABUSE_CATS
 
-            if cmd_count <= 0 and 14 not in cats: # NOTE: If command count is below zero ( no commands executed ) we will flag for port scan.
-                cats.append(14)
+async def log_sink():
+    global _sink_busy
+    while not _sink_stopping:
+        msg = await queue.get()
+        _sink_busy = True
+        try:
+            await _handle(msg)
+        except Exception as e:
+            print(f"[ERROR] Failed to handle session: {e}")
+        finally:
+            _sink_busy = False
+
+
+def _take_batch(first) -> list:
+    batch = [first]
+    while len(batch) < FORWARD_BATCH and not queue.empty():
+        batch.append(queue.get_nowait())
+    return batch
+
+
+async def forward_sink(records):
+    """Worker-side sink: ships queued sessions to the supervisor in batches."""
+    global _sink_busy
+    while not _sink_stopping:
+        batch = _take_batch(await queue.get())
+        _sink_busy = True
+        try:
+            await asyncio.to_thread(records.put, batch)
+        finally:
+            _sink_busy = False
+
+
+async def stop_sink(sink: asyncio.Task):
+    """Stops log_sink() or forward_sink() between sessions, so none it took off the queue is lost."""
+    global _sink_stopping
+    _sink_stopping = True
+    # NOTE: Waiting in queue.get() is safe to cancel, an item is only removed once get() resumes.
+    if not _sink_busy:
+        sink.cancel()
+    await asyncio.gather(sink, return_exceptions=True)
+
+
+def forward_rest(records):
+    """Ships whatever is still queued when a worker stops."""
+    while not queue.empty():
+        records.put(_take_batch(queue.get_nowait()))
+    records.close()
+    records.join_thread()
+
+
+async def ingest(batch: list):
+    """Supervisor-side: queues a batch of sessions received from a worker."""
+    for msg in batch:
+        await enqueue(msg)
+
 
-            comment = f"\nEmulator: {service} \nPort: {port} \nCommands: {cmd_count}\n\nCaught on {ABUSE_IDENTIFIER} using StickyPorts! \nhttps://github.com/ImInTheICU/sticky-ports"
-            ts_str = datetime.fromtimestamp(start_ts, timezone.utc).isoformat()
-            asyncio.create_task(report_to_abuseipdb(ip, cats, comment, ts_str))
+async def shutdown():
+    """Hand any queued sessions to the writer, then wait for it to flush."""
+    while not queue.empty():
+        try:
+            await _handle(queue.get_nowait())
+        except Exception as e:
+            print(f"[ERROR] Failed to handle session: {e}")
+    if coalescer:
+        _sweeper.cancel()
+        for counter in coalescer.drain():
+            await _persist(counter)
+        s = coalescer.stats()
+        print(f"[INFO] Coalesced {s['absorbed']} repeat sessions into {s['counters']} counter rows")
+    if writer:
+        await asyncio.to_thread(writer.close)
+    if reporter:
+        await reporter.close()
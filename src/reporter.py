@@ -0,0 +1,401 @@
+# reporter.py
+import asyncio
+import csv
+import io
+import json
+import sqlite3
+import threading
+import time
+import aiohttp
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+REPORT_URL = "https://api.abuseipdb.com/api/v2/report"
+BULK_REPORT_URL = "https://api.abuseipdb.com/api/v2/bulk-report"
+BULK_MAX_LINES = 10000  # NOTE: AbuseIPDB rejects bulk reports with more lines than this.
+
+DEFAULT_RETRY_BACKOFF = 30
+DEFAULT_RETRY_MAX_BACKOFF = 3600
+DEFAULT_RETRY_MAX_AGE = 7 * 86400
+
+# Outcomes of a report request.
+SENT, RETRY, FAILED, LIMITED = "sent", "retry", "failed", "limited"
+
+
+def parse_retry_after(value, default: float = 60.0) -> float:
+    """Returns the delay in seconds requested by a Retry-After header."""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class ReportSpool:
+    """On-disk queue of unsent reports plus the record of what was reported.
+
+    A report that couldn't be delivered waits `next_attempt_at` before it is
+    taken again, twice as long after each attempt. Calls block on disk, so
+    the reporter runs them with asyncio.to_thread.
+    """
+
+    def __init__(self, file_name: str):
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(file_name, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+        CREATE TABLE IF NOT EXISTS spool (
+            id           INTEGER PRIMARY KEY AUTOINCREMENT,
+            ip           TEXT NOT NULL,
+            categories   TEXT NOT NULL,
+            comment      TEXT NOT NULL,
+            timestamp    TEXT NOT NULL,
+            queued_at    REAL NOT NULL,
+            attempts     INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0
+        );
+        """
+        )
+        # NOTE: Spools written by older versions lack the backoff column.
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(spool)")}
+        if "next_attempt_at" not in columns:
+            self.conn.execute("ALTER TABLE spool ADD COLUMN next_attempt_at REAL NOT NULL DEFAULT 0")
+        self.conn.execute(
+            """
+        CREATE TABLE IF NOT EXISTS reported (
+            ip           TEXT PRIMARY KEY,
+            reported_at  REAL NOT NULL
+        );
+        """
+        )
+        self.conn.commit()
+
+    def add_many(self, reports: list):
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO spool (ip, categories, comment, timestamp, queued_at) VALUES (?, ?, ?, ?, ?)",
+                [(r["ip"], r["categories"], r["comment"], r["timestamp"], now) for r in reports],
+            )
+
+    def take(self, limit: int) -> list:
+        """Returns up to `limit` reports due for an attempt, oldest first."""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT id, ip, categories, comment, timestamp FROM spool"
+                " WHERE next_attempt_at <= ? ORDER BY id LIMIT ?",
+                (time.time(), limit),
+            ).fetchall()
+
+    def done(self, rows: list):
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.executemany("DELETE FROM spool WHERE id = ?", [(r[0],) for r in rows])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO reported (ip, reported_at) VALUES (?, ?)",
+                [(r[1], now) for r in rows],
+            )
+
+    def retry(self, rows: list, backoff: float, max_backoff: float, max_age: float) -> int:
+        """Puts rows off for an exponential backoff. Drops those queued longer than `max_age`; returns how many."""
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "UPDATE spool SET attempts = attempts + 1,"
+                " next_attempt_at = ? + min(?, ? * (1 << min(attempts, 20))) WHERE id = ?",
+                [(now, max_backoff, backoff, r[0]) for r in rows],
+            )
+            if not max_age:
+                return 0
+            return self.conn.executemany(
+                "DELETE FROM spool WHERE id = ? AND queued_at < ?",
+                [(r[0], now - max_age) for r in rows],
+            ).rowcount
+
+    def rejected(self, rows: list) -> int:
+        """Drops rows the API refused."""
+        with self._lock, self.conn:
+            return self.conn.executemany("DELETE FROM spool WHERE id = ?", [(r[0],) for r in rows]).rowcount
+
+    def recent_ips(self, since: float) -> list:
+        """IPs reported since `since` or still waiting in the spool."""
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM reported WHERE reported_at < ?", (since,))
+            return [
+                row[0]
+                for row in self.conn.execute(
+                    "SELECT ip FROM reported UNION SELECT ip FROM spool"
+                )
+            ]
+
+    def close(self):
+        self.conn.close()
+
+
+def bulk_invalid(body: bytes) -> set:
+    """Returns the IPs a bulk-report response lists under invalidReports."""
+    try:
+        invalid = json.loads(body)["data"].get("invalidReports") or []
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return set()
+    return {r.get("input") for r in invalid if isinstance(r, dict)}
+
+
+def bulk_csv(rows: list) -> bytes:
+    buf = io.StringIO()
+    out = csv.writer(buf)
+    out.writerow(("IP", "Categories", "ReportDate", "Comment"))
+    for _, ip, categories, comment, timestamp in rows:
+        out.writerow((ip, categories, timestamp, comment[:1024]))
+    return buf.getvalue().encode()
+
+
+class AbuseReporter:
+    """Long-lived AbuseIPDB client backed by an on-disk spool.
+
+    submit() only buffers the report. A background flusher moves buffered
+    reports into the spool every flush_interval seconds and then submits
+    spooled reports, either as individual requests with at most `concurrency`
+    in flight or, with `bulk`, in one bulk-report upload per bulk_interval.
+    Reports leave the spool only once AbuseIPDB accepted them, so nothing is
+    lost while the API is down or the process restarts. Timeouts and 5xx
+    replies are retried with exponential backoff until a report is
+    `retry_max_age` old; only reports the API rejects (a 4xx, or listed as
+    invalid in a bulk response) are dropped at once. A 429 pauses submission until the
+    Retry-After delay has passed.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        user_agent: str,
+        spool_file: str = "abuse_spool.db",
+        url: str = REPORT_URL,
+        bulk_url: str = BULK_REPORT_URL,
+        bulk: bool = False,
+        bulk_interval: float = 3600,
+        flush_interval: float = 5,
+        concurrency: int = 4,
+        timeout: float = 10.0,
+        queue_size: int = 1000,
+        retry_backoff: float = DEFAULT_RETRY_BACKOFF,
+        retry_max_backoff: float = DEFAULT_RETRY_MAX_BACKOFF,
+        retry_max_age: float = DEFAULT_RETRY_MAX_AGE,
+    ):
+        self.api_key = api_key
+        self.user_agent = user_agent
+        self.spool_file = spool_file
+        self.url = url
+        self.bulk_url = bulk_url
+        self.bulk = bulk
+        self.bulk_interval = bulk_interval
+        self.flush_interval = flush_interval
+        self.concurrency = max(1, int(concurrency))
+        self.timeout = timeout
+        self.queue_size = queue_size
+        self.retry_backoff = retry_backoff
+        self.retry_max_backoff = retry_max_backoff
+        self.retry_max_age = retry_max_age
+
+        self.spool = None
+        self.session = None
+        self._buffer = []
+        self._flusher = None
+        self._wake = None
+        self._flush_lock = asyncio.Lock()
+        self._resume_at = 0.0
+        self._last_bulk = 0.0
+
+        self.sent = 0
+        self.failed = 0
+        self.rate_limited = 0
+        self.dropped = 0
+
+    @classmethod
+    def from_config(cls, cfg: dict, version: str):
+        return cls(
+            api_key=cfg.get("api_key"),
+            user_agent=f"StickyPorts/{version} (L4 Honeypot; reporting abusive IPs)",
+            spool_file=cfg.get("spool_file", "abuse_spool.db"),
+            url=cfg.get("report_url", REPORT_URL),
+            bulk_url=cfg.get("bulk_report_url", BULK_REPORT_URL),
+            bulk=cfg.get("bulk", False),
+            bulk_interval=cfg.get("bulk_interval", 3600),
+            flush_interval=cfg.get("flush_interval", 5),
+            concurrency=cfg.get("concurrency", 4),
+            timeout=cfg.get("timeout", 10),
+            queue_size=cfg.get("queue_size", 1000),
+            retry_backoff=cfg.get("retry_backoff", DEFAULT_RETRY_BACKOFF),
+            retry_max_backoff=cfg.get("retry_max_backoff", DEFAULT_RETRY_MAX_BACKOFF),
+            retry_max_age=cfg.get("retry_max_age", DEFAULT_RETRY_MAX_AGE),
+        )
+
+    async def start(self):
+        if self.session:
+            return
+        self.spool = await asyncio.to_thread(ReportSpool, self.spool_file)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={
+                "Key": self.api_key or "",
+                "Accept": "application/json",
+                "User-Agent": self.user_agent,
+            },
+        )
+        # NOTE: Treat the spool as just flushed so a restart does not trigger an immediate bulk upload.
+        self._last_bulk = time.monotonic()
+        self._wake = asyncio.Event()
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if not self.session:
+            return
+        self._flusher.cancel()
+        await asyncio.gather(self._flusher, return_exceptions=True)
+        if self._buffer:
+            await asyncio.to_thread(self.spool.add_many, self._buffer)
+            self._buffer = []
+        await self.session.close()
+        self.session = None
+        self.spool.close()
+
+    async def recent_ips(self, ttl: float) -> list:
+        return await asyncio.to_thread(self.spool.recent_ips, time.time() - ttl)
+
+    def submit(self, ip: str, categories: list, comment: str, timestamp: str) -> bool:
+        if len(self._buffer) >= self.queue_size:
+            self.dropped += 1
+            return False
+        self._buffer.append(
+            {
+                "ip": ip,
+                "categories": ",".join(str(c) for c in categories),
+                "comment": comment,
+                "timestamp": timestamp,
+            }
+        )
+        if len(self._buffer) >= self.queue_size // 2:
+            self._wake.set()
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "rate_limited": self.rate_limited,
+            "dropped": self.dropped,
+            "buffered": len(self._buffer),
+        }
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"[ERROR] AbuseIPDB flush failed: {e!r}")
+
+    async def flush(self, force_bulk: bool = False):
+        async with self._flush_lock:
+            await self._flush(force_bulk)
+
+    async def _flush(self, force_bulk: bool):
+        if self._buffer:
+            reports, self._buffer = self._buffer, []
+            await asyncio.to_thread(self.spool.add_many, reports)
+
+        if time.monotonic() < self._resume_at:
+            return
+        if self.bulk:
+            if force_bulk or time.monotonic() - self._last_bulk >= self.bulk_interval:
+                await self._flush_bulk()
+        else:
+            while await self._flush_single() and time.monotonic() >= self._resume_at:
+                pass
+
+    async def _flush_bulk(self):
+        rows = await asyncio.to_thread(self.spool.take, BULK_MAX_LINES)
+        if not rows:
+            return
+        self._last_bulk = time.monotonic()
+        form = aiohttp.FormData()
+        form.add_field("csv", bulk_csv(rows), filename="report.csv", content_type="text/csv")
+        outcome, body = await self._post(self.bulk_url, form, f"bulk report of {len(rows)} IPs")
+        if outcome != SENT:
+            await self._settle(rows, outcome)
+            return
+        invalid = bulk_invalid(body)
+        if invalid:
+            print(f"[WARN] AbuseIPDB rejected {len(invalid)} IPs of a bulk report")
+        await self._settle([r for r in rows if r[1] not in invalid], SENT)
+        await self._settle([r for r in rows if r[1] in invalid], FAILED)
+
+    async def _flush_single(self) -> bool:
+        """Sends one batch of spooled reports. Returns True if more may be waiting."""
+        limit = self.concurrency * 16
+        rows = await asyncio.to_thread(self.spool.take, limit)
+        if not rows:
+            return False
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def send(row):
+            _, ip, categories, comment, timestamp = row
+            data = {"ip": ip, "categories": categories, "comment": comment, "timestamp": timestamp}
+            async with sem:
+                if time.monotonic() < self._resume_at:
+                    return LIMITED
+                return (await self._post(self.url, data, ip))[0]
+
+        outcomes = await asyncio.gather(*(send(r) for r in rows))
+        for outcome in (SENT, RETRY, FAILED):
+            await self._settle([r for r, o in zip(rows, outcomes) if o == outcome], outcome)
+        return len(rows) == limit and SENT in outcomes
+
+    async def _settle(self, rows: list, outcome: str):
+        if not rows or outcome == LIMITED:
+            return
+        if outcome == SENT:
+            self.sent += len(rows)
+            await asyncio.to_thread(self.spool.done, rows)
+            return
+        if outcome == RETRY:
+            self.failed += await asyncio.to_thread(
+                self.spool.retry, rows, self.retry_backoff, self.retry_max_backoff, self.retry_max_age
+            )
+        else:
+            self.failed += await asyncio.to_thread(self.spool.rejected, rows)
+
+    async def _post(self, url: str, data, what: str):
+        """Sends one request. Returns its outcome and, if it was accepted, the response body."""
+        try:
+            async with self.session.post(url, data=data) as resp:
+                if resp.status == 200:
+                    return SENT, await resp.read()
+                if resp.status == 429:
+                    self.rate_limited += 1
+                    delay = parse_retry_after(resp.headers.get("Retry-After"))
+                    self._resume_at = max(self._resume_at, time.monotonic() + delay)
+                    print(f"[WARN] AbuseIPDB rate limited, pausing reports for {delay:.0f}s")
+                    return LIMITED, None
+                text = await resp.text()
+                print(f"[ERROR] Failed to report {what}: {resp.status} {text}")
+                return (RETRY if resp.status >= 500 else FAILED), None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"[ERROR] Failed to report {what}: {e!r}")
+            return RETRY, None
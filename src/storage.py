@@ -0,0 +1,728 @@
+# storage.py
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import uuid
+import zlib
+
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from queue import Queue, Empty, Full
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+CODECS = ("zstd", "zlib", "none")
+PARTITION_FORMATS = {
+    "none": None,
+    "day": ("%Y-%m-%d", r"\d{4}-\d{2}-\d{2}"),
+    "week": ("%G-W%V", r"\d{4}-W\d{2}"),
+}
+
+# NOTE: Bump when the layout produced by pack_frames changes. Version 1 kept client payloads
+# in the transcript blob; version 2 keeps them in the payloads table, referenced by digest.
+FORMAT_VERSION = 2
+FORMAT_VERSIONS = (1, 2)
+DEFAULT_PAYLOAD_CACHE = 65536
+FRAME_DIRECTIONS = ("client", "server")
+_DIRECTION_CODES = {name: i for i, name in enumerate(FRAME_DIRECTIONS)}
+_FRAME_HEADER = struct.Struct("<I")
+
+INSERT_SESSION = """
+    INSERT OR REPLACE INTO sessions
+    (session_id, service, ip, port, start_ts, end_ts, cmd_count,
+     truncated_frames, truncated_bytes, end_reason, fields, hit_count, last_seen, payload)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+UPDATE_COUNTER = """
+    UPDATE sessions SET hit_count = ?, last_seen = ? WHERE session_id = ?
+"""
+
+INSERT_TRANSCRIPT = """
+    INSERT OR REPLACE INTO transcripts
+    (session_id, format_version, codec, frame_count, raw_bytes, data)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+INSERT_PAYLOAD = """
+    INSERT OR IGNORE INTO payloads (digest, codec, raw_bytes, data) VALUES (?, ?, ?, ?)
+"""
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS sessions (
+        session_id        TEXT PRIMARY KEY,
+        service           TEXT NOT NULL,
+        ip                TEXT NOT NULL,
+        port              INTEGER NOT NULL,
+        start_ts          REAL NOT NULL,
+        end_ts            REAL NOT NULL,
+        cmd_count         INTEGER NOT NULL,
+        truncated_frames  INTEGER NOT NULL DEFAULT 0,
+        truncated_bytes   INTEGER NOT NULL DEFAULT 0,
+        end_reason        TEXT,
+        fields            TEXT,
+        hit_count         INTEGER NOT NULL DEFAULT 1,
+        last_seen         REAL,
+        payload           TEXT
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS transcripts (
+        session_id        TEXT PRIMARY KEY REFERENCES sessions(session_id),
+        format_version    INTEGER NOT NULL,
+        codec             TEXT NOT NULL,
+        frame_count       INTEGER NOT NULL,
+        raw_bytes         INTEGER NOT NULL,
+        data              BLOB NOT NULL
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS payloads (
+        digest            TEXT PRIMARY KEY,
+        codec             TEXT NOT NULL,
+        raw_bytes         INTEGER NOT NULL,
+        data              BLOB NOT NULL
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_sessions_ip      ON sessions(ip)",
+    "CREATE INDEX IF NOT EXISTS idx_sessions_service ON sessions(service)",
+    "CREATE INDEX IF NOT EXISTS idx_sessions_time    ON sessions(start_ts)",
+)
+
+
+def pack_frames(frames, client: bytearray = None) -> tuple:
+    """Packs (ts, direction, payload) frames into one binary blob.
+
+    Layout (little-endian): frame count as uint32, then the timestamps as
+    float64s, the direction codes as one byte each, the payload lengths as
+    uint32s, and finally every payload back to back. Returns (blob, count).
+
+    With `client`, client payloads are appended to it instead of the blob
+    (format version 2), so the lengths are all that's left of them.
+    """
+    ts = array("d")
+    dirs = bytearray()
+    lens = array("I")
+    payload = bytearray()
+    for t, direction, data in frames:
+        ts.append(t)
+        dirs.append(_DIRECTION_CODES[direction])
+        lens.append(len(data))
+        if client is not None and direction == "client":
+            client += data
+        else:
+            payload += data
+    if sys.byteorder != "little":
+        ts.byteswap()
+        lens.byteswap()
+    n = len(ts)
+    return _FRAME_HEADER.pack(n) + ts.tobytes() + dirs + lens.tobytes() + payload, n
+
+
+def unpack_frames(blob: bytes, client: bytes = None) -> list:
+    """Inverse of pack_frames. Returns a list of (ts, direction, payload).
+
+    `client` is the session's client payload for blobs packed without it.
+    """
+    (n,) = _FRAME_HEADER.unpack_from(blob)
+    pos = _FRAME_HEADER.size
+    ts = array("d", blob[pos : pos + 8 * n])
+    pos += 8 * n
+    dirs = blob[pos : pos + n]
+    pos += n
+    lens = array("I", blob[pos : pos + 4 * n])
+    pos += 4 * n
+    if sys.byteorder != "little":
+        ts.byteswap()
+        lens.byteswap()
+    frames = []
+    cpos = 0
+    for i in range(n):
+        direction = FRAME_DIRECTIONS[dirs[i]]
+        if client is not None and direction == "client":
+            frames.append((ts[i], direction, client[cpos : cpos + lens[i]]))
+            cpos += lens[i]
+            continue
+        frames.append((ts[i], direction, blob[pos : pos + lens[i]]))
+        pos += lens[i]
+    return frames
+
+
+def default_codec() -> str:
+    return "zstd" if zstandard else "zlib"
+
+
+def compress(raw: bytes, codec: str, level: int = None) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(raw)
+    if codec == "zlib":
+        return zlib.compress(raw, 6 if level is None else level)
+    return raw
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        if not zstandard:
+            raise RuntimeError("transcript is zstd-compressed but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == "zlib":
+        return zlib.decompress(data)
+    return data
+
+
+# Columns added to sessions after it was introduced, created on older databases.
+SESSION_COLUMNS = {
+    "end_reason": "TEXT",
+    "fields": "TEXT",
+    "hit_count": "INTEGER NOT NULL DEFAULT 1",
+    "last_seen": "REAL",
+    "payload": "TEXT",
+}
+
+
+def create_schema(conn: sqlite3.Connection):
+    for stmt in SCHEMA:
+        conn.execute(stmt)
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(sessions)")}
+    for name, decl in SESSION_COLUMNS.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE sessions ADD COLUMN {name} {decl}")
+    # NOTE: Created after the column migration, older databases only now have the column.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_payload ON sessions(payload)")
+    conn.commit()
+
+
+def read_transcript(conn: sqlite3.Connection, session_id: str) -> list:
+    """Returns a stored session's frames as (ts, direction, payload) tuples."""
+    row = conn.execute(
+        """
+        SELECT t.format_version, t.codec, t.data, p.codec, p.data
+        FROM transcripts t
+        LEFT JOIN sessions s ON s.session_id = t.session_id
+        LEFT JOIN payloads p ON p.digest = s.payload
+        WHERE t.session_id = ?
+        """,
+        (session_id,),
+    ).fetchone()
+    if not row:
+        return []
+    version, codec, data, payload_codec, payload = row
+    if version not in FORMAT_VERSIONS:
+        raise ValueError(f"unsupported transcript format version {version}")
+    if version == 1:
+        return unpack_frames(decompress(data, codec))
+    client = decompress(payload, payload_codec) if payload is not None else b""
+    return unpack_frames(decompress(data, codec), client)
+
+
+def transcript_row(session_id: str, frames, codec: str, level: int = None, digest: str = None) -> tuple:
+    """Packs a transcript. Returns its transcripts row and its client payload as (digest, bytes), or None.
+
+    `digest` is the client bytes' sha256 if the caller has it already.
+    """
+    client = bytearray()
+    raw, count = pack_frames(frames, client)
+    transcript = (session_id, FORMAT_VERSION, codec, count, len(raw), compress(raw, codec, level))
+    if not client:
+        return transcript, None
+    return transcript, (digest or hashlib.sha256(client).hexdigest(), bytes(client))
+
+
+def session_rows(msg: dict, codec: str, level: int = None) -> tuple:
+    """Builds the sessions row and, if the session has a transcript, its transcripts and payload rows.
+
+    Returns (session, transcript, payload) with payload as (digest, bytes).
+    msg["payload"] is the digest of the client bytes as the emulator
+    computed it; sessions without a transcript keep only that.
+    """
+    session_id = msg.get("session_id") or str(uuid.uuid4())
+    details = msg.get("details")
+    transcript = payload = None
+    digest = msg.get("payload")
+    if details:
+        try:
+            transcript, payload = transcript_row(session_id, details, codec, level, digest)
+        except Exception as e:
+            print(f"[ERROR] Failed to serialize session {session_id}: {e}")
+        digest = payload[0] if payload else None
+    session = (
+        session_id,
+        msg["service"],
+        msg["ip"],
+        msg["port"],
+        msg["start_ts"],
+        msg["end_ts"],
+        msg["cmd_count"],
+        msg.get("truncated_frames", 0),
+        msg.get("truncated_bytes", 0),
+        msg.get("end_reason"),
+        json.dumps(fields, separators=(",", ":")) if (fields := msg.get("fields")) else None,
+        msg.get("hit_count", 1),
+        msg.get("last_seen"),
+        digest,
+    )
+    return session, transcript, payload
+
+
+def partition_key(mode: str, ts: float):
+    """Names the partition a session starting at `ts` belongs to (UTC)."""
+    fmt = PARTITION_FORMATS[mode]
+    if not fmt:
+        return None
+    return datetime.fromtimestamp(ts, timezone.utc).strftime(fmt[0])
+
+
+def partition_path(file_name: str, key) -> str:
+    if key is None:
+        return file_name
+    stem, ext = os.path.splitext(file_name)
+    return f"{stem}-{key}{ext}"
+
+
+def partition_range(mode: str, key: str) -> tuple:
+    """Returns the (start, end) timestamps covered by a partition."""
+    if mode == "day":
+        start = datetime.strptime(key, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+        end = start + timedelta(days=1)
+    else:
+        start = datetime.strptime(key + "-1", "%G-W%V-%u").replace(tzinfo=timezone.utc)
+        end = start + timedelta(weeks=1)
+    return start.timestamp(), end.timestamp()
+
+
+def list_partitions(file_name: str, mode: str) -> list:
+    """Returns the (key, path) of every partition on disk, oldest first."""
+    fmt = PARTITION_FORMATS[mode]
+    if not fmt:
+        return [(None, file_name)] if os.path.exists(file_name) else []
+    stem, ext = os.path.splitext(file_name)
+    folder = os.path.dirname(stem) or "."
+    pattern = re.compile(re.escape(os.path.basename(stem)) + "-(" + fmt[1] + ")" + re.escape(ext) + "$")
+    found = []
+    for entry in os.listdir(folder):
+        m = pattern.match(entry)
+        if m:
+            found.append((m.group(1), os.path.join(os.path.dirname(stem), entry)))
+    return sorted(found)
+
+
+def remove_partition(path: str):
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.unlink(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def compact_partition(path: str, vacuum: bool = True):
+    """Checkpoints, optimizes and optionally vacuums a partition no longer written to."""
+    try:
+        conn = sqlite3.connect(f"file:{path}?mode=rw", uri=True)
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("PRAGMA optimize")
+        if vacuum:
+            conn.execute("VACUUM")
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+    except sqlite3.Error as e:
+        print(f"[ERROR] Failed to compact {path}: {e}")
+
+
+def query_partitions(cfg: dict, sql: str, params=(), since: float = None, until: float = None):
+    """Runs a read-only query against every partition overlapping [since, until).
+
+    Rows are yielded partition by partition, oldest first. Time bounds only
+    select partitions; filter rows in `sql` as well if exact bounds matter.
+    """
+    file_name = cfg.get("file_name", "logger.db")
+    mode = cfg.get("partition", "none")
+    for key, path in list_partitions(file_name, mode):
+        if key is not None and (since is not None or until is not None):
+            start, end = partition_range(mode, key)
+            if (since is not None and end <= since) or (until is not None and start >= until):
+                continue
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            yield from conn.execute(sql, params)
+        finally:
+            conn.close()
+
+
+def find_transcript(cfg: dict, session_id: str) -> list:
+    """Looks a session's transcript up across all partitions, newest first."""
+    file_name = cfg.get("file_name", "logger.db")
+    for _, path in reversed(list_partitions(file_name, cfg.get("partition", "none"))):
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            frames = read_transcript(conn, session_id)
+        finally:
+            conn.close()
+        if frames:
+            return frames
+    return []
+
+
+class SQLiteWriter:
+    """Writes sessions and their transcripts in batches, one transaction per batch.
+
+    With partitioning enabled, sessions go to one database file per day or
+    week of their start time. Partitions that are no longer written to are
+    compacted in the background, and only the newest `retention` partitions
+    are kept, so cleanup is just unlinking files.
+    """
+
+    # NOTE: The current and the previous partition stay open for sessions straddling a rollover.
+    OPEN_PARTITIONS = 2
+
+    def __init__(self, cfg: dict, on_stats=None):
+        self.file_name = cfg.get("file_name", "logger.db")
+        # NOTE: Called after each stats line, so the log queue's counters are reported alongside.
+        self.on_stats = on_stats
+        self.journal_mode = str(cfg.get("journal_mode", "WAL")).upper()
+        self.synchronous = str(cfg.get("synchronous", "NORMAL")).upper()
+        self.cache_size_kb = int(cfg.get("cache_size_kb", 16384))
+        self.stats_interval = cfg.get("stats_interval", 60)
+        self.codec = cfg.get("compression") or default_codec()
+        self.level = cfg.get("compression_level")
+        self.partition = cfg.get("partition", "none")
+        self.retention = int(cfg.get("retention", 0))
+        self.vacuum_closed = cfg.get("vacuum_closed", True)
+        self.payload_cache = int(cfg.get("payload_cache", DEFAULT_PAYLOAD_CACHE))
+
+        if self.partition not in PARTITION_FORMATS:
+            raise ValueError(
+                f"logging.sqlite.partition must be one of {', '.join(PARTITION_FORMATS)}"
+            )
+
+        if self.codec not in CODECS:
+            raise ValueError(f"logging.sqlite.compression must be one of {', '.join(CODECS)}")
+        if self.codec == "zstd" and not zstandard:
+            print("[WARN] zstandard is not installed, compressing transcripts with zlib")
+            self.codec = "zlib"
+        if self.synchronous not in SYNCHRONOUS_MODES:
+            raise ValueError(
+                f"logging.sqlite.synchronous must be one of {', '.join(SYNCHRONOUS_MODES)}"
+            )
+
+        self._conns = OrderedDict()
+        # NOTE: (partition, digest) of payloads known to be stored, most recently seen last.
+        self._payloads = OrderedDict()
+        self._compacting = set()
+        self._newest = None
+        self._conn(partition_key(self.partition, time.time()))
+
+        self.total_rows = 0
+        self.total_batches = 0
+        self.payloads_stored = 0
+        self.payloads_shared = 0
+        self._reset_window()
+
+    def _route(self, start_ts: float):
+        key = partition_key(self.partition, start_ts)
+        if key is None or key in self._conns:
+            return key
+        # NOTE: Never reopen a closed partition, it may be compacting. Late sessions go to the oldest open one.
+        oldest = min(self._conns)
+        return oldest if key < oldest else key
+
+    def _conn(self, key) -> sqlite3.Connection:
+        conn = self._conns.get(key)
+        if conn:
+            self._conns.move_to_end(key)
+            return conn
+
+        conn = sqlite3.connect(partition_path(self.file_name, key), check_same_thread=False)
+        self._apply_pragmas(conn)
+        create_schema(conn)
+        self._conns[key] = conn
+
+        while len(self._conns) > self.OPEN_PARTITIONS:
+            old_key, old = self._conns.popitem(last=False)
+            old.close()
+            if old_key is not None:
+                self._compact_in_background(partition_path(self.file_name, old_key))
+
+        if key is not None and (self._newest is None or key > self._newest):
+            self._newest = key
+            self._apply_retention()
+        return conn
+
+    def _compact_in_background(self, path: str):
+        def run():
+            try:
+                compact_partition(path, self.vacuum_closed)
+            finally:
+                self._compacting.discard(path)
+
+        self._compacting.add(path)
+        threading.Thread(target=run, name=f"compact-{os.path.basename(path)}", daemon=True).start()
+
+    def _apply_retention(self):
+        if self.retention <= 0:
+            return
+        partitions = list_partitions(self.file_name, self.partition)
+        for key, path in partitions[: -self.retention]:
+            # NOTE: Partitions still open or compacting are removed on a later rollover.
+            if key in self._conns or path in self._compacting:
+                continue
+            remove_partition(path)
+            print(f"[INFO] Removed expired log partition {path}")
+
+    def _apply_pragmas(self, c: sqlite3.Connection):
+        mode = c.execute(f"PRAGMA journal_mode={self.journal_mode}").fetchone()[0]
+        if mode.upper() != self.journal_mode:
+            print(
+                f"[WARN] SQLite journal_mode {self.journal_mode} not applied, using {mode}"
+            )
+        c.execute(f"PRAGMA synchronous={self.synchronous}")
+        # NOTE: Negative cache_size is in KiB rather than pages.
+        c.execute(f"PRAGMA cache_size=-{self.cache_size_kb}")
+        c.execute("PRAGMA temp_store=MEMORY")
+
+    def _reset_window(self):
+        self._win_start = time.monotonic()
+        self._win_rows = 0
+        self._win_batches = 0
+        self._win_min = 0
+        self._win_max = 0
+        self._win_busy = 0.0
+
+    def _new_payloads(self, key, conn: sqlite3.Connection, group: list) -> list:
+        """Returns the payloads rows of `group` not stored in partition `key` yet."""
+        rows = {}
+        for _, _, payload in group:
+            if payload is None:
+                continue
+            digest, data = payload
+            known = (key, digest)
+            if known in self._payloads:
+                # NOTE: Hot payloads are answered from memory, without a lookup or compressing them again.
+                self._payloads.move_to_end(known)
+                self.payloads_shared += 1
+            elif digest in rows:
+                # NOTE: Stored by this batch, so cached with its new rows once the batch commits.
+                self.payloads_shared += 1
+            elif conn.execute("SELECT 1 FROM payloads WHERE digest = ?", (digest,)).fetchone():
+                self.payloads_shared += 1
+                self._remember(known)
+            else:
+                rows[digest] = (digest, self.codec, len(data), compress(data, self.codec, self.level))
+        return list(rows.values())
+
+    def _remember(self, known: tuple):
+        if self.payload_cache <= 0:
+            return
+        self._payloads[known] = True
+        while len(self._payloads) > self.payload_cache:
+            self._payloads.popitem(last=False)
+
+    @staticmethod
+    def _update_counters(conn: sqlite3.Connection, counters: list) -> list:
+        """Sets hit_count and last_seen on stored sessions. Returns the counters whose session isn't in `conn`."""
+        return [s for s in counters if not conn.execute(UPDATE_COUNTER, (s[11], s[12], s[0])).rowcount]
+
+    def _update_elsewhere(self, counters: list, tried):
+        """Applies counters whose session wasn't in the partition they were routed to."""
+        # NOTE: A late session may have been routed to another open partition than its own.
+        for key in [k for k in reversed(self._conns) if k != tried]:
+            if not counters:
+                return
+            conn = self._conns[key]
+            try:
+                counters = self._update_counters(conn, counters)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        # NOTE: Their partition was closed since; update its file directly rather than reopen it for writing.
+        paths = {}
+        for s in counters:
+            paths.setdefault(partition_path(self.file_name, partition_key(self.partition, s[4])), []).append(s)
+        for path, group in paths.items():
+            try:
+                conn = sqlite3.connect(f"file:{path}?mode=rw", uri=True, timeout=30)
+            except sqlite3.OperationalError:
+                print(f"[WARN] Dropped {len(group)} hit counts, partition {path} is gone")
+                continue
+            try:
+                with conn:
+                    self._update_counters(conn, group)
+            finally:
+                conn.close()
+
+    def write(self, rows: list):
+        """Writes (session, transcript, payload) rows from session_rows()."""
+        if not rows:
+            return
+        t0 = time.monotonic()
+        # NOTE: partition -> (new session rows, counter sessions), each written in one transaction.
+        groups = {}
+        for row in rows:
+            group = groups.setdefault(self._route(row[0][4]), ([], []))
+            # NOTE: Only the coalescer sets hit_count, to update a session it let through earlier.
+            if row[0][11] > 1:
+                group[1].append(row[0])
+            else:
+                group[0].append(row)
+        try:
+            for key, (group, counters) in groups.items():
+                conn = self._conn(key)
+                try:
+                    payloads = self._new_payloads(key, conn, group)
+                    conn.executemany(INSERT_PAYLOAD, payloads)
+                    conn.executemany(INSERT_SESSION, [r[0] for r in group])
+                    conn.executemany(INSERT_TRANSCRIPT, [r[1] for r in group if r[1]])
+                    missed = self._update_counters(conn, counters)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                # NOTE: Only cached once committed, so a rolled back batch can't leave a dangling digest.
+                self.payloads_stored += len(payloads)
+                for row in payloads:
+                    self._remember((key, row[0]))
+                if missed:
+                    self._update_elsewhere(missed, key)
+        finally:
+            self._win_busy += time.monotonic() - t0
+
+        n = len(rows)
+        self.total_rows += n
+        self.total_batches += 1
+        self._win_rows += n
+        self._win_batches += 1
+        self._win_min = n if self._win_batches == 1 else min(self._win_min, n)
+        self._win_max = max(self._win_max, n)
+
+        if self.stats_interval and time.monotonic() - self._win_start >= self.stats_interval:
+            self.report_stats()
+
+    def stats(self) -> dict:
+        elapsed = max(time.monotonic() - self._win_start, 1e-9)
+        batches = self._win_batches
+        return {
+            "rows_per_sec": self._win_rows / elapsed,
+            "batches": batches,
+            "batch_min": self._win_min,
+            "batch_max": self._win_max,
+            "batch_avg": self._win_rows / batches if batches else 0.0,
+            "busy_pct": 100.0 * self._win_busy / elapsed,
+            "total_rows": self.total_rows,
+            "total_batches": self.total_batches,
+            "payloads_stored": self.payloads_stored,
+            "payloads_shared": self.payloads_shared,
+        }
+
+    def report_stats(self):
+        s = self.stats()
+        print(
+            f"[INFO] SQLite writer: {s['rows_per_sec']:.1f} rows/s, "
+            f"{s['batches']} batches (min {s['batch_min']}, avg {s['batch_avg']:.1f}, max {s['batch_max']}), "
+            f"{s['busy_pct']:.1f}% busy, {s['total_rows']} rows total, "
+            f"payloads {s['payloads_stored']} stored / {s['payloads_shared']} shared"
+        )
+        if self.on_stats:
+            self.on_stats()
+        self._reset_window()
+
+    def close(self):
+        for conn in self._conns.values():
+            conn.close()
+        self._conns.clear()
+
+
+class WriterThread(threading.Thread):
+    """Owns the SQLite connection and persists sessions off the event loop.
+
+    Sessions are handed over with submit() and batched here: up to batch_size
+    messages, or whatever arrived within batch_wait_ms of the first one.
+    Serialization happens in this thread too, so large transcripts never block
+    the emulators. The inbox is bounded; submit() returns False when it is
+    full so the caller can apply backpressure.
+    """
+
+    _STOP = object()
+
+    def __init__(self, cfg: dict, on_stats=None):
+        super().__init__(name="sqlite-writer", daemon=True)
+        self.cfg = cfg
+        self.on_stats = on_stats
+        self.batch_size = max(1, int(cfg.get("batch_size", 500)))
+        self.batch_wait = cfg.get("batch_wait_ms", 250) / 1000
+        self.inbox = Queue(maxsize=int(cfg.get("inbox_size", self.batch_size * 4)))
+        self.writer = None
+        self._ready = threading.Event()
+        self._error = None
+
+    def start(self):
+        super().start()
+        self._ready.wait()
+        if self._error:
+            raise self._error
+
+    def submit(self, msg: dict) -> bool:
+        try:
+            self.inbox.put_nowait(msg)
+        except Full:
+            return False
+        return True
+
+    def close(self, timeout: float = None):
+        self.inbox.put(self._STOP)
+        self.join(timeout)
+
+    def _next_batch(self):
+        first = self.inbox.get()
+        if first is self._STOP:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                msg = self.inbox.get(timeout=remaining) if remaining > 0 else self.inbox.get_nowait()
+            except Empty:
+                break
+            if msg is self._STOP:
+                return batch, True
+            batch.append(msg)
+        return batch, False
+
+    def run(self):
+        try:
+            self.writer = SQLiteWriter(self.cfg, self.on_stats)
+        except Exception as e:
+            self._error = e
+            return
+        finally:
+            self._ready.set()
+
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            rows = []
+            for msg in batch:
+                try:
+                    rows.append(session_rows(msg, self.writer.codec, self.writer.level))
+                except Exception as e:
+                    print(f"[ERROR] Dropping malformed session: {e}")
+            try:
+                self.writer.write(rows)
+            except Exception as e:
+                print(f"[ERROR] SQLite error: {e}")
+
+        if self.writer.total_rows:
+            self.writer.report_stats()
+        self.writer.close()
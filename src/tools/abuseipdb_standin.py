@@ -0,0 +1,157 @@
+# tools/abuseipdb_standin.py
+"""Local stand-in for the AbuseIPDB report API.
+
+Run from the src directory:
+
+    python -m tools.abuseipdb_standin --port 8099
+    python -m tools.abuseipdb_standin --bench 5000
+
+Point `logging.abuseipdb.report_url` and `bulk_report_url` at
+http://127.0.0.1:8099/api/v2/report and /api/v2/bulk-report to exercise the
+reporter offline. With --bench, the stand-in is started in-process and the
+given number of reports is pushed through AbuseReporter (add --bulk to use the
+bulk-report path).
+"""
+import argparse
+import asyncio
+import csv
+import io
+import ipaddress
+import os
+import tempfile
+import time
+
+from aiohttp import web
+
+from reporter import AbuseReporter
+
+
+class StandIn:
+    def __init__(self, latency_ms: float = 0, limit_every: int = 0, retry_after: int = 1):
+        self.latency = latency_ms / 1000
+        self.limit_every = limit_every
+        self.retry_after = retry_after
+        self.received = 0
+        self.limited = 0
+        self.requests = 0
+
+    async def _throttle(self):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.limit_every and self.requests % self.limit_every == 0:
+            self.limited += 1
+            return web.json_response(
+                {"errors": [{"detail": "Daily rate limit exceeded.", "status": 429}]},
+                status=429,
+                headers={"Retry-After": str(self.retry_after)},
+            )
+        return None
+
+    async def report(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        limited = await self._throttle()
+        if limited:
+            return limited
+        self.received += 1
+        return web.json_response(
+            {"data": {"ipAddress": form.get("ip"), "abuseConfidenceScore": 0}}
+        )
+
+    async def bulk_report(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        limited = await self._throttle()
+        if limited:
+            return limited
+        upload = form.get("csv")
+        text = upload.file.read().decode() if hasattr(upload, "file") else str(upload or "")
+        saved, invalid = 0, []
+        for n, row in enumerate(csv.DictReader(io.StringIO(text)), 1):
+            try:
+                ipaddress.ip_address(row["IP"])
+            except ValueError:
+                invalid.append({"error": "Invalid IP", "input": row["IP"], "rowNumber": n})
+                continue
+            saved += 1
+        self.received += saved
+        return web.json_response({"data": {"savedReports": saved, "invalidReports": invalid}})
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=4 * 1024 * 1024)
+        app.router.add_post("/api/v2/report", self.report)
+        app.router.add_post("/api/v2/bulk-report", self.bulk_report)
+        return app
+
+
+async def serve(standin: StandIn, host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(standin.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def bench(args):
+    standin = StandIn(args.latency, args.limit_every, args.retry_after)
+    runner = await serve(standin, args.host, args.port)
+    base = f"http://{args.host}:{args.port}/api/v2"
+    with tempfile.TemporaryDirectory() as tmp:
+        reporter = AbuseReporter(
+            api_key="bench",
+            user_agent="StickyPorts/bench",
+            spool_file=os.path.join(tmp, "spool.db"),
+            url=f"{base}/report",
+            bulk_url=f"{base}/bulk-report",
+            bulk=args.bulk,
+            flush_interval=3600,
+            concurrency=args.concurrency,
+            queue_size=args.reports,
+        )
+        await reporter.start()
+
+        t0 = time.perf_counter()
+        for i in range(args.reports):
+            reporter.submit(f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", [14], "bench", "")
+        while reporter.sent + reporter.failed < args.reports:
+            await reporter.flush(force_bulk=True)
+            await asyncio.sleep(max(0.0, reporter._resume_at - time.monotonic()))
+        elapsed = time.perf_counter() - t0
+
+        await reporter.close()
+    await runner.cleanup()
+    mode = "bulk" if args.bulk else f"concurrency {args.concurrency}"
+    print(
+        f"{args.reports} reports in {elapsed:.2f}s ({args.reports / elapsed:.0f} reports/s) "
+        f"using {mode} in {standin.requests} requests; stats {reporter.stats()}"
+    )
+
+
+async def run(args):
+    standin = StandIn(args.latency, args.limit_every, args.retry_after)
+    runner = await serve(standin, args.host, args.port)
+    print(f"[INFO] AbuseIPDB stand-in listening on http://{args.host}:{args.port}/api/v2/report")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8099)
+    p.add_argument("--latency", type=float, default=0, help="Added response latency in ms.")
+    p.add_argument("--limit-every", type=int, default=0, help="Answer every Nth request with 429.")
+    p.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429s.")
+    p.add_argument("--bench", dest="reports", type=int, default=0, help="Push N reports through AbuseReporter and exit.")
+    p.add_argument("--concurrency", type=int, default=4, help="Reporter concurrency for --bench.")
+    p.add_argument("--bulk", action="store_true", help="Use the bulk-report path for --bench.")
+    args = p.parse_args()
+
+    try:
+        asyncio.run(bench(args) if args.reports else run(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
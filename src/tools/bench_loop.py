@@ -0,0 +1,143 @@
+# tools/bench_loop.py
+"""Measures per-connection memory and accepts/sec of an emulator per event loop.
+
+Run from the src directory (Linux, reads /proc for memory):
+
+    python -m tools.bench_loop
+    python -m tools.bench_loop --loop uvloop --service ftp --connections 5000
+    python -m tools.bench_loop --service telnet --mode protocol
+
+For each loop, one emulator is served in a child process running on that
+loop. The benchmark then opens --connections idle sessions and reports the
+server's RSS growth per connection. After that, it opens and closes
+--accepts connections with --concurrency clients at a time and reports
+accepts/sec. Admission and logging are bypassed so only the emulator and
+the loop are measured. --mode protocol serves the emulator's protocol-mode
+handler instead of its stream handler.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import time
+
+from engine import EVENT_LOOPS, loop_factory, run
+
+# NOTE: Only services that greet first; a session counts as accepted once its first byte arrives.
+SERVICES = {
+    "vnc": ("emulators.vnc", "VNCEmulator"),
+    "telnet": ("emulators.telnet", "TelnetEmulator"),
+    "redis": ("emulators.redis", "RedisEmulator"),
+    "smtp": ("emulators.smtp", "SMTPEmulator"),
+    "ftp": ("emulators.ftp", "FTPEmulator"),
+    "mysql": ("emulators.mysql", "MySQLEmulator"),
+}
+
+
+def rss_kb(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+async def _serve(service: str, mode: str, port: int, ready, stop):
+    import logger
+
+    module, cls = SERVICES[service]
+    emu_cls = getattr(__import__(module, fromlist=[cls]), cls)
+    emulator = emu_cls(
+        "127.0.0.1", port, {"emulators": {service: {"idle_timeout": 0, "max_session": 0, "mode": mode}}}
+    )
+
+    async def discard():
+        while True:
+            await logger.queue.get()
+
+    sink = asyncio.create_task(discard())
+    if emulator.mode == "protocol":
+        server = await asyncio.get_running_loop().create_server(
+            lambda: emulator.protocol(emulator), "127.0.0.1", port, backlog=4096
+        )
+    else:
+        server = await asyncio.start_server(
+            emulator.handle, "127.0.0.1", port, limit=emulator.max_line, backlog=4096
+        )
+    ready.set()
+    await asyncio.to_thread(stop.wait)
+    server.close()
+    sink.cancel()
+
+
+def serve(loop: str, service: str, mode: str, port: int, ready, stop):
+    run(_serve(service, mode, port, ready, stop), loop)
+
+
+async def _session(port: int):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    await reader.read(1)
+    return writer
+
+
+async def measure(pid: int, port: int, args) -> tuple:
+    before = rss_kb(pid)
+    writers = []
+    for i in range(0, args.connections, args.concurrency):
+        n = min(args.concurrency, args.connections - i)
+        writers += await asyncio.gather(*(_session(port) for _ in range(n)))
+    await asyncio.sleep(0.5)
+    per_conn = (rss_kb(pid) - before) * 1024 / args.connections
+    for w in writers:
+        w.close()
+    await asyncio.sleep(1)
+
+    remaining = args.accepts
+
+    async def client():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            w = await _session(port)
+            w.close()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    rate = args.accepts / (time.perf_counter() - t0)
+    # NOTE: Let the last sessions finish their handshake delays before the server is stopped.
+    await asyncio.sleep(1)
+    return per_conn, rate
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--loop", choices=EVENT_LOOPS[:2], action="append", help="Loop to measure (repeatable, default both).")
+    p.add_argument("--service", choices=SERVICES, default="vnc")
+    p.add_argument("--mode", choices=("stream", "protocol"), default="stream", help="Handler mode (protocol: vnc, telnet).")
+    p.add_argument("--port", type=int, default=18000)
+    p.add_argument("--connections", type=int, default=2000, help="Idle sessions held for the memory measurement.")
+    p.add_argument("--accepts", type=int, default=5000, help="Connections opened for the accepts/sec measurement.")
+    p.add_argument("--concurrency", type=int, default=50, help="Clients connecting at once.")
+    args = p.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    for loop in args.loop or EVENT_LOOPS[:2]:
+        if loop == "uvloop" and loop_factory("auto") is None:
+            print("uvloop: not installed, skipped")
+            continue
+        ready, stop = ctx.Event(), ctx.Event()
+        proc = ctx.Process(target=serve, args=(loop, args.service, args.mode, args.port, ready, stop))
+        proc.start()
+        ready.wait(30)
+        try:
+            per_conn, rate = asyncio.run(measure(proc.pid, args.port, args))
+        finally:
+            stop.set()
+            proc.join(10)
+        print(
+            f"{loop}: {args.service} ({args.mode}), {per_conn / 1024:.1f} KiB per idle connection "
+            f"({args.connections} held), {rate:.0f} accepts/s (concurrency {args.concurrency})"
+        )
+
+
+if __name__ == "__main__":
+    main()
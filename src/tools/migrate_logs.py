@@ -0,0 +1,189 @@
+# tools/migrate_logs.py
+"""Converts rows of the legacy `logs` table into sessions + transcripts.
+
+Run from the src directory:
+
+    python -m tools.migrate_logs logger.db
+    python -m tools.migrate_logs logger.db --partition day --drop
+
+Legacy transcripts were stored as JSON text, so payloads are recovered as
+latin-1 (hex for MySQL). Whitespace the old format stripped from line-based
+services can't be recovered. Frames with a direction other than client or
+server are skipped and counted. Pass the logging.sqlite.partition setting as
+--partition so sessions land in the partition files the writer and readers
+use. Already-migrated sessions are skipped, so the tool can be re-run after
+an interruption.
+"""
+import argparse
+import json
+import sqlite3
+import time
+
+from collections import OrderedDict
+
+from storage import (
+    CODECS,
+    FRAME_DIRECTIONS,
+    INSERT_PAYLOAD,
+    INSERT_SESSION,
+    INSERT_TRANSCRIPT,
+    PARTITION_FORMATS,
+    compress,
+    create_schema,
+    default_codec,
+    partition_key,
+    partition_path,
+    transcript_row,
+)
+
+HEX_SERVICES = {"mysql"}
+# NOTE: Partition files kept open at once; legacy rows are mostly in time order.
+OPEN_PARTITIONS = 4
+
+
+def legacy_frames(service: str, details_json: str) -> tuple:
+    """Returns a legacy transcript's (ts, direction, payload) frames and how many were skipped."""
+    frames = []
+    skipped = 0
+    for f in json.loads(details_json or "null") or []:
+        direction = f.get("direction", "client")
+        if direction not in FRAME_DIRECTIONS:
+            skipped += 1
+            continue
+        data = f.get("data") or ""
+        if service in HEX_SERVICES:
+            payload = bytes.fromhex(data)
+        else:
+            payload = data.encode("latin-1", errors="replace")
+        frames.append((f.get("ts") or 0.0, direction, payload))
+    return frames, skipped
+
+
+class Partitions:
+    """Target databases of the migration, one per partition, opened as needed."""
+
+    def __init__(self, conn: sqlite3.Connection, file_name: str, mode: str):
+        self.base = conn
+        self.file_name = file_name
+        self.mode = mode
+        self.conns = OrderedDict()
+
+    def get(self, key) -> sqlite3.Connection:
+        if key is None:
+            return self.base
+        conn = self.conns.get(key)
+        if conn is not None:
+            self.conns.move_to_end(key)
+            return conn
+        conn = self.conns[key] = sqlite3.connect(partition_path(self.file_name, key))
+        create_schema(conn)
+        while len(self.conns) > OPEN_PARTITIONS:
+            self.conns.popitem(last=False)[1].close()
+        return conn
+
+    def close(self):
+        for conn in self.conns.values():
+            conn.close()
+        self.conns.clear()
+
+
+def migrate(conn: sqlite3.Connection, codec: str, batch: int, file_name: str = None, mode: str = "none") -> int:
+    if mode == "none":
+        create_schema(conn)
+    partitions = Partitions(conn, file_name, mode)
+    try:
+        return _migrate(conn, partitions, codec, batch)
+    finally:
+        partitions.close()
+
+
+def _migrate(conn: sqlite3.Connection, partitions: Partitions, codec: str, batch: int) -> int:
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(logs)")}
+    if not columns:
+        print("[INFO] No legacy logs table, nothing to migrate.")
+        return 0
+    trunc = (
+        "truncated_frames, truncated_bytes"
+        if "truncated_frames" in columns
+        else "0, 0"
+    )
+
+    migrated = 0
+    skipped_frames = 0
+    last = 0
+    while True:
+        rows = conn.execute(
+            f"""
+            SELECT rowid, session_id, service, ip, port, start_ts, end_ts, cmd_count, {trunc}, details
+            FROM logs
+            WHERE rowid > ?
+            ORDER BY rowid LIMIT ?
+            """,
+            (last, batch),
+        ).fetchall()
+        if not rows:
+            break
+        # NOTE: partition key -> (sessions, transcripts, payloads by digest) of this batch.
+        groups = {}
+        for rowid, sid, service, ip, port, start_ts, end_ts, cmd_count, tf, tb, details in rows:
+            last = rowid
+            key = partition_key(partitions.mode, start_ts)
+            if partitions.get(key).execute("SELECT 1 FROM sessions WHERE session_id = ?", (sid,)).fetchone():
+                continue
+            sessions, transcripts, payloads = groups.setdefault(key, ([], [], {}))
+            digest = None
+            try:
+                frames, skipped = legacy_frames(service, details)
+            except (ValueError, TypeError, AttributeError) as e:
+                print(f"[WARN] Session {sid}: unreadable transcript ({e}), migrating summary only")
+                frames, skipped = [], 0
+            skipped_frames += skipped
+            if frames:
+                transcript, payload = transcript_row(sid, frames, codec)
+                transcripts.append(transcript)
+                if payload:
+                    digest = payload[0]
+                    if digest not in payloads:
+                        payloads[digest] = (digest, codec, len(payload[1]), compress(payload[1], codec))
+            sessions.append((sid, service, ip, port, start_ts, end_ts, cmd_count, tf, tb, None, None, 1, None, digest))
+        for key, (sessions, transcripts, payloads) in groups.items():
+            target = partitions.get(key)
+            with target:
+                target.executemany(INSERT_PAYLOAD, payloads.values())
+                target.executemany(INSERT_SESSION, sessions)
+                target.executemany(INSERT_TRANSCRIPT, transcripts)
+            migrated += len(sessions)
+        print(f"[INFO] Migrated {migrated} sessions")
+    if skipped_frames:
+        print(f"[WARN] Skipped {skipped_frames} frames with an unknown direction")
+    return migrated
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("db", help="SQLite database holding the legacy logs table.")
+    p.add_argument("--codec", choices=CODECS, default=default_codec())
+    p.add_argument(
+        "--partition",
+        choices=PARTITION_FORMATS,
+        default="none",
+        help="logging.sqlite.partition of the installation; sessions are written to its partition files.",
+    )
+    p.add_argument("--batch", type=int, default=1000, help="Rows converted per transaction.")
+    p.add_argument("--drop", action="store_true", help="Drop the logs table and VACUUM afterwards.")
+    args = p.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    t0 = time.monotonic()
+    n = migrate(conn, args.codec, args.batch, args.db, args.partition)
+    print(f"[INFO] Done: {n} sessions in {time.monotonic() - t0:.1f}s")
+    if args.drop:
+        conn.execute("DROP TABLE IF EXISTS logs")
+        conn.commit()
+        conn.execute("VACUUM")
+        print("[INFO] Dropped legacy logs table")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()